@@ -0,0 +1,70 @@
+import statistics
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+from database import MedicineBarcode
+
+def normalize_gtin(code: str) -> str:
+    """Scanner input as a GTIN-14, so UPC-A, EAN-13 and GTIN-14 scans of one item match"""
+    code = code.strip()
+    return code.zfill(14) if code.isdigit() and len(code) <= 14 else code
+
+class ScanStats:
+    """Rolling scan-to-line latencies in milliseconds"""
+
+    def __init__(self, size: int = 500):
+        self.samples = deque(maxlen=size)
+
+    def record(self, seconds: float):
+        self.samples.append(seconds * 1000)
+
+    def summary(self) -> Dict:
+        if not self.samples:
+            return {'count': 0, 'p50_ms': 0.0, 'p95_ms': 0.0, 'max_ms': 0.0}
+        ordered = sorted(self.samples)
+        return {
+            'count': len(ordered),
+            'p50_ms': statistics.median(ordered),
+            'p95_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+            'max_ms': ordered[-1]
+        }
+
+class BarcodeIndex:
+    """Every barcode on the terminal in a dict, for scans without a DB round trip.
+
+    ``load`` builds a new dict from one query and swaps it in whole, so it
+    can run on the scheduler thread while the counter keeps scanning
+    against the previous copy.
+    """
+
+    def __init__(self):
+        self.codes = {}
+        self.loaded_at = None
+        self._lock = threading.Lock()
+
+    def load(self) -> int:
+        codes = {}
+        for row in MedicineBarcode.get_index_rows():
+            codes[normalize_gtin(row['barcode'])] = {
+                'medicine_id': row['medicine_id'],
+                'name': row['name'],
+                'price': row['price']
+            }
+        with self._lock:
+            self.codes = codes
+            self.loaded_at = time.time()
+        return len(codes)
+
+    def lookup(self, code: str) -> Optional[Dict]:
+        return self.codes.get(normalize_gtin(code))
+
+    def add(self, code: str, medicine: Dict):
+        """Make a just-registered barcode scannable before the next load"""
+        with self._lock:
+            codes = dict(self.codes)
+            codes[normalize_gtin(code)] = medicine
+            self.codes = codes
+
+    def __len__(self):
+        return len(self.codes)
@@ -0,0 +1,150 @@
+"""Micro-benchmarks for the pharmacy hot paths.
+
+Run one with ``python benchmarks.py <name>``; see ``--help`` for the list.
+"""
+import argparse
+import time
+from datetime import datetime
+from decimal import Decimal
+
+def sample_receipt(lines: int = 10) -> dict:
+    items = []
+    for i in range(lines):
+        price = Decimal("2.50") + i
+        items.append((f"Sample Medicine {i} 500mg Tablets", 2, price, price * 2))
+    subtotal = sum(item[3] for item in items)
+    tax = (subtotal * Decimal("0.10")).quantize(Decimal("0.01"))
+    return {
+        'issued_at': datetime.now(),
+        'customer': {'name': "John Doe", 'phone': "1234567890"},
+        'lines': items,
+        'subtotal': subtotal,
+        'tax': tax,
+        'total': subtotal + tax
+    }
+
+def report(name: str, count: int, elapsed: float):
+    print(f"{name}: {count} in {elapsed:.3f}s ({count / elapsed:.1f}/s, {elapsed / count * 1000:.2f} ms each)")
+
+def bench_receipts(count: int = 200, lines: int = 10):
+    """Receipts per second and output size for every receipt format"""
+    from receipt_renderer import ReceiptRenderer, render_stats
+
+    renderer = ReceiptRenderer()
+    receipt = sample_receipt(lines)
+    for fmt in ReceiptRenderer.BACKENDS:
+        renderer.render(receipt, fmt)
+
+        start = time.perf_counter()
+        for _ in range(count):
+            renderer.render(receipt, fmt)
+        report(f"render {fmt} receipt ({lines} lines)", count, time.perf_counter() - start)
+
+    for fmt, stats in render_stats.summary().items():
+        print(f"{fmt}: {stats['avg_bytes'] / 1024:.1f} KB, {stats['avg_ms']:.2f} ms average over {stats['count']}")
+
+def bench_order_items(count: int = 20, sizes=(1, 10, 100, 1000)):
+    """Per-row vs multi-row order_items inserts; everything is rolled back"""
+    from database import Database, Order
+
+    conn = Database.get_connection()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute("SELECT medicine_id, price FROM medicines LIMIT 1")
+        medicine = cursor.fetchone()
+        cursor.execute("INSERT INTO orders (total_amount, order_type) VALUES (0, 'benchmark')")
+        order_id = cursor.lastrowid
+
+        for size in sizes:
+            items = [{'medicine_id': medicine['medicine_id'], 'quantity': 1,
+                      'price': medicine['price'], 'subtotal': medicine['price']}] * size
+
+            start = time.perf_counter()
+            for _ in range(count):
+                for item in items:
+                    cursor.execute(
+                        """INSERT INTO order_items (order_id, medicine_id, quantity, unit_price, subtotal)
+                           VALUES (%s, %s, %s, %s, %s)""",
+                        (order_id, item['medicine_id'], item['quantity'], item['price'], item['subtotal'])
+                    )
+            report(f"order with {size} lines, row by row", count, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for _ in range(count):
+                Order.add_items(order_id, items, cursor)
+            report(f"order with {size} lines, multi-row", count, time.perf_counter() - start)
+    finally:
+        conn.rollback()
+        Database.close_connection(conn, cursor)
+
+def sample_interaction_data(rules: int = 10000, medicines: int = 5000, ingredients: int = 2000,
+                            categories: int = 200, seed: int = 1):
+    """Synthetic rule and medicine rows shaped like InteractionRule/Medicine query results"""
+    import random
+
+    rng = random.Random(seed)
+    now = datetime.now()
+
+    def key():
+        if rng.random() < 0.9:
+            return ('ingredient', f"ingredient {rng.randrange(ingredients)}")
+        return ('category', f"category {rng.randrange(categories)}")
+
+    pairs = set()
+    while len(pairs) < rules:
+        pairs.add(tuple(sorted([key(), key()])))
+    rule_rows = [{'rule_id': i, 'left_type': a[0], 'left_value': a[1], 'right_type': b[0], 'right_value': b[1],
+                  'severity': rng.choice(('minor', 'moderate', 'major')), 'description': None,
+                  'active': 1, 'updated_at': now}
+                 for i, (a, b) in enumerate(pairs, start=1)]
+    medicine_rows = [{'medicine_id': i, 'name': f"Medicine {i}",
+                      'active_ingredient': f"ingredient {rng.randrange(ingredients)}",
+                      'category': f"category {rng.randrange(categories)}", 'updated_at': None}
+                     for i in range(1, medicines + 1)]
+    return rule_rows, medicine_rows
+
+def bench_interactions(count: int = 200, rules: int = 10000, sizes=(5, 10, 20, 50)):
+    """Interaction index build, basket checks and incremental rule updates, all in memory"""
+    import random
+    from interactions import InteractionIndex
+
+    rule_rows, medicine_rows = sample_interaction_data(rules)
+    index = InteractionIndex()
+    start = time.perf_counter()
+    index.apply(rule_rows, medicine_rows)
+    print(f"build: {len(rule_rows)} rules, {len(medicine_rows)} medicines, {len(index.key_bits)} keys "
+          f"in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    rng = random.Random(2)
+    for size in sizes:
+        baskets = [rng.sample(range(1, len(medicine_rows) + 1), size) for _ in range(count)]
+        findings = 0
+        start = time.perf_counter()
+        for basket in baskets:
+            findings += len(index.check(basket))
+        report(f"check basket of {size} ({findings / count:.1f} findings each)", count, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for basket in baskets:
+            index.check(basket, added=basket[-1:])
+        report(f"check one line against {size - 1}", count, time.perf_counter() - start)
+
+    # A refresh's worth of changes: some rules edited, some switched off
+    changed = [dict(rule, severity='major', updated_at=datetime.now()) for rule in rng.sample(rule_rows, 80)]
+    changed += [dict(rule, active=0, updated_at=datetime.now()) for rule in rng.sample(rule_rows, 20)]
+    start = time.perf_counter()
+    index.apply(changed)
+    print(f"incremental: {len(changed)} rule changes in {(time.perf_counter() - start) * 1000:.2f} ms")
+
+BENCHMARKS = {
+    'receipts': bench_receipts,
+    'order_items': bench_order_items,
+    'interactions': bench_interactions,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--count", type=int, default=200)
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](count=args.count)
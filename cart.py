@@ -0,0 +1,98 @@
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Dict, List
+
+CENT = Decimal("0.01")
+
+def to_money(value) -> Decimal:
+    """Convert a price from the database, a widget or a float to exact cents"""
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    return value.quantize(CENT, rounding=ROUND_HALF_UP)
+
+class Cart:
+    """Bill lines keyed by medicine_id with exact running totals.
+
+    Prices are snapshotted as Decimal when a medicine is first added, adding
+    the same medicine again merges into its line, and the subtotal is updated
+    by the line's delta on every change, so totals cost O(1) regardless of
+    how many lines the bill has. Views subscribe to per-line change events
+    instead of reading totals back out of widgets. A line dispensed against a
+    prescription holds exactly one fill, so nothing is merged into or onto it.
+    """
+
+    TAX_RATE = Decimal("0.10")
+
+    def __init__(self):
+        self.lines = {}
+        self.subtotal = Decimal("0.00")
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        """Call callback(event, line) on 'add', 'update', 'remove' and 'clear'"""
+        self._subscribers.append(callback)
+
+    def add(self, medicine_id: int, name: str, price, quantity: int,
+            prescription_item_id: int = None) -> Dict:
+        """Add a line, or more of one; ``prescription_item_id`` marks it as dispensed against a prescription"""
+        line = self.lines.get(medicine_id)
+        if line:
+            if prescription_item_id or line['prescription_item_id']:
+                raise ValueError(f"{line['name']} is already on the bill")
+            return self.set_quantity(medicine_id, line['quantity'] + quantity)
+
+        line = {
+            'medicine_id': medicine_id,
+            'name': name,
+            'price': to_money(price),
+            'quantity': quantity,
+            'prescription_item_id': prescription_item_id
+        }
+        line['total'] = line['price'] * quantity
+        self.lines[medicine_id] = line
+        self.subtotal += line['total']
+        self._notify('add', line)
+        return line
+
+    def set_quantity(self, medicine_id: int, quantity: int) -> Dict:
+        if quantity <= 0:
+            raise ValueError("Quantity must be positive")
+        line = self.lines[medicine_id]
+        new_total = line['price'] * quantity
+        self.subtotal += new_total - line['total']
+        line['quantity'] = quantity
+        line['total'] = new_total
+        self._notify('update', line)
+        return line
+
+    def remove(self, medicine_id: int):
+        line = self.lines.pop(medicine_id, None)
+        if line:
+            self.subtotal -= line['total']
+            self._notify('remove', line)
+
+    def clear(self):
+        self.lines = {}
+        self.subtotal = Decimal("0.00")
+        self._notify('clear', None)
+
+    def quantity_of(self, medicine_id: int) -> int:
+        line = self.lines.get(medicine_id)
+        return line['quantity'] if line else 0
+
+    def items(self) -> List[Dict]:
+        return list(self.lines.values())
+
+    @property
+    def tax(self) -> Decimal:
+        return (self.subtotal * self.TAX_RATE).quantize(CENT, rounding=ROUND_HALF_UP)
+
+    @property
+    def total(self) -> Decimal:
+        return self.subtotal + self.tax
+
+    def __len__(self):
+        return len(self.lines)
+
+    def _notify(self, event, line):
+        for callback in self._subscribers:
+            callback(event, line)
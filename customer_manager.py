@@ -116,7 +116,14 @@ class CustomerManager:
         dialog = CustomerDialog(self.frame, title="Edit Customer", data=customer_data)
         if dialog.result:
             try:
-                Customer.update(customer_id, dialog.result)
+                data = dict(dialog.result)
+                points = data.pop('loyalty_points')
+                Customer.update(customer_id, data)
+                # A changed balance is booked as a ledger adjustment so
+                # points still waiting to be folded are not lost
+                delta = points - Customer.loyalty_balance(customer_id)
+                if delta:
+                    Customer.add_loyalty_points(customer_id, delta)
                 self.load_customers()
                 messagebox.showinfo("Success", "Customer updated successfully")
             except Exception as e:
@@ -205,4 +212,107 @@ class CustomerDialog(tk.Toplevel):
             }
             self.destroy()
         except ValueError:
-            messagebox.showerror("Error", "Please enter valid numeric values for age and loyalty points")
\ No newline at end of file
+            messagebox.showerror("Error", "Please enter valid numeric values for age and loyalty points")
+
+
+class CustomerSelector(ttk.Frame):
+    """Type-ahead customer picker for the counter, backed by Customer.lookup.
+
+    Type part of a phone number, an email or a name; matches are looked up
+    once typing pauses and listed below the entry. Nothing is preloaded.
+    ``on_select(customer)`` is called with the chosen row, or None when the
+    field is cleared.
+    """
+
+    DELAY_MS = 250
+    MIN_CHARS = 2
+
+    def __init__(self, parent, on_select=None, width=40):
+        super().__init__(parent)
+        self.on_select = on_select
+        self.customer = None
+        self.matches = []
+        self._pending = None
+        
+        self.entry = ttk.Entry(self, width=width)
+        self.entry.pack(fill="x")
+        self.listbox = tk.Listbox(self, height=6)
+        
+        self.entry.bind("<KeyRelease>", self.on_key)
+        self.entry.bind("<Down>", self.focus_matches)
+        self.entry.bind("<Return>", lambda event: self.choose(0))
+        self.listbox.bind("<Return>", lambda event: self.choose())
+        self.listbox.bind("<Double-1>", lambda event: self.choose())
+        self.listbox.bind("<Escape>", lambda event: self.hide_matches())
+    
+    @property
+    def customer_id(self):
+        return self.customer['customer_id'] if self.customer else None
+    
+    def typed(self) -> str:
+        """Text in the field when no customer has been chosen from it"""
+        return "" if self.customer else self.entry.get().strip()
+    
+    def on_key(self, event):
+        if event.keysym in ("Return", "Down", "Up", "Tab", "Escape"):
+            return
+        if self.customer:
+            self.customer = None
+            if self.on_select:
+                self.on_select(None)
+        if self._pending:
+            self.after_cancel(self._pending)
+        self._pending = self.after(self.DELAY_MS, self.search)
+    
+    def search(self):
+        self._pending = None
+        term = self.entry.get().strip()
+        if len(term) < self.MIN_CHARS:
+            self.hide_matches()
+            return
+        self.listbox.delete(0, tk.END)
+        try:
+            self.matches = Customer.lookup(term)
+        except Exception as e:
+            self.matches = []
+            self.listbox.insert(tk.END, f"Lookup failed: {str(e)}")
+        for customer in self.matches:
+            self.listbox.insert(tk.END, self.label(customer))
+        if not self.matches and self.listbox.size() == 0:
+            self.listbox.insert(tk.END, "No matching customers")
+        self.listbox.pack(fill="x")
+    
+    @staticmethod
+    def label(customer) -> str:
+        return " - ".join(v for v in (customer['name'], customer['phone'], customer['email']) if v)
+    
+    def focus_matches(self, event=None):
+        if self.matches:
+            self.listbox.focus_set()
+            self.listbox.selection_set(0)
+    
+    def choose(self, index=None):
+        if index is None:
+            selected = self.listbox.curselection()
+            index = selected[0] if selected else None
+        if index is None or index >= len(self.matches):
+            return
+        self.set(self.matches[index])
+        self.entry.focus_set()
+    
+    def set(self, customer):
+        self.customer = customer
+        self.entry.delete(0, tk.END)
+        if customer:
+            self.entry.insert(0, self.label(customer))
+        self.hide_matches()
+        if self.on_select:
+            self.on_select(customer)
+    
+    def clear(self):
+        self.set(None)
+    
+    def hide_matches(self):
+        self.matches = []
+        self.listbox.delete(0, tk.END)
+        self.listbox.pack_forget()
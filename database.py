@@ -1,10 +1,38 @@
+import logging
+import re
 import mysql.connector
-from mysql.connector import pooling
+from mysql.connector import errorcode, pooling
+from contextlib import contextmanager
 from datetime import date, datetime
 from typing import List, Dict, Optional
 
+logger = logging.getLogger(__name__)
+
+class InsufficientStockError(Exception):
+    """Raised when a stock movement would take a medicine below zero"""
+
+    def __init__(self, medicine_ids):
+        self.medicine_ids = list(medicine_ids)
+        super().__init__(f"Insufficient stock for medicine(s): {', '.join(map(str, self.medicine_ids))}")
+
+class PrescriptionError(Exception):
+    """Raised when a line is dispensed against a prescription item that cannot fill it"""
+
+    def __init__(self, problems: Dict[int, str]):
+        self.problems = problems
+        super().__init__("; ".join(f"prescription item {item_id}: {reason}" for item_id, reason in problems.items()))
+
+class DatabaseUnavailableError(Exception):
+    """Raised when no connection to the database can be had (server down, pool exhausted)
+    or the one in use was lost before its transaction finished"""
+
+# Client errors for a connection that dropped after it was handed out
+CONNECTION_LOST = {errorcode.CR_SERVER_GONE_ERROR, errorcode.CR_SERVER_LOST,
+                   errorcode.CR_CONNECTION_ERROR, errorcode.CR_CONN_HOST_ERROR}
+
 class Database:
     __connection_pool = None
+    __commit_hooks = {}
 
     @classmethod
     def initialize_pool(cls):
@@ -19,35 +47,117 @@ class Database:
                 autocommit=False
             )
         except mysql.connector.Error as err:
-            raise Exception(f"Database connection error: {err}")
+            raise DatabaseUnavailableError(f"Database connection error: {err}")
 
     @classmethod
     def get_connection(cls):
         if cls.__connection_pool is None:
             cls.initialize_pool()
-        return cls.__connection_pool.get_connection()
+        try:
+            return cls.__connection_pool.get_connection()
+        except (mysql.connector.errors.PoolError, mysql.connector.errors.InterfaceError,
+                mysql.connector.errors.OperationalError) as err:
+            raise DatabaseUnavailableError(f"Database connection error: {err}")
 
     @classmethod
     def close_connection(cls, connection, cursor=None):
-        if cursor:
-            cursor.close()
-        if connection:
-            connection.close()
+        try:
+            if cursor:
+                cursor.close()
+            if connection:
+                connection.close()
+        except mysql.connector.Error as err:
+            # A dropped connection cannot be closed cleanly; the pool replaces it
+            logger.warning("Could not close database connection: %s", err)
+
+    @staticmethod
+    def connection_lost(err: Exception) -> bool:
+        """Whether err means the server or the connection went away, rather than a problem with the statement"""
+        return (isinstance(err, (mysql.connector.errors.InterfaceError, mysql.connector.errors.OperationalError))
+                or getattr(err, 'errno', None) in CONNECTION_LOST)
 
     @classmethod
-    def execute_query(cls, query: str, params: tuple = None, fetch: bool = False):
-        conn = cls.get_connection()
-        cursor = conn.cursor(dictionary=True)
+    @contextmanager
+    def _lost_is_unavailable(cls):
+        # Checkout journals on DatabaseUnavailableError, and the server may
+        # well be down by the time a statement on a pooled connection fails
+        try:
+            yield
+        except mysql.connector.Error as err:
+            if cls.connection_lost(err):
+                raise DatabaseUnavailableError(f"Database connection lost: {err}") from err
+            raise
+
+    @staticmethod
+    def _rollback(conn):
         try:
-            cursor.execute(query, params or ())
-            if fetch:
-                return cursor.fetchall()
-            conn.commit()
-        except Exception as e:
             conn.rollback()
-            raise e
-        finally:
-            cls.close_connection(conn, cursor)
+        except mysql.connector.Error as err:
+            # The server rolls back on its own when the connection is gone
+            logger.warning("Rollback failed: %s", err)
+
+    @classmethod
+    def execute_query(cls, query: str, params: tuple = None, fetch: bool = False):
+        conn = cls.get_connection()
+        cursor = None
+        with cls._lost_is_unavailable():
+            try:
+                cursor = conn.cursor(dictionary=True)
+                cursor.execute(query, params or ())
+                if fetch:
+                    return cursor.fetchall()
+                conn.commit()
+            except Exception as e:
+                cls._rollback(conn)
+                raise e
+            finally:
+                cls.close_connection(conn, cursor)
+
+    @classmethod
+    @contextmanager
+    def transaction(cls, cursor=None):
+        """Yield a dictionary cursor whose statements commit or roll back together.
+
+        Passing an existing cursor joins the caller's transaction; commit and
+        rollback are then left to whoever opened it.
+        """
+        if cursor is not None:
+            yield cursor
+            return
+
+        conn = cls.get_connection()
+        with cls._lost_is_unavailable():
+            try:
+                cursor = conn.cursor(dictionary=True)
+            except Exception:
+                cls.close_connection(conn)
+                raise
+            cls.__commit_hooks[id(cursor)] = []
+            try:
+                yield cursor
+                conn.commit()
+                hooks = cls.__commit_hooks.get(id(cursor), [])
+            except Exception:
+                cls._rollback(conn)
+                raise
+            finally:
+                cls.__commit_hooks.pop(id(cursor), None)
+                cls.close_connection(conn, cursor)
+
+        for hook in hooks:
+            try:
+                hook()
+            except Exception:
+                logger.exception("Commit hook failed")
+
+    @classmethod
+    def on_commit(cls, cursor, hook):
+        """Run hook once the transaction owning cursor commits (immediately if none)"""
+        hooks = cls.__commit_hooks.get(id(cursor))
+        if hooks is None:
+            hook()
+        else:
+            hooks.append(hook)
 
 class BaseModel:
     @classmethod
@@ -65,17 +175,22 @@ class BaseModel:
         return result[0] if result else None
     
     @classmethod
-    def create(cls, data: Dict) -> int:
+    def create(cls, data: Dict, cursor=None) -> int:
         columns = ', '.join(data.keys())
         placeholders = ', '.join(['%s'] * len(data))
         query = f"INSERT INTO {cls.TABLE} ({columns}) VALUES ({placeholders})"
-        Database.execute_query(query, tuple(data.values()))
-        return Database.execute_query("SELECT LAST_INSERT_ID()", fetch=True)[0]['LAST_INSERT_ID()']
+        with Database.transaction(cursor) as cursor:
+            cursor.execute(query, tuple(data.values()))
+            return cursor.lastrowid
     
     @classmethod
-    def update(cls, id: int, data: Dict) -> bool:
+    def update(cls, id: int, data: Dict, cursor=None) -> bool:
         set_clause = ', '.join([f"{key}=%s" for key in data.keys()])
         query = f"UPDATE {cls.TABLE} SET {set_clause} WHERE {cls.TABLE}_id = %s"
+        if cursor is not None:
+            # Part of the caller's transaction, which has to see a failure to roll back
+            cursor.execute(query, tuple(data.values()) + (id,))
+            return True
         try:
             Database.execute_query(query, tuple(data.values()) + (id,))
             return True
@@ -104,30 +219,517 @@ class Medicine(BaseModel):
             return Database.execute_query(query, (f"%{search_term}%", f"%{search_term}%"), fetch=True)
         return Database.execute_query(query, fetch=True)
     
+    # Columns get_many may project
+    COLUMNS = ("medicine_id", "name", "quantity", "price", "expiry_date", "manufacturer",
+               "batch_number", "category", "active_ingredient", "description", "supplier_id")
+
+    @classmethod
+    def get_many(cls, medicine_ids: List[int],
+                 columns=("medicine_id", "name", "price", "quantity")) -> Dict[int, Dict]:
+        """Resolve many medicines in one IN (...) query, keyed by medicine_id.
+
+        Only the requested columns are read; medicine_id is always included.
+        Ids that do not exist are simply missing from the result.
+        """
+        ids = list(dict.fromkeys(medicine_ids))
+        if not ids:
+            return {}
+        unknown = set(columns) - set(cls.COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown medicine column(s): {', '.join(sorted(unknown))}")
+        columns = ["medicine_id"] + [c for c in columns if c != "medicine_id"]
+        rows = Database.execute_query(
+            f"""SELECT {', '.join(columns)} FROM {cls.TABLE}
+               WHERE medicine_id IN ({', '.join(['%s'] * len(ids))})""",
+            tuple(ids), fetch=True
+        )
+        return {row['medicine_id']: row for row in rows}
+
+    @classmethod
+    def classified_since(cls, since: datetime = None, after_id: int = 0) -> List[Dict]:
+        """Ingredient and category of medicines added after ``after_id`` or updated at or after ``since``"""
+        query = f"SELECT medicine_id, name, active_ingredient, category, updated_at FROM {cls.TABLE}"
+        if since is None:
+            return Database.execute_query(query, fetch=True)
+        return Database.execute_query(query + " WHERE medicine_id > %s OR updated_at >= %s",
+                                      (after_id, since), fetch=True)
+
     @classmethod
-    def reduce_stock(cls, medicine_id: int, quantity: int) -> bool:
-        query = f"UPDATE {cls.TABLE} SET quantity = quantity - %s WHERE medicine_id = %s AND quantity >= %s"
+    def reduce_stock(cls, medicine_id: int, quantity: int,
+                     movement_type: str = "order", reference_id: int = None) -> bool:
         try:
-            Database.execute_query(query, (quantity, medicine_id, quantity))
+            MedicineLot.take({medicine_id: quantity}, movement_type, reference_id)
             return True
         except:
             return False
 
+class MedicinePrice(BaseModel):
+    """Price history of each medicine as effective_from/effective_to ranges.
+
+    The open row (effective_to NULL) always matches ``medicines.price``; a
+    change closes it and opens a new one. Point-in-time lookups and
+    reporting read the ``medicine_effective`` index instead of scanning.
+    """
+    TABLE = "medicine_prices"
+
+    # Rows per statement when repricing from a list
+    REPRICE_CHUNK = 1000
+
+    @classmethod
+    def set_price(cls, medicine_id: int, price, effective_from: datetime = None, cursor=None) -> bool:
+        """Change a medicine's price; returns False if it already had that price"""
+        effective_from = effective_from or datetime.now()
+        with Database.transaction(cursor) as cursor:
+            cursor.execute("SELECT price FROM medicines WHERE medicine_id = %s FOR UPDATE", (medicine_id,))
+            row = cursor.fetchone()
+            if not row:
+                raise ValueError("Medicine not found")
+            if round(float(row['price']), 2) == round(float(price), 2):
+                return False
+            cursor.execute(
+                f"UPDATE {cls.TABLE} SET effective_to = %s WHERE medicine_id = %s AND effective_to IS NULL",
+                (effective_from, medicine_id)
+            )
+            cursor.execute(
+                f"INSERT INTO {cls.TABLE} (medicine_id, price, effective_from) VALUES (%s, %s, %s)",
+                (medicine_id, price, effective_from)
+            )
+            cursor.execute("UPDATE medicines SET price = %s WHERE medicine_id = %s", (price, medicine_id))
+            return True
+
+    @classmethod
+    def open_history(cls, medicine_id: int, price, effective_from: datetime = None, cursor=None) -> None:
+        """First price row of a newly created medicine"""
+        with Database.transaction(cursor) as cursor:
+            cursor.execute(
+                f"INSERT INTO {cls.TABLE} (medicine_id, price, effective_from) VALUES (%s, %s, %s)",
+                (medicine_id, price, effective_from or datetime.now())
+            )
+
+    @classmethod
+    def price_at(cls, medicine_id: int, at: datetime) -> Optional[float]:
+        rows = Database.execute_query(
+            f"""SELECT price FROM {cls.TABLE}
+               WHERE medicine_id = %s AND effective_from <= %s
+               ORDER BY effective_from DESC LIMIT 1""",
+            (medicine_id, at), fetch=True
+        )
+        return rows[0]['price'] if rows else None
+
+    @classmethod
+    def prices_at(cls, medicine_ids: List[int], at: datetime) -> Dict[int, float]:
+        """Price of each medicine in effect at a point in time"""
+        if not medicine_ids:
+            return {}
+        rows = Database.execute_query(
+            f"""SELECT medicine_id, price FROM {cls.TABLE}
+               WHERE medicine_id IN ({', '.join(['%s'] * len(medicine_ids))})
+                 AND effective_from <= %s AND (effective_to IS NULL OR effective_to > %s)""",
+            tuple(medicine_ids) + (at, at), fetch=True
+        )
+        return {row['medicine_id']: row['price'] for row in rows}
+
+    @classmethod
+    def history(cls, medicine_id: int) -> List[Dict]:
+        return Database.execute_query(
+            f"SELECT * FROM {cls.TABLE} WHERE medicine_id = %s ORDER BY effective_from",
+            (medicine_id,), fetch=True
+        )
+
+    @classmethod
+    def reprice_percent(cls, percent: float, medicine_ids: List[int] = None, category: str = None,
+                        effective_from: datetime = None) -> int:
+        """Raise (or, if negative, cut) prices by percent for the chosen medicines; returns how many changed.
+
+        Without medicine_ids or category every medicine is repriced. Each of
+        the three steps is one set-based statement whatever the catalog size.
+        """
+        effective_from = effective_from or datetime.now()
+        conditions, params = [], []
+        if medicine_ids:
+            conditions.append(f"medicine_id IN ({', '.join(['%s'] * len(medicine_ids))})")
+            params.extend(medicine_ids)
+        if category:
+            conditions.append("category = %s")
+            params.append(category)
+        where = " AND ".join(conditions) or "1 = 1"
+        factor = 1 + percent / 100
+
+        with Database.transaction() as cursor:
+            cursor.execute(
+                f"""UPDATE {cls.TABLE} SET effective_to = %s
+                   WHERE effective_to IS NULL AND medicine_id IN (
+                       SELECT medicine_id FROM medicines WHERE {where})""",
+                (effective_from, *params)
+            )
+            cursor.execute(
+                f"""INSERT INTO {cls.TABLE} (medicine_id, price, effective_from)
+                   SELECT medicine_id, ROUND(price * %s, 2), %s FROM medicines WHERE {where}""",
+                (factor, effective_from, *params)
+            )
+            cursor.execute(
+                f"UPDATE medicines SET price = ROUND(price * %s, 2) WHERE {where}",
+                (factor, *params)
+            )
+            return cursor.rowcount
+
+    @classmethod
+    def reprice_list(cls, prices: Dict[int, float], effective_from: datetime = None) -> int:
+        """Apply a {medicine_id: new price} list; returns how many medicines changed.
+
+        The list is joined in as a derived table, REPRICE_CHUNK rows per
+        statement, and medicines whose price is unchanged are left alone.
+        """
+        effective_from = effective_from or datetime.now()
+        items = list(prices.items())
+        changed = 0
+        with Database.transaction() as cursor:
+            for start in range(0, len(items), cls.REPRICE_CHUNK):
+                chunk = items[start:start + cls.REPRICE_CHUNK]
+                new_prices = " UNION ALL ".join(["SELECT %s AS medicine_id, %s AS price"] * len(chunk))
+                params = tuple(v for pair in chunk for v in pair)
+                cursor.execute(
+                    f"""UPDATE {cls.TABLE} mp
+                       JOIN ({new_prices}) np ON np.medicine_id = mp.medicine_id
+                       JOIN medicines m ON m.medicine_id = mp.medicine_id
+                       SET mp.effective_to = %s
+                       WHERE mp.effective_to IS NULL AND m.price <> np.price""",
+                    params + (effective_from,)
+                )
+                cursor.execute(
+                    f"""INSERT INTO {cls.TABLE} (medicine_id, price, effective_from)
+                       SELECT np.medicine_id, np.price, %s
+                       FROM ({new_prices}) np JOIN medicines m ON m.medicine_id = np.medicine_id
+                       WHERE m.price <> np.price""",
+                    (effective_from,) + params
+                )
+                cursor.execute(
+                    f"""UPDATE medicines m JOIN ({new_prices}) np ON np.medicine_id = m.medicine_id
+                       SET m.price = np.price WHERE m.price <> np.price""",
+                    params
+                )
+                changed += cursor.rowcount
+        return changed
+
+    @classmethod
+    def revenue_comparison(cls, start: datetime, end: datetime) -> List[Dict]:
+        """Per medicine: revenue sold in [start, end) at the prices charged vs at current prices"""
+        return Database.execute_query(
+            """SELECT si.medicine_id, m.name, SUM(si.quantity) AS quantity,
+                      SUM(si.total_price) AS historical_revenue,
+                      SUM(si.quantity) * m.price AS current_revenue
+               FROM sales s
+               JOIN sale_items si ON si.sale_id = s.sale_id
+               JOIN medicines m ON m.medicine_id = si.medicine_id
+               WHERE s.sale_date >= %s AND s.sale_date < %s
+               GROUP BY si.medicine_id, m.name, m.price
+               ORDER BY historical_revenue DESC""",
+            (start, end), fetch=True
+        )
+
+class MedicineBarcode(BaseModel):
+    """GTIN/barcodes of a medicine; a medicine can have several, a code belongs to one"""
+    TABLE = "medicine_barcodes"
+
+    @classmethod
+    def add(cls, medicine_id: int, barcode: str) -> None:
+        Database.execute_query(
+            f"INSERT INTO {cls.TABLE} (barcode, medicine_id) VALUES (%s, %s)",
+            (barcode, medicine_id)
+        )
+
+    @classmethod
+    def remove(cls, barcode: str) -> None:
+        Database.execute_query(f"DELETE FROM {cls.TABLE} WHERE barcode = %s", (barcode,))
+
+    @classmethod
+    def for_medicine(cls, medicine_id: int) -> List[str]:
+        rows = Database.execute_query(
+            f"SELECT barcode FROM {cls.TABLE} WHERE medicine_id = %s ORDER BY barcode",
+            (medicine_id,), fetch=True
+        )
+        return [row['barcode'] for row in rows]
+
+    @classmethod
+    def get_index_rows(cls) -> List[Dict]:
+        """Every barcode with what a scan needs to add a bill line"""
+        return Database.execute_query(
+            f"""SELECT b.barcode, m.medicine_id, m.name, m.price
+               FROM {cls.TABLE} b JOIN medicines m ON m.medicine_id = b.medicine_id""",
+            fetch=True
+        )
+
+class InteractionRule(BaseModel):
+    TABLE = "interaction_rules"
+
+    INGREDIENT = "ingredient"
+    CATEGORY = "category"
+    SEVERITIES = ("minor", "moderate", "major")
+
+    @classmethod
+    def add(cls, left: tuple, right: tuple, severity: str = "moderate", description: str = None) -> None:
+        """Store (or re-activate) the rule that ``left`` and ``right`` interact.
+
+        Both sides are (type, value), e.g. ('ingredient', 'warfarin') or
+        ('category', 'nsaid'); values are compared case-insensitively.
+        """
+        if severity not in cls.SEVERITIES:
+            raise ValueError(f"Unknown severity: {severity}")
+        left, right = sorted([(left[0], left[1].strip().lower()), (right[0], right[1].strip().lower())])
+        Database.execute_query(
+            f"""INSERT INTO {cls.TABLE} (left_type, left_value, right_type, right_value, severity, description)
+               VALUES (%s, %s, %s, %s, %s, %s)
+               ON DUPLICATE KEY UPDATE severity = VALUES(severity), description = VALUES(description), active = 1""",
+            left + right + (severity, description)
+        )
+
+    @classmethod
+    def deactivate(cls, rule_id: int) -> None:
+        Database.execute_query(f"UPDATE {cls.TABLE} SET active = 0 WHERE rule_id = %s", (rule_id,))
+
+    @classmethod
+    def changed_since(cls, since: datetime = None) -> List[Dict]:
+        """All rules, or those added, edited or switched off at or after ``since``"""
+        query = f"SELECT * FROM {cls.TABLE}"
+        if since is None:
+            return Database.execute_query(query + " WHERE active = 1", fetch=True)
+        return Database.execute_query(query + " WHERE updated_at >= %s", (since,), fetch=True)
+
 class Supplier(BaseModel):
     TABLE = "suppliers"
 
 class Customer(BaseModel):
     TABLE = "customers"
-    
+
+    # The one loyalty formula, for sales and orders alike
+    POINTS_PER_DOLLAR = 1
+
+    @classmethod
+    def points_for(cls, amount) -> int:
+        return int(amount * cls.POINTS_PER_DOLLAR)
+
+    # Most matches Customer.lookup returns
+    LOOKUP_LIMIT = 20
+
+    @staticmethod
+    def normalize_phone(phone: str) -> Optional[str]:
+        """Just the digits, so '(555) 123-4567' and '555.123.4567' index alike"""
+        digits = re.sub(r"\D", "", phone or "")
+        return digits or None
+
+    @staticmethod
+    def name_tokens(name: str) -> List[str]:
+        return list(dict.fromkeys(token[:50] for token in re.findall(r"\w+", (name or "").lower())))
+
+    @staticmethod
+    def like_prefix(text: str) -> str:
+        """LIKE pattern matching values that start with ``text``, its % and _ taken literally"""
+        return re.sub(r"([\\%_])", r"\\\1", text) + "%"
+
     @classmethod
-    def add_loyalty_points(cls, customer_id: int, points: int) -> bool:
-        query = f"UPDATE {cls.TABLE} SET loyalty_points = loyalty_points + %s WHERE customer_id = %s"
+    def create(cls, data: Dict) -> int:
+        """Insert a customer along with its normalized phone and name tokens"""
+        data = dict(data, phone_digits=cls.normalize_phone(data.get('phone')))
+        with Database.transaction() as cursor:
+            cursor.execute(
+                f"INSERT INTO {cls.TABLE} ({', '.join(data)}) VALUES ({', '.join(['%s'] * len(data))})",
+                tuple(data.values())
+            )
+            customer_id = cursor.lastrowid
+            cls.index_name(customer_id, data['name'], cursor)
+        return customer_id
+
+    @classmethod
+    def update(cls, id: int, data: Dict) -> bool:
+        data = dict(data)
+        if 'phone' in data:
+            data['phone_digits'] = cls.normalize_phone(data['phone'])
         try:
-            Database.execute_query(query, (points, customer_id))
+            with Database.transaction() as cursor:
+                cursor.execute(
+                    f"UPDATE {cls.TABLE} SET {', '.join(f'{key} = %s' for key in data)} WHERE customer_id = %s",
+                    tuple(data.values()) + (id,)
+                )
+                if 'name' in data:
+                    cls.index_name(id, data['name'], cursor)
             return True
         except:
             return False
 
+    @classmethod
+    def index_name(cls, customer_id: int, name: str, cursor=None) -> None:
+        """Replace the customer's rows in customer_name_tokens"""
+        tokens = cls.name_tokens(name)
+        with Database.transaction(cursor) as cursor:
+            cursor.execute("DELETE FROM customer_name_tokens WHERE customer_id = %s", (customer_id,))
+            if tokens:
+                cursor.execute(
+                    f"""INSERT INTO customer_name_tokens (token, sound, customer_id)
+                       VALUES {', '.join(['(%s, SOUNDEX(%s), %s)'] * len(tokens))}""",
+                    tuple(v for token in tokens for v in (token, token, customer_id))
+                )
+
+    @classmethod
+    def lookup(cls, term: str, limit: int = None) -> List[Dict]:
+        """Customers matching what was typed at the counter, each read through an index.
+
+        Digits (with any punctuation) match the start of the phone number,
+        anything with an @ the start of the email, and words the start of
+        words in the name, every word having to match. When no name starts
+        that way, words are matched by how they sound instead, so 'jon smyth'
+        still finds John Smith.
+        """
+        term = (term or "").strip()
+        limit = limit or cls.LOOKUP_LIMIT
+        columns = "c.customer_id, c.name, c.phone, c.email"
+        if not term:
+            return []
+
+        digits = cls.normalize_phone(term)
+        if digits and not re.search(r"[^\d\s()+.\-]", term):
+            return Database.execute_query(
+                f"""SELECT {columns} FROM {cls.TABLE} c WHERE c.phone_digits LIKE %s
+                   ORDER BY c.phone_digits LIMIT %s""",
+                (digits + "%", limit), fetch=True
+            )
+        if "@" in term:
+            return Database.execute_query(
+                f"SELECT {columns} FROM {cls.TABLE} c WHERE c.email LIKE %s ORDER BY c.email LIMIT %s",
+                (cls.like_prefix(term.lower()), limit), fetch=True
+            )
+
+        words = cls.name_tokens(term)[:3]
+        if not words:
+            return []
+        return (cls._lookup_by_words(columns, "token LIKE %s", [cls.like_prefix(word) for word in words], limit)
+                or cls._lookup_by_words(columns, "sound = SOUNDEX(%s)", words, limit))
+
+    @classmethod
+    def _lookup_by_words(cls, columns: str, match: str, values: List[str], limit: int) -> List[Dict]:
+        """Customers with a name token satisfying ``match`` for every value"""
+        joins = " ".join(
+            f"JOIN customer_name_tokens t{i} ON t{i}.customer_id = c.customer_id AND t{i}.{match}"
+            for i in range(len(values))
+        )
+        return Database.execute_query(
+            f"SELECT DISTINCT {columns} FROM {cls.TABLE} c {joins} ORDER BY c.name LIMIT %s",
+            tuple(values) + (limit,), fetch=True
+        )
+
+    @classmethod
+    def get_all(cls, search_term: str = None) -> List[Dict]:
+        """Customers with loyalty_points as their full balance, folded plus pending"""
+        customers = super().get_all(search_term)
+        pending = LoyaltyLedger.pending([c['customer_id'] for c in customers])
+        for customer in customers:
+            customer['loyalty_points'] = (customer['loyalty_points'] or 0) + pending.get(customer['customer_id'], 0)
+        return customers
+
+    @classmethod
+    def add_loyalty_points(cls, customer_id: int, points: int, cursor=None,
+                           source: str = "adjustment", reference_id: int = None) -> bool:
+        """Record points in the loyalty ledger; they reach customers.loyalty_points when folded"""
+        if cursor is not None:
+            LoyaltyLedger.accrue(customer_id, points, source, reference_id, cursor=cursor)
+            return True
+        try:
+            LoyaltyLedger.accrue(customer_id, points, source, reference_id)
+            return True
+        except:
+            return False
+
+    @classmethod
+    def loyalty_balance(cls, customer_id: int) -> int:
+        return LoyaltyLedger.balance(customer_id)
+
+class LoyaltyLedger(BaseModel):
+    """Append-only loyalty point entries, folded into customers in batches.
+
+    Checkout only inserts a ledger row, so busy customers' rows are not
+    locked by every purchase. ``fold`` marks the pending entries with a batch
+    id and adds each customer's sum to ``customers.loyalty_points`` in one
+    set-based UPDATE; a balance is the folded value plus the pending tail.
+    """
+    TABLE = "loyalty_ledger"
+
+    SALE = "sale"
+    ORDER = "order"
+    ADJUSTMENT = "adjustment"
+
+    @classmethod
+    def accrue(cls, customer_id: int, points: int, source: str = ADJUSTMENT,
+               reference_id: int = None, cursor=None) -> None:
+        if not points:
+            return
+        with Database.transaction(cursor) as cursor:
+            cursor.execute(
+                f"""INSERT INTO {cls.TABLE} (customer_id, points, source, reference_id)
+                   VALUES (%s, %s, %s, %s)""",
+                (customer_id, points, source, reference_id)
+            )
+
+    @classmethod
+    def pending(cls, customer_ids: List[int]) -> Dict[int, int]:
+        """Unfolded points per customer"""
+        if not customer_ids:
+            return {}
+        rows = Database.execute_query(
+            f"""SELECT customer_id, SUM(points) AS points FROM {cls.TABLE}
+               WHERE customer_id IN ({', '.join(['%s'] * len(customer_ids))}) AND fold_batch IS NULL
+               GROUP BY customer_id""",
+            tuple(customer_ids), fetch=True
+        )
+        return {row['customer_id']: int(row['points']) for row in rows}
+
+    @classmethod
+    def balance(cls, customer_id: int) -> int:
+        rows = Database.execute_query(
+            f"""SELECT c.loyalty_points + COALESCE(
+                      (SELECT SUM(points) FROM {cls.TABLE}
+                       WHERE customer_id = c.customer_id AND fold_batch IS NULL), 0) AS balance
+               FROM customers c WHERE c.customer_id = %s""",
+            (customer_id,), fetch=True
+        )
+        return int(rows[0]['balance']) if rows else 0
+
+    @classmethod
+    def history(cls, customer_id: int) -> List[Dict]:
+        return Database.execute_query(
+            f"SELECT * FROM {cls.TABLE} WHERE customer_id = %s ORDER BY entry_id",
+            (customer_id,), fetch=True
+        )
+
+    @classmethod
+    def fold(cls, batch_size: int = 10000) -> int:
+        """Fold up to batch_size pending entries into customers; returns how many were folded"""
+        with Database.transaction() as cursor:
+            cursor.execute(
+                f"""SELECT MAX(entry_id) AS high FROM (
+                       SELECT entry_id FROM {cls.TABLE} WHERE fold_batch IS NULL
+                       ORDER BY entry_id LIMIT %s) pending""",
+                (batch_size,)
+            )
+            high = cursor.fetchone()['high']
+            if high is None:
+                return 0
+
+            # The batch is named after its highest entry so it is unique
+            # without a sequence table
+            cursor.execute(
+                f"UPDATE {cls.TABLE} SET fold_batch = %s WHERE fold_batch IS NULL AND entry_id <= %s",
+                (high, high)
+            )
+            folded = cursor.rowcount
+            cursor.execute(
+                f"""UPDATE customers c
+                   JOIN (SELECT customer_id, SUM(points) AS points FROM {cls.TABLE}
+                         WHERE fold_batch = %s GROUP BY customer_id) batch
+                     ON batch.customer_id = c.customer_id
+                   SET c.loyalty_points = c.loyalty_points + batch.points""",
+                (high,)
+            )
+            return folded
+
 class Employee(BaseModel):
     TABLE = "employees"
 
@@ -143,61 +745,951 @@ class Prescription(BaseModel):
             return Database.execute_query(query, (f"%{search_term}%", f"%{search_term}%"), fetch=True)
         return Database.execute_query(query, fetch=True)
 
+    @classmethod
+    def page(cls, customer_id: int = None, doctor: str = None, start: date = None, end: date = None,
+             after: tuple = None, limit: int = 50) -> tuple:
+        """One page of prescriptions, newest first, with item counts, and the cursor for the next page.
+
+        Works like Order.history: ``after`` is the (issue_date,
+        prescription_id) of the last row of the previous page. ``doctor``
+        matches the start of the doctor's name. Items are counted with one
+        grouped query over the page's ids rather than a subquery per row.
+        """
+        conditions, params = [], []
+        if customer_id is not None:
+            conditions.append("p.customer_id = %s")
+            params.append(customer_id)
+        if doctor:
+            conditions.append("p.doctor_name LIKE %s")
+            params.append(f"{doctor}%")
+        if start:
+            conditions.append("p.issue_date >= %s")
+            params.append(start)
+        if end:
+            conditions.append("p.issue_date < %s")
+            params.append(end)
+        if after:
+            conditions.append("(p.issue_date < %s OR (p.issue_date = %s AND p.prescription_id < %s))")
+            params.extend([after[0], after[0], after[1]])
+
+        query = f"""SELECT p.*, c.name AS customer_name
+                   FROM {cls.TABLE} p JOIN customers c ON c.customer_id = p.customer_id"""
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY p.issue_date DESC, p.prescription_id DESC LIMIT %s"
+        rows = Database.execute_query(query, tuple(params) + (limit + 1,), fetch=True)
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = (rows[-1]['issue_date'], rows[-1]['prescription_id'])
+
+        counts = cls.item_counts([row['prescription_id'] for row in rows])
+        for row in rows:
+            row['item_count'] = counts.get(row['prescription_id'], 0)
+        return rows, next_cursor
+
+    @classmethod
+    def item_counts(cls, prescription_ids: List[int]) -> Dict[int, int]:
+        """Item count per prescription, read from the prescription_id index"""
+        if not prescription_ids:
+            return {}
+        rows = Database.execute_query(
+            f"""SELECT prescription_id, COUNT(*) AS item_count FROM prescription_items
+               WHERE prescription_id IN ({', '.join(['%s'] * len(prescription_ids))})
+               GROUP BY prescription_id""",
+            tuple(prescription_ids), fetch=True
+        )
+        return {row['prescription_id']: row['item_count'] for row in rows}
+
+    # Fields of a prescription line the dialog edits
+    ITEM_FIELDS = ("medicine_id", "quantity", "dosage", "instructions", "refills")
+
+    @classmethod
+    def get_items(cls, prescription_id: int, cursor=None, lock: bool = False) -> List[Dict]:
+        with Database.transaction(cursor) as cursor:
+            cursor.execute(
+                f"""SELECT item_id, {', '.join(cls.ITEM_FIELDS)}, fills_remaining FROM prescription_items
+                   WHERE prescription_id = %s ORDER BY item_id""" + (" FOR UPDATE" if lock else ""),
+                (prescription_id,)
+            )
+            return cursor.fetchall()
+
+    @classmethod
+    def create_with_items(cls, data: Dict, items: List[Dict], cursor=None) -> int:
+        """Write a prescription and all its lines in one transaction; returns the prescription_id"""
+        with Database.transaction(cursor) as cursor:
+            cursor.execute(
+                f"INSERT INTO {cls.TABLE} ({', '.join(data)}) VALUES ({', '.join(['%s'] * len(data))})",
+                tuple(data.values())
+            )
+            prescription_id = cursor.lastrowid
+            cls._insert_items(cursor, prescription_id, items)
+        return prescription_id
+
+    @classmethod
+    def replace_items(cls, prescription_id: int, items: List[Dict], data: Dict = None,
+                      cursor=None) -> Dict[str, int]:
+        """Make a prescription's lines match ``items`` by applying only the difference.
+
+        Lines that carry the ``item_id`` they were read with are matched on
+        it; the rest are matched to an unclaimed existing line for the same
+        medicine. Matched lines are updated only if something changed, so
+        kept lines keep their item_id, and a change of refills moves
+        fills_remaining by the same amount. Updates go out as one joined UPDATE,
+        new lines as one multi-row INSERT and dropped lines as one DELETE,
+        in a single transaction together with the header ``data`` if given.
+        Returns how many lines were inserted, updated and deleted.
+        """
+        with Database.transaction(cursor) as cursor:
+            if data:
+                cursor.execute(
+                    f"UPDATE {cls.TABLE} SET {', '.join(f'{key} = %s' for key in data)} WHERE prescription_id = %s",
+                    tuple(data.values()) + (prescription_id,)
+                )
+            existing = {row['item_id']: row for row in cls.get_items(prescription_id, cursor, lock=True)}
+            unclaimed = dict(existing)
+
+            matched, inserts = [], []
+            for item in items:
+                if item.get('item_id') in unclaimed:
+                    matched.append((unclaimed.pop(item['item_id']), item))
+            for item in items:
+                if item.get('item_id') in existing:
+                    continue
+                old = next((row for row in unclaimed.values() if row['medicine_id'] == item['medicine_id']), None)
+                if old:
+                    matched.append((unclaimed.pop(old['item_id']), item))
+                else:
+                    inserts.append(item)
+
+            updates = [(old, item) for old, item in matched
+                       if any(old[field] != item.get(field) for field in cls.ITEM_FIELDS)]
+            if updates:
+                new_values = " UNION ALL ".join(
+                    ["SELECT %s AS item_id, %s AS medicine_id, %s AS quantity, %s AS dosage, "
+                     "%s AS instructions, %s AS refills, %s AS old_refills"] * len(updates)
+                )
+                # MySQL does not promise the order of a multi-table SET, so the
+                # old refill count comes from the locked rows read above
+                cursor.execute(
+                    f"""UPDATE prescription_items pi JOIN ({new_values}) nv ON nv.item_id = pi.item_id
+                       SET pi.medicine_id = nv.medicine_id, pi.quantity = nv.quantity,
+                           pi.dosage = nv.dosage, pi.instructions = nv.instructions,
+                           pi.fills_remaining = GREATEST(pi.fills_remaining + nv.refills - nv.old_refills, 0),
+                           pi.refills = nv.refills""",
+                    tuple(v for old, item in updates
+                          for v in (old['item_id'],) + tuple(item.get(field) for field in cls.ITEM_FIELDS)
+                          + (old['refills'],))
+                )
+            if unclaimed:
+                cursor.execute(
+                    f"DELETE FROM prescription_items WHERE item_id IN ({', '.join(['%s'] * len(unclaimed))})",
+                    tuple(unclaimed)
+                )
+            cls._insert_items(cursor, prescription_id, inserts)
+        return {'inserted': len(inserts), 'updated': len(updates), 'deleted': len(unclaimed)}
+
+    @classmethod
+    def _insert_items(cls, cursor, prescription_id: int, items: List[Dict]):
+        if not items:
+            return
+        cursor.execute(
+            f"""INSERT INTO prescription_items (prescription_id, {', '.join(cls.ITEM_FIELDS)}, fills_remaining)
+               VALUES {', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * len(items))}""",
+            tuple(v for item in items
+                  for v in (prescription_id,) + tuple(item.get(field) for field in cls.ITEM_FIELDS)
+                  + ((item.get('refills') or 0) + 1,))
+        )
+
+    @classmethod
+    def active_for(cls, customer_id: int, on: date = None) -> List[Dict]:
+        """A customer's unexpired prescription lines with fills left, soonest expiry first.
+
+        Served by the (customer_id, expiry_date) index; prescriptions
+        without an expiry date count as open.
+        """
+        return Database.execute_query(
+            f"""SELECT p.prescription_id, p.doctor_name, p.issue_date, p.expiry_date,
+                      pi.item_id, pi.medicine_id, m.name, m.price, pi.quantity, pi.dosage, pi.instructions,
+                      pi.refills, pi.fills_remaining
+               FROM {cls.TABLE} p
+               JOIN prescription_items pi ON pi.prescription_id = p.prescription_id
+               JOIN medicines m ON m.medicine_id = pi.medicine_id
+               WHERE p.customer_id = %s AND (p.expiry_date IS NULL OR p.expiry_date >= %s)
+                 AND pi.fills_remaining > 0
+               ORDER BY p.expiry_date IS NULL, p.expiry_date, p.prescription_id, pi.item_id""",
+            (customer_id, on or date.today()), fetch=True
+        )
+
+    @classmethod
+    def dispense(cls, lines: List[Dict], customer_id: int, cursor) -> None:
+        """Use up one fill of each prescription item the ``lines`` are dispensed against.
+
+        Runs inside the checkout's transaction: the items are locked, every
+        line is checked (same customer, same medicine, not more than
+        prescribed, not expired, a fill left) and then all fills are taken
+        with one UPDATE. Raises PrescriptionError naming every line that
+        cannot be filled, which rolls the checkout back.
+        """
+        lines = [line for line in lines if line.get('prescription_item_id')]
+        if not lines:
+            return
+        ids = list(dict.fromkeys(line['prescription_item_id'] for line in lines))
+        cursor.execute(
+            f"""SELECT pi.item_id, pi.medicine_id, pi.quantity, pi.fills_remaining, p.customer_id, p.expiry_date
+               FROM prescription_items pi JOIN {cls.TABLE} p ON p.prescription_id = pi.prescription_id
+               WHERE pi.item_id IN ({', '.join(['%s'] * len(ids))})
+               FOR UPDATE""",
+            tuple(ids)
+        )
+        items = {row['item_id']: row for row in cursor.fetchall()}
+
+        problems, seen = {}, set()
+        for line in lines:
+            item_id = line['prescription_item_id']
+            item = items.get(item_id)
+            if item_id in seen:
+                problems[item_id] = "dispensed twice on one bill"
+            elif not item:
+                problems[item_id] = "not found"
+            elif customer_id is None:
+                problems[item_id] = "no customer on the bill"
+            elif item['customer_id'] != customer_id:
+                problems[item_id] = "written for another customer"
+            elif item['medicine_id'] != line['medicine_id']:
+                problems[item_id] = "prescribes a different medicine"
+            elif line['quantity'] > item['quantity']:
+                problems[item_id] = f"only {item['quantity']} prescribed"
+            elif item['expiry_date'] and item['expiry_date'] < date.today():
+                problems[item_id] = "prescription expired"
+            elif item['fills_remaining'] <= 0:
+                problems[item_id] = "no refills left"
+            seen.add(item_id)
+        if problems:
+            raise PrescriptionError(problems)
+
+        cursor.execute(
+            f"""UPDATE prescription_items SET fills_remaining = fills_remaining - 1
+               WHERE item_id IN ({', '.join(['%s'] * len(ids))})""",
+            tuple(ids)
+        )
+
 class Order(BaseModel):
     TABLE = "orders"
+
+    # order_items rows per INSERT statement
+    ITEM_CHUNK = 500
     
     @classmethod
-    def create_with_details(cls, order_data: Dict, items: List[Dict]) -> int:
-        conn = Database.get_connection()
-        cursor = conn.cursor()
-        try:
+    def find_by_key(cls, idempotency_key: str, cursor=None, lock: bool = False) -> Optional[int]:
+        """order_id already written under idempotency_key, if any (one unique index probe)"""
+        with Database.transaction(cursor) as cursor:
+            cursor.execute(
+                f"SELECT order_id FROM {cls.TABLE} WHERE idempotency_key = %s"
+                + (" LOCK IN SHARE MODE" if lock else ""),
+                (idempotency_key,)
+            )
+            row = cursor.fetchone()
+            return row['order_id'] if row else None
+
+    @classmethod
+    def find_by_keys(cls, idempotency_keys: List[str]) -> Dict[str, int]:
+        """{idempotency_key: order_id} for the keys already used, in one query"""
+        if not idempotency_keys:
+            return {}
+        rows = Database.execute_query(
+            f"""SELECT idempotency_key, order_id FROM {cls.TABLE}
+               WHERE idempotency_key IN ({', '.join(['%s'] * len(idempotency_keys))})""",
+            tuple(idempotency_keys), fetch=True
+        )
+        return {row['idempotency_key']: row['order_id'] for row in rows}
+
+    @classmethod
+    def add_items(cls, order_id: int, items: List[Dict], cursor=None) -> List[int]:
+        """Insert order lines with multi-row INSERTs of ITEM_CHUNK rows; returns their item_ids.
+
+        The ids are read back rather than counted on from the first id each
+        INSERT reports, which is wrong under auto_increment_increment > 1
+        (multi-primary setups). Ids still rise in row order, so the lines of
+        this order from the first reported id on are these items, in order.
+        """
+        if not items:
+            return []
+        first_id = None
+        with Database.transaction(cursor) as cursor:
+            for start in range(0, len(items), cls.ITEM_CHUNK):
+                chunk = items[start:start + cls.ITEM_CHUNK]
+                cursor.execute(
+                    f"""INSERT INTO order_items
+                       (order_id, medicine_id, quantity, unit_price, subtotal, prescription_item_id)
+                       VALUES {', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(chunk))}""",
+                    tuple(v for item in chunk
+                          for v in (order_id, item['medicine_id'], item['quantity'], item['price'], item['subtotal'],
+                                    item.get('prescription_item_id')))
+                )
+                if first_id is None:
+                    first_id = cursor.lastrowid
+            cursor.execute(
+                "SELECT item_id FROM order_items WHERE order_id = %s AND item_id >= %s ORDER BY item_id",
+                (order_id, first_id)
+            )
+            return [row['item_id'] for row in cursor.fetchall()]
+
+    @classmethod
+    def item_ids(cls, order_id: int, cursor=None) -> List[int]:
+        with Database.transaction(cursor) as cursor:
+            cursor.execute("SELECT item_id FROM order_items WHERE order_id = %s ORDER BY item_id", (order_id,))
+            return [row['item_id'] for row in cursor.fetchall()]
+
+    @classmethod
+    def history(cls, customer_id: int = None, employee_id: int = None, order_type: str = None,
+                start: datetime = None, end: datetime = None, after: tuple = None,
+                limit: int = 50) -> tuple:
+        """One page of orders, newest first, and the cursor for the next page.
+
+        ``after`` is the (order_date, order_id) of the last row of the
+        previous page (the returned cursor), so every page is an index range
+        read whatever its depth. The next cursor is None on the last page.
+        """
+        conditions, params = [], []
+        for column, value in (("o.customer_id", customer_id), ("o.employee_id", employee_id),
+                              ("o.order_type", order_type)):
+            if value is not None:
+                conditions.append(f"{column} = %s")
+                params.append(value)
+        if start:
+            conditions.append("o.order_date >= %s")
+            params.append(start)
+        if end:
+            conditions.append("o.order_date < %s")
+            params.append(end)
+        if after:
+            conditions.append("(o.order_date < %s OR (o.order_date = %s AND o.order_id < %s))")
+            params.extend([after[0], after[0], after[1]])
+
+        query = f"""SELECT o.order_id, o.order_date, o.order_type, o.total_amount,
+                          o.customer_id, c.name AS customer_name, e.name AS employee_name
+                   FROM {cls.TABLE} o
+                   LEFT JOIN customers c ON c.customer_id = o.customer_id
+                   LEFT JOIN employees e ON e.employee_id = o.employee_id"""
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY o.order_date DESC, o.order_id DESC LIMIT %s"
+        rows = Database.execute_query(query, tuple(params) + (limit + 1,), fetch=True)
+
+        if len(rows) > limit:
+            rows = rows[:limit]
+            return rows, (rows[-1]['order_date'], rows[-1]['order_id'])
+        return rows, None
+
+    @classmethod
+    def get_items(cls, order_id: int) -> List[Dict]:
+        query = """SELECT oi.item_id, oi.medicine_id, m.name, oi.quantity, oi.unit_price, oi.subtotal
+                   FROM order_items oi JOIN medicines m ON m.medicine_id = oi.medicine_id
+                   WHERE oi.order_id = %s ORDER BY oi.item_id"""
+        return Database.execute_query(query, (order_id,), fetch=True)
+
+    @classmethod
+    def create_with_details(cls, order_data: Dict, items: List[Dict], cursor=None,
+                            return_item_ids: bool = False):
+        """Write an order, take its stock and award loyalty in one transaction; returns the order_id.
+
+        Pass ``cursor`` to run inside the caller's transaction. With
+        ``return_item_ids`` the result is (order_id, item_ids) instead.
+
+        When ``order_data`` carries an ``idempotency_key`` that was already
+        used (a double click, or a retry after a timeout), the original
+        order_id is returned and nothing is inserted, taken or awarded again.
+        """
+        key = order_data.get('idempotency_key')
+        with Database.transaction(cursor) as cursor:
+            if key:
+                existing = cls.find_by_key(key, cursor)
+                if existing:
+                    return (existing, cls.item_ids(existing, cursor)) if return_item_ids else existing
+
             # Create order
             query = f"""INSERT INTO {cls.TABLE} 
-                       (customer_id, employee_id, order_date, total_amount, order_type) 
-                       VALUES (%s, %s, %s, %s, %s)"""
-            cursor.execute(query, (
-                order_data.get('customer_id'),
-                order_data.get('employee_id'),
-                order_data.get('order_date', datetime.now()),
-                order_data['total_amount'],
-                order_data.get('order_type', 'retail')
-            ))
+                       (customer_id, employee_id, order_date, total_amount, order_type, idempotency_key) 
+                       VALUES (%s, %s, %s, %s, %s, %s)"""
+            try:
+                cursor.execute(query, (
+                    order_data.get('customer_id'),
+                    order_data.get('employee_id'),
+                    order_data.get('order_date', datetime.now()),
+                    order_data['total_amount'],
+                    order_data.get('order_type', 'retail'),
+                    key
+                ))
+            except mysql.connector.IntegrityError as e:
+                # A concurrent submit with the same key got in first; wait
+                # for it and hand back its order
+                if key and e.errno == errorcode.ER_DUP_ENTRY:
+                    existing = cls.find_by_key(key, cursor, lock=True)
+                    if existing:
+                        return (existing, cls.item_ids(existing, cursor)) if return_item_ids else existing
+                raise
             order_id = cursor.lastrowid
+            item_ids = cls.add_items(order_id, items, cursor)
             
-            # Add order items - Fixed table name to match SQL schema
+            # Take the items out of stock, earliest-expiring lots first, in
+            # the same transaction
+            basket = {}
             for item in items:
-                query = """INSERT INTO order_items 
-                          (order_id, medicine_id, quantity, unit_price, subtotal) 
-                          VALUES (%s, %s, %s, %s, %s)"""
-                cursor.execute(query, (
-                    order_id,
-                    item['medicine_id'],
-                    item['quantity'],
-                    item['price'],
-                    item['subtotal']
-                ))
+                basket[item['medicine_id']] = basket.get(item['medicine_id'], 0) + item['quantity']
+            MedicineLot.take(basket, StockMovement.ORDER, order_id, cursor=cursor)
+            Prescription.dispense(items, order_data.get('customer_id'), cursor)
             
-            conn.commit()
-            return order_id
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            Database.close_connection(conn, cursor)
+            # Loyalty points are awarded only with a new order
+            if order_data.get('customer_id'):
+                LoyaltyLedger.accrue(order_data['customer_id'], Customer.points_for(order_data['total_amount']),
+                                     LoyaltyLedger.ORDER, order_id, cursor=cursor)
+            
+            return (order_id, item_ids) if return_item_ids else order_id
+
+class MedicineLot(BaseModel):
+    """A received lot of a medicine with its own expiry date.
+
+    Stock leaves first-expired-first-out. ``open_expiry`` is a generated column
+    that is NULL for empty lots, and the ``fefo`` index on (medicine_id,
+    open_expiry, quantity) means allocation and availability only walk lots
+    that still hold unexpired stock, however many lots a medicine has had.
+    """
+    TABLE = "medicine_lots"
+
+    # Lots read per round trip while allocating; one batch covers most lines
+    ALLOCATION_BATCH = 32
+
+    @classmethod
+    def receive(cls, medicine_id: int, quantity: int, expiry_date: date = None,
+                batch_number: str = None, movement_type: str = "receipt",
+                reference_id: int = None, cursor=None) -> int:
+        """Book a new lot into stock and return its lot_id"""
+        with Database.transaction(cursor) as cursor:
+            cursor.execute(
+                f"""INSERT INTO {cls.TABLE} (medicine_id, batch_number, expiry_date, quantity)
+                   VALUES (%s, %s, %s, %s)""",
+                (medicine_id, batch_number, expiry_date, quantity)
+            )
+            lot_id = cursor.lastrowid
+            StockMovement.record([{
+                'medicine_id': medicine_id,
+                'lot_id': lot_id,
+                'movement_type': movement_type,
+                'quantity': quantity,
+                'reference_id': reference_id
+            }], cursor=cursor)
+            return lot_id
+
+    @classmethod
+    def allocate(cls, basket: Dict[int, int], cursor, include_expired: bool = False) -> List[Dict]:
+        """Choose lots for {medicine_id: quantity}, earliest expiry first.
+
+        The chosen lots are locked with FOR UPDATE but not yet decremented.
+        Raises InsufficientStockError listing every medicine that cannot be
+        covered from unexpired lots, or from any lot with ``include_expired``,
+        where expired lots come first.
+        """
+        in_date = "open_expiry IS NOT NULL" if include_expired else "open_expiry >= CURDATE()"
+        allocations = []
+        short = []
+        for medicine_id, quantity in basket.items():
+            need = quantity
+            after = None
+            while need > 0:
+                query = f"""SELECT lot_id, medicine_id, expiry_date, quantity, open_expiry
+                           FROM {cls.TABLE}
+                           WHERE medicine_id = %s AND {in_date}"""
+                params = [medicine_id]
+                if after:
+                    query += " AND (open_expiry, quantity, lot_id) > (%s, %s, %s)"
+                    params.extend(after)
+                query += " ORDER BY open_expiry, quantity, lot_id LIMIT %s FOR UPDATE"
+                params.append(cls.ALLOCATION_BATCH)
+                cursor.execute(query, tuple(params))
+                lots = cursor.fetchall()
+                if not lots:
+                    short.append(medicine_id)
+                    break
+
+                for lot in lots:
+                    take = min(need, lot['quantity'])
+                    allocations.append({
+                        'lot_id': lot['lot_id'],
+                        'medicine_id': medicine_id,
+                        'expiry_date': lot['expiry_date'],
+                        'quantity': take
+                    })
+                    need -= take
+                    if need == 0:
+                        break
+                last = lots[-1]
+                after = (last['open_expiry'], last['quantity'], last['lot_id'])
+
+        if short:
+            raise InsufficientStockError(short)
+        return allocations
+
+    @classmethod
+    def take(cls, basket: Dict[int, int], movement_type: str, reference_id: int = None,
+             cursor=None, include_expired: bool = False) -> List[Dict]:
+        """Allocate a basket FEFO, decrement every chosen lot in one statement
+        and record the per-lot movements. Returns the allocations."""
+        with Database.transaction(cursor) as cursor:
+            allocations = cls.allocate(basket, cursor, include_expired)
+            if not allocations:
+                return allocations
+
+            lot_ids = [a['lot_id'] for a in allocations]
+            case = ' '.join(['WHEN %s THEN %s'] * len(allocations))
+            cursor.execute(
+                f"""UPDATE {cls.TABLE} SET quantity = quantity - CASE lot_id {case} END
+                   WHERE lot_id IN ({', '.join(['%s'] * len(lot_ids))})""",
+                tuple(v for a in allocations for v in (a['lot_id'], a['quantity'])) + tuple(lot_ids)
+            )
+            StockMovement.record([{
+                'medicine_id': a['medicine_id'],
+                'lot_id': a['lot_id'],
+                'movement_type': movement_type,
+                'quantity': -a['quantity'],
+                'reference_id': reference_id
+            } for a in allocations], cursor=cursor)
+            return allocations
+
+    @classmethod
+    def availability(cls, medicine_ids: List[int]) -> Dict[int, int]:
+        """Unexpired quantity on hand per medicine, read from the fefo index alone"""
+        if not medicine_ids:
+            return {}
+        query = f"""SELECT medicine_id, SUM(quantity) AS available FROM {cls.TABLE}
+                   WHERE medicine_id IN ({', '.join(['%s'] * len(medicine_ids))})
+                   AND open_expiry >= CURDATE()
+                   GROUP BY medicine_id"""
+        rows = Database.execute_query(query, tuple(medicine_ids), fetch=True)
+        available = {medicine_id: 0 for medicine_id in medicine_ids}
+        available.update({row['medicine_id']: int(row['available']) for row in rows})
+        return available
+
+    @classmethod
+    def expiring_before(cls, until: date) -> List[Dict]:
+        # Range read over the open_expiry index, which skips empty lots
+        query = f"""SELECT l.lot_id, l.medicine_id, m.name, l.batch_number, l.expiry_date, l.quantity
+                   FROM {cls.TABLE} l JOIN medicines m ON l.medicine_id = m.medicine_id
+                   WHERE l.open_expiry <= %s ORDER BY l.open_expiry"""
+        return Database.execute_query(query, (until,), fetch=True)
 
 class Sale(BaseModel):
+    """A bill: one ``sales`` header row with its lines in ``sale_items``"""
     TABLE = "sales"
 
+    @classmethod
+    def find_by_key(cls, idempotency_key: str, cursor=None, lock: bool = False) -> Optional[int]:
+        """sale_id already written under idempotency_key, if any (one unique index probe)"""
+        with Database.transaction(cursor) as cursor:
+            cursor.execute(
+                f"SELECT sale_id FROM {cls.TABLE} WHERE idempotency_key = %s"
+                + (" LOCK IN SHARE MODE" if lock else ""),
+                (idempotency_key,)
+            )
+            row = cursor.fetchone()
+            return row['sale_id'] if row else None
+
+    @classmethod
+    def create_with_details(cls, sale_data: Dict, items: List[Dict], cursor=None) -> int:
+        """Write a bill, take its stock and award loyalty in one transaction; returns the sale_id.
+
+        Items are dicts with ``medicine_id``, ``quantity``, ``price`` and
+        ``total``, plus ``prescription_item_id`` for a line dispensed against
+        a prescription (see Prescription.dispense); all of them go in with a
+        single multi-row insert. When
+        ``sale_data`` carries an ``idempotency_key`` that was already used,
+        the original sale_id is returned and nothing is written again.
+        """
+        key = sale_data.get('idempotency_key')
+        with Database.transaction(cursor) as cursor:
+            if key:
+                existing = cls.find_by_key(key, cursor)
+                if existing:
+                    return existing
+
+            try:
+                cursor.execute(
+                    f"""INSERT INTO {cls.TABLE} (customer_id, sale_date, subtotal, tax, total, idempotency_key)
+                       VALUES (%s, %s, %s, %s, %s, %s)""",
+                    (sale_data.get('customer_id'), sale_data.get('sale_date', datetime.now()),
+                     sale_data['subtotal'], sale_data['tax'], sale_data['total'], key)
+                )
+            except mysql.connector.IntegrityError as e:
+                if key and e.errno == errorcode.ER_DUP_ENTRY:
+                    existing = cls.find_by_key(key, cursor, lock=True)
+                    if existing:
+                        return existing
+                raise
+            sale_id = cursor.lastrowid
+
+            cursor.execute(
+                f"""INSERT INTO sale_items (sale_id, medicine_id, quantity, unit_price, total_price, prescription_item_id)
+                   VALUES {', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(items))}""",
+                tuple(v for item in items
+                      for v in (sale_id, item['medicine_id'], item['quantity'], item['price'], item['total'],
+                                item.get('prescription_item_id')))
+            )
+
+            basket = {}
+            for item in items:
+                basket[item['medicine_id']] = basket.get(item['medicine_id'], 0) + item['quantity']
+            MedicineLot.take(basket, StockMovement.SALE, sale_id, cursor=cursor)
+            Prescription.dispense(items, sale_data.get('customer_id'), cursor)
+
+            if sale_data.get('customer_id'):
+                LoyaltyLedger.accrue(sale_data['customer_id'], Customer.points_for(sale_data['subtotal']),
+                                     LoyaltyLedger.SALE, sale_id, cursor=cursor)
+            return sale_id
+
+    @classmethod
+    def get_items(cls, sale_id: int) -> List[Dict]:
+        query = """SELECT si.*, m.name FROM sale_items si
+                   JOIN medicines m ON m.medicine_id = si.medicine_id
+                   WHERE si.sale_id = %s ORDER BY si.item_id"""
+        return Database.execute_query(query, (sale_id,), fetch=True)
+
 class Payment(BaseModel):
     TABLE = "payments"
 
+class Receipt(BaseModel):
+    """Index row for each archived receipt file, one per sale and format"""
+    TABLE = "receipts"
+
+    @classmethod
+    def record(cls, data: Dict) -> None:
+        """Insert or replace the index entry for data['sale_id'] and data['format']"""
+        columns = ', '.join(data.keys())
+        placeholders = ', '.join(['%s'] * len(data))
+        updates = ', '.join(f"{key} = VALUES({key})" for key in data if key not in ('sale_id', 'format'))
+        Database.execute_query(
+            f"""INSERT INTO {cls.TABLE} ({columns}) VALUES ({placeholders})
+               ON DUPLICATE KEY UPDATE {updates},
+               segment_path = NULL, segment_offset = NULL, segment_length = NULL""",
+            tuple(data.values())
+        )
+
+    @classmethod
+    def for_sale(cls, sale_id: int, fmt: str = None) -> Optional[Dict]:
+        query = f"SELECT * FROM {cls.TABLE} WHERE sale_id = %s"
+        params = [sale_id]
+        if fmt:
+            query += " AND format = %s"
+            params.append(fmt)
+        result = Database.execute_query(query + " ORDER BY receipt_id LIMIT 1", tuple(params), fetch=True)
+        return result[0] if result else None
+
+    @classmethod
+    def for_customer(cls, customer_id: int, start: datetime = None, end: datetime = None) -> List[Dict]:
+        query = f"SELECT * FROM {cls.TABLE} WHERE customer_id = %s"
+        params = [customer_id]
+        if start:
+            query += " AND issued_at >= %s"
+            params.append(start)
+        if end:
+            query += " AND issued_at < %s"
+            params.append(end)
+        return Database.execute_query(query + " ORDER BY issued_at", tuple(params), fetch=True)
+
+    @classmethod
+    def on_day(cls, day: date, unpacked_only: bool = False) -> List[Dict]:
+        query = f"SELECT * FROM {cls.TABLE} WHERE issued_at >= %s AND issued_at < %s + INTERVAL 1 DAY"
+        if unpacked_only:
+            query += " AND segment_path IS NULL"
+        return Database.execute_query(query + " ORDER BY receipt_id", (day, day), fetch=True)
+
+    @classmethod
+    def unpacked_days(cls, before: date) -> List[date]:
+        rows = Database.execute_query(
+            f"""SELECT DISTINCT DATE(issued_at) AS day FROM {cls.TABLE}
+               WHERE issued_at < %s AND segment_path IS NULL ORDER BY day""",
+            (before,), fetch=True
+        )
+        return [row['day'] for row in rows]
+
+    @classmethod
+    def mark_packed(cls, segment_path: str, placements: List[tuple]) -> None:
+        """placements are (receipt_id, offset, length) inside segment_path"""
+        with Database.transaction() as cursor:
+            cursor.executemany(
+                f"""UPDATE {cls.TABLE} SET segment_path = %s, segment_offset = %s, segment_length = %s
+                   WHERE receipt_id = %s""",
+                [(segment_path, offset, length, receipt_id) for receipt_id, offset, length in placements]
+            )
+
+class ReceiptJob(BaseModel):
+    """Receipts not yet archived, so they survive a restart of the app"""
+    TABLE = "receipt_jobs"
+
+    @classmethod
+    def set_status(cls, sale_id: int, fmt: str, status: str, detail: str = None) -> None:
+        Database.execute_query(
+            f"""INSERT INTO {cls.TABLE} (sale_id, format, status, detail) VALUES (%s, %s, %s, %s)
+               ON DUPLICATE KEY UPDATE status = VALUES(status), detail = VALUES(detail)""",
+            (sale_id, fmt, status, detail[:255] if detail else None)
+        )
+
+    @classmethod
+    def done(cls, sale_id: int, fmt: str) -> None:
+        Database.execute_query(f"DELETE FROM {cls.TABLE} WHERE sale_id = %s AND format = %s", (sale_id, fmt))
+
+    @classmethod
+    def unfinished(cls, fmt: str) -> List[Dict]:
+        """Queued and failed jobs for a format, oldest sale first"""
+        return Database.execute_query(
+            f"SELECT sale_id, status, detail FROM {cls.TABLE} WHERE format = %s ORDER BY sale_id",
+            (fmt,), fetch=True
+        )
+
 class Stock(BaseModel):
     TABLE = "stock"
+    __listeners = []
     
     @classmethod
     def check_low_stock(cls, threshold: int = 10) -> List[Dict]:
-        query = f"""SELECT m.name, s.quantity_in_stock, s.reorder_level 
+        # below_reorder is a stored generated column with its own index, so
+        # this reads only the rows currently in alert
+        query = f"""SELECT s.medicine_id, m.name, s.quantity_in_stock, s.reorder_level 
                    FROM {cls.TABLE} s JOIN medicines m 
                    ON s.medicine_id = m.medicine_id 
-                   WHERE s.quantity_in_stock <= s.reorder_level"""
-        return Database.execute_query(query, fetch=True)
\ No newline at end of file
+                   WHERE s.below_reorder = 1
+                   ORDER BY s.quantity_in_stock - s.reorder_level"""
+        return Database.execute_query(query, fetch=True)
+    
+    @classmethod
+    def set_reorder_level(cls, medicine_id: int, reorder_level: int, cursor=None) -> None:
+        with Database.transaction(cursor) as cursor:
+            cursor.execute(
+                f"""UPDATE {cls.TABLE} SET reorder_level = %s, last_updated = CURRENT_DATE 
+                   WHERE medicine_id = %s""",
+                (reorder_level, medicine_id)
+            )
+            cls.publish_levels(cursor, [medicine_id])
+    
+    @classmethod
+    def add_listener(cls, callback) -> None:
+        """Register callback(levels) for levels changed by committed transactions"""
+        cls.__listeners.append(callback)
+    
+    @classmethod
+    def remove_listener(cls, callback) -> None:
+        if callback in cls.__listeners:
+            cls.__listeners.remove(callback)
+    
+    @classmethod
+    def publish_levels(cls, cursor, medicine_ids: List[int]) -> None:
+        """Read the new levels of medicine_ids and hand them to listeners on commit"""
+        if not cls.__listeners or not medicine_ids:
+            return
+        cursor.execute(
+            f"""SELECT s.medicine_id, m.name, s.quantity_in_stock, s.reorder_level 
+               FROM {cls.TABLE} s JOIN medicines m ON s.medicine_id = m.medicine_id 
+               WHERE s.medicine_id IN ({', '.join(['%s'] * len(medicine_ids))})""",
+            tuple(medicine_ids)
+        )
+        levels = {row['medicine_id']: row for row in cursor.fetchall()}
+        
+        def notify():
+            for callback in list(cls.__listeners):
+                callback(levels)
+        
+        Database.on_commit(cursor, notify)
+
+class StockMovement(BaseModel):
+    """Append-only ledger of every change to a medicine's stock level.
+
+    ``medicines.quantity`` and ``stock.quantity_in_stock`` are kept as cached
+    current levels and are only ever moved by the deltas recorded here, so the
+    two can no longer drift. ``stock_snapshots`` folds the ledger periodically
+    so a level is one snapshot row plus the movements after it.
+    """
+    TABLE = "stock_movements"
+
+    SALE = "sale"
+    ORDER = "order"
+    RECEIPT = "receipt"
+    ADJUSTMENT = "adjustment"
+    WRITE_OFF = "write_off"
+    TYPES = (SALE, ORDER, RECEIPT, ADJUSTMENT, WRITE_OFF)
+
+    # A medicine is snapshotted once this many movements have piled up after
+    # its latest snapshot, which bounds the tail a level lookup has to sum.
+    SNAPSHOT_EVERY = 50
+
+    # Movements younger than this are left out of snapshots. Ids are handed
+    # out at insert, not at commit, so a lower id can still be uncommitted
+    # behind a higher one; no transaction that records movements is
+    # expected to stay open this long.
+    SETTLE_SECONDS = 300
+
+    @classmethod
+    def record(cls, movements: List[Dict], cursor=None) -> None:
+        """Append movements and apply their deltas to the cached levels.
+
+        Each movement is a dict with ``medicine_id``, ``movement_type``, a signed
+        ``quantity`` and optional ``lot_id`` and ``reference_id``. Lot
+        quantities are moved by MedicineLot, which records through here. All movements are written
+        with one multi-row insert and one UPDATE per cached table; the whole
+        batch is rejected with InsufficientStockError if any level would go
+        negative.
+        """
+        if not movements:
+            return
+        for movement in movements:
+            if movement['movement_type'] not in cls.TYPES:
+                raise ValueError(f"Unknown movement type: {movement['movement_type']}")
+
+        deltas = {}
+        for movement in movements:
+            deltas[movement['medicine_id']] = deltas.get(movement['medicine_id'], 0) + movement['quantity']
+
+        with Database.transaction(cursor) as cursor:
+            cursor.executemany(
+                f"""INSERT INTO {cls.TABLE} (medicine_id, lot_id, movement_type, quantity, reference_id)
+                   VALUES (%s, %s, %s, %s, %s)""",
+                [(m['medicine_id'], m.get('lot_id'), m['movement_type'], m['quantity'], m.get('reference_id'))
+                 for m in movements]
+            )
+
+            ids = list(deltas)
+            case = ' '.join(['WHEN %s THEN %s'] * len(ids))
+            case_params = tuple(v for medicine_id in ids for v in (medicine_id, deltas[medicine_id]))
+            in_clause = ', '.join(['%s'] * len(ids))
+
+            cursor.execute(
+                f"""UPDATE medicines SET quantity = quantity + CASE medicine_id {case} END
+                   WHERE medicine_id IN ({in_clause})""",
+                case_params + tuple(ids)
+            )
+            cursor.execute(
+                f"""UPDATE stock SET quantity_in_stock = quantity_in_stock + CASE medicine_id {case} END,
+                   last_updated = CURRENT_DATE
+                   WHERE medicine_id IN ({in_clause})""",
+                case_params + tuple(ids)
+            )
+
+            decreased = [medicine_id for medicine_id in ids if deltas[medicine_id] < 0]
+            if decreased:
+                cursor.execute(
+                    f"""SELECT medicine_id FROM medicines
+                       WHERE medicine_id IN ({', '.join(['%s'] * len(decreased))}) AND quantity < 0""",
+                    tuple(decreased)
+                )
+                short = cursor.fetchall()
+                if short:
+                    raise InsufficientStockError(row['medicine_id'] for row in short)
+
+            Stock.publish_levels(cursor, ids)
+
+    @classmethod
+    def adjust_to(cls, medicine_id: int, new_quantity: int, movement_type: str = ADJUSTMENT,
+                  cursor=None) -> int:
+        """Record the movement that brings a medicine to new_quantity; returns the delta.
+
+        A decrease is taken from the earliest-expiring lots, expired ones
+        first, since new_quantity is a count of everything on the shelf; an
+        increase is booked as a new lot carrying the medicine's batch number
+        and expiry.
+        """
+        with Database.transaction(cursor) as cursor:
+            cursor.execute(
+                "SELECT quantity, batch_number, expiry_date FROM medicines WHERE medicine_id = %s FOR UPDATE",
+                (medicine_id,)
+            )
+            row = cursor.fetchone()
+            if not row:
+                raise ValueError("Medicine not found")
+            delta = new_quantity - row['quantity']
+            if delta < 0:
+                MedicineLot.take({medicine_id: -delta}, movement_type, cursor=cursor, include_expired=True)
+            elif delta > 0:
+                MedicineLot.receive(medicine_id, delta, row['expiry_date'], row['batch_number'],
+                                    movement_type=movement_type, cursor=cursor)
+            return delta
+
+    @classmethod
+    def level_at(cls, medicine_id: int, at: datetime = None) -> int:
+        """Stock level of a medicine at a point in time (now by default).
+
+        Served from the latest snapshot taken at or before ``at`` plus the
+        movements recorded after it, both located by index.
+        """
+        at = at or datetime.now()
+        snapshot = Database.execute_query(
+            """SELECT quantity, last_movement_id FROM stock_snapshots
+               WHERE medicine_id = %s AND taken_at <= %s
+               ORDER BY taken_at DESC, last_movement_id DESC LIMIT 1""",
+            (medicine_id, at), fetch=True
+        )
+        base, last_movement_id = (snapshot[0]['quantity'], snapshot[0]['last_movement_id']) if snapshot else (0, 0)
+        tail = Database.execute_query(
+            f"""SELECT COALESCE(SUM(quantity), 0) AS delta FROM {cls.TABLE}
+               WHERE medicine_id = %s AND movement_id > %s AND moved_at <= %s""",
+            (medicine_id, last_movement_id, at), fetch=True
+        )
+        return int(base + tail[0]['delta'])
+
+    @classmethod
+    def current_level(cls, medicine_id: int) -> int:
+        return cls.level_at(medicine_id)
+
+    @classmethod
+    def history(cls, medicine_id: int, start: datetime = None, end: datetime = None) -> List[Dict]:
+        query = f"SELECT * FROM {cls.TABLE} WHERE medicine_id = %s"
+        params = [medicine_id]
+        if start:
+            query += " AND moved_at >= %s"
+            params.append(start)
+        if end:
+            query += " AND moved_at <= %s"
+            params.append(end)
+        query += " ORDER BY moved_at, movement_id"
+        return Database.execute_query(query, tuple(params), fetch=True)
+
+    @classmethod
+    def take_snapshots(cls, min_tail: int = SNAPSHOT_EVERY) -> int:
+        """Snapshot every medicine with at least min_tail unsnapshotted movements.
+
+        Runs as a single set-based INSERT ... SELECT and returns the number of
+        snapshots written. Only movements up to the newest one recorded
+        SETTLE_SECONDS ago are folded, so a movement committed late behind a
+        higher id is never skipped by the snapshot and then by every tail.
+        """
+        with Database.transaction() as cursor:
+            # Walks the primary key back from the newest movement, so only
+            # the settle window is read
+            cursor.execute(
+                f"""SELECT movement_id FROM {cls.TABLE}
+                   WHERE moved_at < NOW() - INTERVAL %s SECOND
+                   ORDER BY movement_id DESC LIMIT 1""",
+                (cls.SETTLE_SECONDS,)
+            )
+            row = cursor.fetchone()
+            if not row:
+                return 0
+            high = row['movement_id']
+            cursor.execute(
+                f"""INSERT INTO stock_snapshots (medicine_id, quantity, last_movement_id, taken_at)
+                   SELECT mv.medicine_id,
+                          COALESCE(sn.quantity, 0) + SUM(mv.quantity),
+                          MAX(mv.movement_id),
+                          MAX(mv.moved_at)
+                   FROM {cls.TABLE} mv
+                   LEFT JOIN (SELECT medicine_id, MAX(last_movement_id) AS last_movement_id
+                              FROM stock_snapshots GROUP BY medicine_id) latest
+                     ON latest.medicine_id = mv.medicine_id
+                   LEFT JOIN stock_snapshots sn
+                     ON sn.medicine_id = latest.medicine_id
+                    AND sn.last_movement_id = latest.last_movement_id
+                   WHERE mv.movement_id > COALESCE(latest.last_movement_id, 0)
+                     AND mv.movement_id <= %s
+                   GROUP BY mv.medicine_id, sn.quantity
+                   HAVING COUNT(*) >= %s""",
+                (high, min_tail)
+            )
+            return cursor.rowcount
@@ -0,0 +1,165 @@
+import queue
+import threading
+import tkinter as tk
+from tkinter import ttk
+from bisect import bisect_right, insort
+from datetime import date, timedelta
+from typing import Dict, List
+from database import MedicineLot
+
+class ExpiryCalendar:
+    """Lots with stock left, bucketed by expiry day.
+
+    Loaded with one range read over the lots' ``open_expiry`` index, so the
+    cost depends on how many lots fall inside the horizon, not on the catalog
+    or on lots that are already used up.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.days = []
+
+    def load(self, until: date):
+        self.buckets = {}
+        self.days = []
+        for item in MedicineLot.expiring_before(until):
+            self.add(item)
+
+    def add(self, item: Dict):
+        day = item['expiry_date']
+        if day not in self.buckets:
+            self.buckets[day] = []
+            insort(self.days, day)
+        self.buckets[day].append(item)
+
+    def through(self, day: date) -> List[Dict]:
+        """Items expiring on or before day, earliest first"""
+        items = []
+        for bucket_day in self.days[:bisect_right(self.days, day)]:
+            items.extend(self.buckets[bucket_day])
+        return items
+
+class ExpiryMonitor:
+    """Background check that turns the calendar into expiry events.
+
+    Meant to be registered with a BackgroundScheduler. Each lot yields an
+    ``expiring`` event when it enters the warning window, again whenever its
+    days-left count changes, and an ``expired`` event once it lapses. Events
+    land on ``self.events`` for the UI thread to drain.
+    """
+
+    def __init__(self, warn_days: int = 30):
+        self.warn_days = warn_days
+        self.calendar = ExpiryCalendar()
+        self.events = queue.Queue()
+        self._lock = threading.Lock()
+        self._emitted = {}
+
+    def check(self, today: date = None):
+        today = today or date.today()
+        with self._lock:
+            self.calendar.load(today + timedelta(days=self.warn_days))
+            seen = set()
+            for item in self.calendar.through(today + timedelta(days=self.warn_days)):
+                days_left = (item['expiry_date'] - today).days
+                state = ('expired', None) if days_left < 0 else ('expiring', days_left)
+                seen.add(item['lot_id'])
+                if self._emitted.get(item['lot_id']) == state:
+                    continue
+                self._emitted[item['lot_id']] = state
+                self.events.put({
+                    'kind': state[0],
+                    'lot_id': item['lot_id'],
+                    'medicine_id': item['medicine_id'],
+                    'name': item['name'],
+                    'batch_number': item['batch_number'],
+                    'quantity': item['quantity'],
+                    'expiry_date': item['expiry_date'],
+                    'days_left': days_left
+                })
+            # Sold-out or written-off lots drop out of the panel
+            for lot_id in set(self._emitted) - seen:
+                del self._emitted[lot_id]
+                self.events.put({'kind': 'cleared', 'lot_id': lot_id})
+
+class ExpiryAlertPanel(ttk.Frame):
+    """Paginated view of the alerts produced by an ExpiryMonitor"""
+
+    PAGE_SIZE = 20
+    POLL_MS = 1000
+
+    def __init__(self, parent, monitor: ExpiryMonitor):
+        super().__init__(parent)
+        self.monitor = monitor
+        self.alerts = {}
+        self.page = 0
+        self.setup_ui()
+        self.after(self.POLL_MS, self.poll_events)
+
+    def setup_ui(self):
+        self.tree = ttk.Treeview(self, columns=("Medicine", "Batch", "Qty", "Expiry", "Status"), show="headings")
+
+        columns = [
+            ("Medicine", "Medicine", 200),
+            ("Batch", "Batch", 100),
+            ("Qty", "Quantity", 80),
+            ("Expiry", "Expiry Date", 120),
+            ("Status", "Status", 200)
+        ]
+
+        for col_id, col_text, width in columns:
+            self.tree.heading(col_id, text=col_text)
+            self.tree.column(col_id, width=width, anchor="center")
+
+        self.tree.tag_configure("expired", foreground="#b00020")
+        self.tree.pack(fill="both", expand=True, padx=10, pady=10)
+
+        nav_frame = ttk.Frame(self)
+        nav_frame.pack(fill="x", padx=10, pady=5)
+
+        ttk.Button(nav_frame, text="< Prev", command=lambda: self.show_page(self.page - 1)).pack(side="left", padx=5)
+        self.page_label = ttk.Label(nav_frame, text="Page 1 of 1")
+        self.page_label.pack(side="left", padx=5)
+        ttk.Button(nav_frame, text="Next >", command=lambda: self.show_page(self.page + 1)).pack(side="left", padx=5)
+
+    def poll_events(self):
+        changed = False
+        while True:
+            try:
+                event = self.monitor.events.get_nowait()
+            except queue.Empty:
+                break
+            if event['kind'] == 'cleared':
+                self.alerts.pop(event['lot_id'], None)
+            else:
+                self.alerts[event['lot_id']] = event
+            changed = True
+
+        if changed:
+            self.show_page(self.page)
+        self.after(self.POLL_MS, self.poll_events)
+
+    def page_count(self) -> int:
+        return max(1, -(-len(self.alerts) // self.PAGE_SIZE))
+
+    def show_page(self, page: int):
+        self.page = min(max(page, 0), self.page_count() - 1)
+        for row in self.tree.get_children():
+            self.tree.delete(row)
+
+        ordered = sorted(self.alerts.values(), key=lambda a: (a['expiry_date'], a['name']))
+        start = self.page * self.PAGE_SIZE
+        for alert in ordered[start:start + self.PAGE_SIZE]:
+            if alert['kind'] == 'expired':
+                status = "Expired"
+            else:
+                status = f"Expiring in {alert['days_left']} days"
+            self.tree.insert("", tk.END, values=(
+                alert['name'],
+                alert['batch_number'] or "N/A",
+                alert['quantity'],
+                alert['expiry_date'].strftime("%Y-%m-%d"),
+                status
+            ), tags=(alert['kind'],))
+
+        self.page_label.config(text=f"Page {self.page + 1} of {self.page_count()}")
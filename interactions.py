@@ -0,0 +1,162 @@
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List
+from database import InteractionRule, Medicine
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+def _bits(mask: int) -> Iterable[int]:
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+class InteractionIndex:
+    """Interaction rules and medicine classifications held as bitsets.
+
+    Every ingredient or category named by a medicine or a rule gets a bit.
+    ``partners[k]`` is the mask of keys that interact with key ``k``, and a
+    medicine's mask has the bits of its ingredient and its category, so two
+    medicines interact when the partners of one overlap the mask of the
+    other. Checking a basket of N medicines is N² AND operations over these
+    ints with no queries.
+
+    ``refresh`` (run from the BackgroundScheduler) reads only rules and
+    medicines changed since the last refresh and patches the bitsets in
+    place; ``apply`` takes rows directly, for benchmarks.
+    """
+
+    def __init__(self):
+        self.key_bits = {}
+        self.partners = []
+        # (low bit, high bit) -> rule, and rule_id -> its pair
+        self.rules = {}
+        self.rule_pairs = {}
+        # medicine_id -> (name, mask, ingredient bit or None)
+        self.medicines = {}
+        self.rules_seen = None
+        self.medicines_seen = None
+        self.last_medicine_id = 0
+        self.loaded = False
+        self._lock = threading.Lock()
+
+    def refresh(self) -> int:
+        """Fold in rules and medicines changed since the last call; returns how many rows were read"""
+        # Medicines never edited have no updated_at, so after the first full
+        # load they are only picked up as new ids
+        if self.loaded:
+            rules_since, medicines_since = self.rules_seen or EPOCH, self.medicines_seen or EPOCH
+        else:
+            rules_since = medicines_since = None
+        rules = InteractionRule.changed_since(rules_since)
+        medicines = Medicine.classified_since(medicines_since, self.last_medicine_id)
+        self.apply(rules, medicines)
+        self.loaded = True
+        if rules or medicines:
+            logger.info("Interaction index: %d rule and %d medicine change(s), %d rules in total",
+                        len(rules), len(medicines), len(self.rules))
+        return len(rules) + len(medicines)
+
+    def apply(self, rules: List[Dict], medicines: List[Dict] = ()) -> None:
+        with self._lock:
+            for rule in rules:
+                self._apply_rule(rule)
+                if rule.get('updated_at') and (self.rules_seen is None or rule['updated_at'] > self.rules_seen):
+                    self.rules_seen = rule['updated_at']
+            for medicine in medicines:
+                self._apply_medicine(medicine)
+                self.last_medicine_id = max(self.last_medicine_id, medicine['medicine_id'])
+                if medicine.get('updated_at') and (self.medicines_seen is None
+                                                   or medicine['updated_at'] > self.medicines_seen):
+                    self.medicines_seen = medicine['updated_at']
+
+    def _bit(self, key_type: str, value: str) -> int:
+        key = (key_type, value.strip().lower())
+        bit = self.key_bits.get(key)
+        if bit is None:
+            bit = self.key_bits[key] = len(self.partners)
+            self.partners.append(0)
+        return bit
+
+    def _apply_rule(self, rule: Dict):
+        old = self.rule_pairs.pop(rule['rule_id'], None)
+        if old:
+            del self.rules[old]
+            a, b = old
+            self.partners[a] &= ~(1 << b)
+            self.partners[b] &= ~(1 << a)
+        if not rule.get('active', 1):
+            return
+        a = self._bit(rule['left_type'], rule['left_value'])
+        b = self._bit(rule['right_type'], rule['right_value'])
+        pair = (min(a, b), max(a, b))
+        self.rules[pair] = rule
+        self.rule_pairs[rule['rule_id']] = pair
+        self.partners[a] |= 1 << b
+        self.partners[b] |= 1 << a
+
+    def _apply_medicine(self, medicine: Dict):
+        mask, ingredient = 0, None
+        if medicine.get('active_ingredient'):
+            ingredient = self._bit(InteractionRule.INGREDIENT, medicine['active_ingredient'])
+            mask |= 1 << ingredient
+        if medicine.get('category'):
+            mask |= 1 << self._bit(InteractionRule.CATEGORY, medicine['category'])
+        self.medicines[medicine['medicine_id']] = (medicine['name'], mask, ingredient)
+
+    def check(self, medicine_ids: Iterable[int], added: Iterable[int] = None) -> List[Dict]:
+        """Interactions and duplicate therapies among ``medicine_ids``.
+
+        With ``added``, only pairs involving one of those medicines are
+        reported, for checking a line against a basket already accepted.
+        Each finding has 'medicine_ids', 'names', 'severity' and
+        'description'; duplicate therapies have severity 'duplicate'.
+        """
+        added = set(added) if added is not None else None
+        with self._lock:
+            basket = [(medicine_id, self.medicines[medicine_id]) for medicine_id in dict.fromkeys(medicine_ids)
+                      if medicine_id in self.medicines]
+            reach = []
+            for medicine_id, (name, mask, ingredient) in basket:
+                r = 0
+                for bit in _bits(mask):
+                    r |= self.partners[bit]
+                reach.append(r)
+
+            findings = []
+            for i, (id_a, (name_a, mask_a, ingredient_a)) in enumerate(basket):
+                for j in range(i + 1, len(basket)):
+                    id_b, (name_b, mask_b, ingredient_b) = basket[j]
+                    if added is not None and id_a not in added and id_b not in added:
+                        continue
+                    if ingredient_a is not None and ingredient_a == ingredient_b:
+                        findings.append({'medicine_ids': (id_a, id_b), 'names': (name_a, name_b),
+                                         'severity': 'duplicate',
+                                         'description': "Same active ingredient (duplicate therapy)"})
+                    if reach[i] & mask_b:
+                        for rule in self._rules_between(mask_a, mask_b):
+                            findings.append({'medicine_ids': (id_a, id_b), 'names': (name_a, name_b),
+                                             'severity': rule['severity'],
+                                             'description': rule['description'] or "Known interaction"})
+            return findings
+
+    def _rules_between(self, mask_a: int, mask_b: int) -> List[Dict]:
+        rules = []
+        for a in _bits(mask_a):
+            for b in _bits(self.partners[a] & mask_b):
+                rule = self.rules[(min(a, b), max(a, b))]
+                if rule not in rules:
+                    rules.append(rule)
+        return rules
+
+    def __len__(self):
+        return len(self.rules)
+
+def describe(findings: List[Dict]) -> str:
+    """Findings as lines for a confirmation dialog"""
+    return "\n".join(
+        f"{f['names'][0]} + {f['names'][1]}: {f['severity']} - {f['description']}" for f in findings
+    )
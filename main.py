@@ -4,9 +4,13 @@ from medicine_manager import MedicineManager
 from supplier_manager import SupplierManager
 from customer_manager import CustomerManager
 from order_manager import OrderManager
+from order_history_manager import OrderHistoryManager
 from prescription_manager import PrescriptionManager
 from employee_manager import EmployeeManager
-from database import Database
+from database import Database, StockMovement, LoyaltyLedger
+from scheduler import BackgroundScheduler
+from pos_journal import PosJournal
+from interactions import InteractionIndex
 
 class PharmacyApp:
     def __init__(self, root):
@@ -33,18 +37,32 @@ class PharmacyApp:
         self.content_frame = ttk.Frame(self.main_frame)
         self.content_frame.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True)
         
+        # Checkouts made while the database is down are journaled locally
+        self.journal = PosJournal()
+        # Interaction rules, shared by every screen that builds a basket
+        self.interactions = InteractionIndex()
+        
         # Initialize managers
         self.managers = {
             "medicines": MedicineManager(self.content_frame),
             "suppliers": SupplierManager(self.content_frame),
             "customers": CustomerManager(self.content_frame),
-            "orders": OrderManager(self.content_frame),
-            "prescriptions": PrescriptionManager(self.content_frame),
+            "orders": OrderManager(self.content_frame, self.journal, self.interactions),
+            "order_history": OrderHistoryManager(self.content_frame),
+            "prescriptions": PrescriptionManager(self.content_frame, self.interactions),
             "employees": EmployeeManager(self.content_frame)
         }
         
         # Show default view
         self.show_manager("medicines")
+        
+        # Background maintenance
+        self.scheduler = BackgroundScheduler()
+        self.scheduler.every(15 * 60, StockMovement.take_snapshots, "stock snapshots")
+        self.scheduler.every(5 * 60, LoyaltyLedger.fold, "loyalty fold")
+        self.scheduler.every(30, self.journal.replay, "journal replay", run_now=True)
+        self.scheduler.every(5 * 60, self.interactions.refresh, "interaction rules")
+        self.scheduler.start()
 
     def create_sidebar(self):
         """Create navigation sidebar"""
@@ -56,6 +74,7 @@ class PharmacyApp:
             ("Suppliers", "suppliers"),
             ("Customers", "customers"),
             ("Orders", "orders"),
+            ("Order History", "order_history"),
             ("Prescriptions", "prescriptions"),
             ("Employees", "employees")
         ]
@@ -1,12 +1,15 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog
 from datetime import datetime
-from database import Medicine, Supplier
+from database import Database, Medicine, MedicineBarcode, MedicineLot, MedicinePrice, Supplier, StockMovement
+from barcode_index import BarcodeIndex, normalize_gtin
 
 class MedicineManager:
-    def __init__(self, parent):
+    def __init__(self, parent, barcodes: BarcodeIndex = None):
         self.frame = ttk.Frame(parent)
         self.current_medicine = None
+        # The counter's scan index, if this terminal has one
+        self.barcodes = barcodes
         self.setup_ui()
 
     def setup_ui(self):
@@ -54,6 +57,8 @@ class MedicineManager:
         self.edit_btn.pack(side=tk.LEFT, padx=5)
         self.delete_btn = ttk.Button(btn_frame, text="Delete", state=tk.DISABLED, command=self.delete_medicine)
         self.delete_btn.pack(side=tk.LEFT, padx=5)
+        self.barcode_btn = ttk.Button(btn_frame, text="Add Barcode", state=tk.DISABLED, command=self.add_barcode)
+        self.barcode_btn.pack(side=tk.LEFT, padx=5)
         ttk.Button(btn_frame, text="Refresh", command=self.load_medicines).pack(side=tk.RIGHT, padx=5)
         
         # Load initial data
@@ -87,17 +92,29 @@ class MedicineManager:
             self.current_medicine = self.tree.item(selected[0])['values']
             self.edit_btn.config(state=tk.NORMAL)
             self.delete_btn.config(state=tk.NORMAL)
+            self.barcode_btn.config(state=tk.NORMAL)
         else:
             self.current_medicine = None
             self.edit_btn.config(state=tk.DISABLED)
             self.delete_btn.config(state=tk.DISABLED)
+            self.barcode_btn.config(state=tk.DISABLED)
 
     def add_medicine(self):
         """Open add medicine dialog"""
         dialog = MedicineDialog(self.frame, "Add Medicine")
         if dialog.result:
             try:
-                Medicine.create(dialog.result)
+                # Opening stock is received as the medicine's first lot, in
+                # the same transaction so a failure leaves no half-made medicine
+                quantity = dialog.result['quantity']
+                with Database.transaction() as cursor:
+                    medicine_id = Medicine.create(dict(dialog.result, quantity=0), cursor=cursor)
+                    MedicinePrice.open_history(medicine_id, dialog.result['price'], cursor=cursor)
+                    if quantity:
+                        MedicineLot.receive(medicine_id, quantity,
+                                            dialog.result['expiry_date'],
+                                            dialog.result['batch_number'],
+                                            cursor=cursor)
                 self.load_medicines()
                 messagebox.showinfo("Success", "Medicine added successfully")
             except Exception as e:
@@ -118,18 +135,46 @@ class MedicineManager:
                 'price': float(self.current_medicine[3][1:]),
                 'expiry_date': self.current_medicine[4] if self.current_medicine[4] != "N/A" else None,
                 'category': self.current_medicine[5] if self.current_medicine[5] != "N/A" else None,
+                'active_ingredient': Medicine.get_many([med_id], ("active_ingredient",))
+                                     .get(med_id, {}).get('active_ingredient'),
                 'supplier_id': None  # Would need actual ID lookup
             }
         )
         
         if dialog.result:
             try:
-                Medicine.update(med_id, dialog.result)
+                data = dict(dialog.result)
+                # Stock, price history and the medicine row change together or not at all
+                with Database.transaction() as cursor:
+                    StockMovement.adjust_to(med_id, data.pop('quantity'), cursor=cursor)
+                    # Price changes go through the history instead of overwriting
+                    MedicinePrice.set_price(med_id, data.pop('price'), cursor=cursor)
+                    Medicine.update(med_id, data, cursor=cursor)
                 self.load_medicines()
                 messagebox.showinfo("Success", "Medicine updated successfully")
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to update medicine: {str(e)}")
 
+    def add_barcode(self):
+        """Register another barcode for the selected medicine"""
+        if not self.current_medicine:
+            return
+        code = simpledialog.askstring("Add Barcode", f"Scan or type a barcode for {self.current_medicine[1]}:",
+                                      parent=self.frame)
+        if not code or not code.strip():
+            return
+        try:
+            medicine_id = self.current_medicine[0]
+            MedicineBarcode.add(medicine_id, normalize_gtin(code))
+            if self.barcodes is not None:
+                # Scannable right away rather than after the next reload
+                medicine = Medicine.get_many([medicine_id], ("name", "price"))[medicine_id]
+                self.barcodes.add(code, {'medicine_id': medicine_id, 'name': medicine['name'],
+                                         'price': medicine['price']})
+            messagebox.showinfo("Success", "Barcode added successfully")
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to add barcode: {str(e)}")
+
     def delete_medicine(self):
         """Delete selected medicine"""
         if not self.current_medicine or not messagebox.askyesno(
@@ -147,7 +192,7 @@ class MedicineDialog(tk.Toplevel):
     def __init__(self, parent, title, initial_data=None):
         super().__init__(parent)
         self.title(title)
-        self.geometry("500x400")
+        self.geometry("500x440")
         self.resizable(False, False)
         self.result = None
         
@@ -160,6 +205,7 @@ class MedicineDialog(tk.Toplevel):
             ("Manufacturer", "manufacturer", False),
             ("Batch Number", "batch_number", False),
             ("Category", "category", False),
+            ("Active Ingredient", "active_ingredient", False),
             ("Description", "description", False)
         ]
         
@@ -213,6 +259,7 @@ class MedicineDialog(tk.Toplevel):
                 'manufacturer': self.entries['manufacturer'].get() or None,
                 'batch_number': self.entries['batch_number'].get() or None,
                 'category': self.entries['category'].get() or None,
+                'active_ingredient': self.entries['active_ingredient'].get().strip().lower() or None,
                 'description': self.entries['description'].get() or None,
                 'supplier_id': int(self.supplier_combo.get().split(" - ")[0]) if self.supplier_combo.get() else None
             }
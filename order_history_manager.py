@@ -0,0 +1,157 @@
+import tkinter as tk
+from tkinter import ttk, messagebox
+from datetime import datetime, timedelta
+from database import Order, Customer, Employee
+
+class OrderHistoryManager:
+    """Browse past orders a page at a time; an order's items load when it is expanded"""
+
+    PAGE_SIZE = 50
+
+    def __init__(self, parent_frame):
+        self.frame = ttk.Frame(parent_frame)
+        # Cursor that starts each page seen so far, for going back
+        self.page_cursors = [None]
+        self.next_cursor = None
+        self.loaded_items = set()
+        self.setup_ui()
+
+    def setup_ui(self):
+        filter_frame = ttk.LabelFrame(self.frame, text="Filter", padding=10)
+        filter_frame.pack(fill="x", padx=10, pady=10)
+
+        ttk.Label(filter_frame, text="Customer:").grid(row=0, column=0, sticky="e")
+        self.customer_combo = ttk.Combobox(filter_frame, state="readonly")
+        self.customer_combo.grid(row=0, column=1, padx=5, pady=5)
+
+        ttk.Label(filter_frame, text="Employee:").grid(row=0, column=2, sticky="e")
+        self.employee_combo = ttk.Combobox(filter_frame, state="readonly")
+        self.employee_combo.grid(row=0, column=3, padx=5, pady=5)
+
+        ttk.Label(filter_frame, text="Order Type:").grid(row=0, column=4, sticky="e")
+        self.order_type_combo = ttk.Combobox(filter_frame, state="readonly",
+                                             values=["", "Retail", "Wholesale", "Online"])
+        self.order_type_combo.grid(row=0, column=5, padx=5, pady=5)
+
+        ttk.Label(filter_frame, text="From (YYYY-MM-DD):").grid(row=1, column=0, sticky="e")
+        self.start_entry = ttk.Entry(filter_frame)
+        self.start_entry.grid(row=1, column=1, padx=5, pady=5)
+
+        ttk.Label(filter_frame, text="To (YYYY-MM-DD):").grid(row=1, column=2, sticky="e")
+        self.end_entry = ttk.Entry(filter_frame)
+        self.end_entry.grid(row=1, column=3, padx=5, pady=5)
+
+        ttk.Button(filter_frame, text="Search", command=self.search).grid(row=1, column=5, pady=5)
+
+        self.tree = ttk.Treeview(self.frame, columns=("Date", "Customer", "Employee", "Type", "Total"),
+                                 show="tree headings")
+        self.tree.heading("#0", text="Order / Item")
+        self.tree.column("#0", width=220)
+        columns = [
+            ("Date", "Date", 150),
+            ("Customer", "Customer", 150),
+            ("Employee", "Employee", 150),
+            ("Type", "Type / Qty", 100),
+            ("Total", "Total", 100)
+        ]
+        for col_id, col_text, width in columns:
+            self.tree.heading(col_id, text=col_text)
+            self.tree.column(col_id, width=width, anchor="center")
+        self.tree.pack(fill="both", expand=True, padx=10, pady=5)
+        self.tree.bind("<<TreeviewOpen>>", self.on_order_open)
+
+        nav_frame = ttk.Frame(self.frame)
+        nav_frame.pack(fill="x", padx=10, pady=10)
+        self.prev_btn = ttk.Button(nav_frame, text="< Newer", state=tk.DISABLED, command=self.prev_page)
+        self.prev_btn.pack(side="left", padx=5)
+        self.page_label = ttk.Label(nav_frame, text="Page 1")
+        self.page_label.pack(side="left", padx=5)
+        self.next_btn = ttk.Button(nav_frame, text="Older >", state=tk.DISABLED, command=self.next_page)
+        self.next_btn.pack(side="left", padx=5)
+
+        self.load_combos()
+        self.search()
+
+    def load_combos(self):
+        try:
+            customers = Customer.get_all()
+            self.customer_combo['values'] = [""] + [f"{c['customer_id']} - {c['name']}" for c in customers]
+            employees = Employee.get_all()
+            self.employee_combo['values'] = [""] + [f"{e['employee_id']} - {e['name']}" for e in employees]
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load filters: {str(e)}")
+
+    def filters(self) -> dict:
+        customer = self.customer_combo.get()
+        employee = self.employee_combo.get()
+        start = self.start_entry.get().strip()
+        end = self.end_entry.get().strip()
+        return {
+            'customer_id': int(customer.split(" - ")[0]) if customer else None,
+            'employee_id': int(employee.split(" - ")[0]) if employee else None,
+            'order_type': self.order_type_combo.get() or None,
+            'start': datetime.strptime(start, "%Y-%m-%d") if start else None,
+            # The end date is inclusive in the form
+            'end': datetime.strptime(end, "%Y-%m-%d") + timedelta(days=1) if end else None
+        }
+
+    def search(self):
+        self.page_cursors = [None]
+        self.show_page()
+
+    def next_page(self):
+        if self.next_cursor:
+            self.page_cursors.append(self.next_cursor)
+            self.show_page()
+
+    def prev_page(self):
+        if len(self.page_cursors) > 1:
+            self.page_cursors.pop()
+            self.show_page()
+
+    def show_page(self):
+        try:
+            orders, self.next_cursor = Order.history(after=self.page_cursors[-1], limit=self.PAGE_SIZE,
+                                                     **self.filters())
+        except ValueError:
+            messagebox.showerror("Error", "Dates must be in YYYY-MM-DD format")
+            return
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load orders: {str(e)}")
+            return
+
+        self.tree.delete(*self.tree.get_children())
+        self.loaded_items = set()
+        for order in orders:
+            iid = str(order['order_id'])
+            self.tree.insert("", "end", iid=iid, text=f"Order #{order['order_id']}", values=(
+                order['order_date'].strftime("%Y-%m-%d %H:%M"),
+                order['customer_name'] or "N/A",
+                order['employee_name'] or "N/A",
+                order['order_type'] or "N/A",
+                f"${order['total_amount']:.2f}"
+            ))
+            # Placeholder so the order can be expanded before its items are read
+            self.tree.insert(iid, "end", text="Loading...")
+
+        page = len(self.page_cursors)
+        self.page_label.config(text=f"Page {page}")
+        self.prev_btn.config(state=tk.NORMAL if page > 1 else tk.DISABLED)
+        self.next_btn.config(state=tk.NORMAL if self.next_cursor else tk.DISABLED)
+
+    def on_order_open(self, event=None):
+        iid = self.tree.focus()
+        if not iid or self.tree.parent(iid) or iid in self.loaded_items:
+            return
+        try:
+            items = Order.get_items(int(iid))
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load order items: {str(e)}")
+            return
+
+        self.tree.delete(*self.tree.get_children(iid))
+        for item in items:
+            self.tree.insert(iid, "end", text=f"{item['name']} @ ${item['unit_price']:.2f}", values=(
+                "", "", "", item['quantity'], f"${item['subtotal']:.2f}"
+            ))
+        self.loaded_items.add(iid)
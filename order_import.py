@@ -0,0 +1,228 @@
+"""Bulk import of wholesale orders from a CSV order sheet.
+
+The file needs a header row with ``order_ref``, ``customer_id``,
+``medicine_id`` and ``quantity``; ``employee_id`` and ``order_type`` are
+optional. Lines of one order must be contiguous::
+
+    python order_import.py orders.csv --rejects orders_rejects.csv
+"""
+import argparse
+import csv
+import hashlib
+import logging
+import os
+import uuid
+from datetime import datetime
+from typing import Dict, Iterator, List
+from database import Database, DatabaseUnavailableError, Medicine, MedicineLot, Order
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_COLUMNS = ("order_ref", "customer_id", "medicine_id", "quantity")
+
+def file_digest(path: str) -> str:
+    """SHA-256 of a file's contents, read in 1 MiB chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_orders(path: str) -> Iterator[Dict]:
+    """Yield one order at a time as {'ref', 'lines': [(line_no, row)]}"""
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        missing = set(REQUIRED_COLUMNS) - set(reader.fieldnames or ())
+        if missing:
+            raise ValueError(f"Missing column(s): {', '.join(sorted(missing))}")
+        order = None
+        for line_no, row in enumerate(reader, start=2):
+            if order is None or row['order_ref'] != order['ref']:
+                if order:
+                    yield order
+                order = {'ref': row['order_ref'], 'lines': []}
+            order['lines'].append((line_no, row))
+        if order:
+            yield order
+
+class OrderImporter:
+    """Streams an order sheet into orders, a batch of lines at a time.
+
+    Each batch is validated with one medicine lookup and one availability
+    query, then written in one transaction through
+    Order.create_with_details. An order with any bad line is rejected as a
+    whole and all of its lines go to the reject file with a reason. Orders
+    are keyed by import_id (by default a hash of the file's contents) and
+    order_ref, so importing the same file again skips the orders that
+    already went in and counts them as already imported, while a new sheet
+    that reuses refs gets new keys. Pass the same import_id to resume a
+    sheet that was edited after a partial import. Memory holds batch_size
+    lines plus the largest single order, and the set of order_refs seen so
+    far, which grows with the number of orders in the sheet: a repeated ref
+    would share its key with the earlier order, and from the database alone
+    it cannot be told apart from an order imported by an earlier run.
+    """
+
+    def __init__(self, path: str, reject_path: str = None, batch_size: int = 1000, employee_id: int = None,
+                 import_id: str = None):
+        self.path = path
+        self.reject_path = reject_path or os.path.splitext(path)[0] + "_rejects.csv"
+        self.batch_size = batch_size
+        self.employee_id = employee_id
+        self.import_id = import_id
+        self.stats = {'orders': 0, 'lines': 0, 'already_imported': 0, 'rejected_orders': 0, 'rejected_lines': 0}
+        self._rejects = None
+        self._refs = set()
+
+    def run(self) -> Dict:
+        if not self.import_id:
+            self.import_id = file_digest(self.path)
+        with open(self.reject_path, "w", newline="", encoding="utf-8") as reject_file:
+            self._rejects = csv.writer(reject_file)
+            self._rejects.writerow(["line", "order_ref", "medicine_id", "quantity", "reason"])
+            batch, batch_lines = [], 0
+            for order in read_orders(self.path):
+                batch.append(order)
+                batch_lines += len(order['lines'])
+                if batch_lines >= self.batch_size:
+                    self.import_batch(batch)
+                    batch, batch_lines = [], 0
+            if batch:
+                self.import_batch(batch)
+        return self.stats
+
+    def order_key(self, ref: str) -> str:
+        return uuid.uuid5(uuid.NAMESPACE_URL, f"order-import:{self.import_id}:{ref}").hex
+
+    def import_batch(self, batch: List[Dict]):
+        parsed = [self.parse(order) for order in batch]
+        done = Order.find_by_keys([order['key'] for order in parsed if order])
+        parsed = [order if order and order['key'] not in done else None for order in parsed]
+        self.stats['already_imported'] += len(done)
+        ids = list({line['medicine_id'] for order in parsed if order for line in order['items']})
+        medicines = Medicine.get_many(ids, ("name", "price"))
+        available = MedicineLot.availability(ids)
+
+        ready = []
+        for raw, order in zip(batch, parsed):
+            if order is None:
+                continue
+            reason = self.check(order, medicines, available)
+            if reason:
+                self.reject(raw, reason)
+                continue
+            for item in order['items']:
+                item['price'] = medicines[item['medicine_id']]['price']
+                item['subtotal'] = item['price'] * item['quantity']
+                available[item['medicine_id']] -= item['quantity']
+            ready.append((raw, order))
+
+        try:
+            with Database.transaction() as cursor:
+                for raw, order in ready:
+                    Order.create_with_details(self.order_data(order), order['items'], cursor=cursor)
+        except DatabaseUnavailableError:
+            raise
+        except Exception as e:
+            # Stock moved since it was checked, or a customer does not
+            # exist; go one order at a time so only the failing ones are
+            # rejected
+            logger.warning("Batch import from %s failed (%s); retrying order by order", self.path, e)
+            ready = self.import_one_by_one(ready)
+
+        for raw, order in ready:
+            self.stats['orders'] += 1
+            self.stats['lines'] += len(order['items'])
+
+    def import_one_by_one(self, ready: List[tuple]) -> List[tuple]:
+        imported = []
+        for raw, order in ready:
+            try:
+                Order.create_with_details(self.order_data(order), order['items'])
+                imported.append((raw, order))
+            except DatabaseUnavailableError:
+                raise
+            except Exception as e:
+                self.reject(raw, str(e))
+        return imported
+
+    def parse(self, order: Dict):
+        items = []
+        if order['ref'] in self._refs:
+            # Would share the earlier order's key and be dropped as a repeat
+            self.reject(order, "order_ref used by an earlier order in the file")
+            return None
+        self._refs.add(order['ref'])
+        # Short rows come back from DictReader with None in the missing columns
+        first = order['lines'][0][1]
+        try:
+            customer_id = int(first['customer_id'])
+        except (TypeError, ValueError):
+            self.reject(order, "invalid customer_id")
+            return None
+        try:
+            employee_id = int(first['employee_id']) if first.get('employee_id') else self.employee_id
+        except ValueError:
+            self.reject(order, "invalid employee_id")
+            return None
+        for line_no, row in order['lines']:
+            try:
+                medicine_id, quantity = int(row['medicine_id']), int(row['quantity'])
+            except (TypeError, ValueError):
+                self.reject(order, f"line {line_no}: medicine_id and quantity must be whole numbers")
+                return None
+            if quantity <= 0:
+                self.reject(order, f"line {line_no}: quantity must be positive")
+                return None
+            items.append({'medicine_id': medicine_id, 'quantity': quantity, 'line_no': line_no})
+        return {
+            'ref': order['ref'],
+            'key': self.order_key(order['ref']),
+            'customer_id': customer_id,
+            'employee_id': employee_id,
+            'order_type': first.get('order_type') or "Wholesale",
+            'items': items
+        }
+
+    @staticmethod
+    def check(order: Dict, medicines: Dict, available: Dict):
+        """Reason the order cannot be placed from what is left in this batch, or None"""
+        wanted = {}
+        for item in order['items']:
+            if item['medicine_id'] not in medicines:
+                return f"line {item['line_no']}: unknown medicine {item['medicine_id']}"
+            wanted[item['medicine_id']] = wanted.get(item['medicine_id'], 0) + item['quantity']
+        for medicine_id, quantity in wanted.items():
+            if quantity > available.get(medicine_id, 0):
+                return f"not enough stock for {medicines[medicine_id]['name']}"
+        return None
+
+    def order_data(self, order: Dict) -> Dict:
+        return {
+            'customer_id': order['customer_id'],
+            'employee_id': order['employee_id'],
+            'order_type': order['order_type'],
+            'order_date': datetime.now(),
+            'total_amount': sum(item['subtotal'] for item in order['items']),
+            'idempotency_key': order['key']
+        }
+
+    def reject(self, order: Dict, reason: str):
+        self.stats['rejected_orders'] += 1
+        for line_no, row in order['lines']:
+            self.stats['rejected_lines'] += 1
+            self._rejects.writerow([line_no, row['order_ref'], row['medicine_id'], row['quantity'], reason])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="CSV order sheet")
+    parser.add_argument("--rejects", help="where to write rejected lines (default: <path>_rejects.csv)")
+    parser.add_argument("--batch-size", type=int, default=1000, help="lines per transaction")
+    parser.add_argument("--employee-id", type=int, help="employee for orders without one")
+    parser.add_argument("--import-id", help="key orders by this id instead of a hash of the file")
+    args = parser.parse_args()
+
+    stats = OrderImporter(args.path, args.rejects, args.batch_size, args.employee_id, args.import_id).run()
+    print(f"Imported {stats['orders']} orders ({stats['lines']} lines), "
+          f"{stats['already_imported']} already imported; "
+          f"rejected {stats['rejected_orders']} orders ({stats['rejected_lines']} lines)")
@@ -1,14 +1,33 @@
+import queue
+import threading
 import tkinter as tk
-from tkinter import ttk, messagebox
+from tkinter import ttk, messagebox, filedialog
 from datetime import datetime
-from database import Order, Medicine, Customer, Employee
+from database import Order, Medicine, MedicineLot, Employee, DatabaseUnavailableError
+from pos_journal import PosJournal, new_key
+from order_import import OrderImporter
+from interactions import InteractionIndex, describe
+from prescription_manager import OpenPrescriptionsPanel
+from customer_manager import CustomerSelector
 
 class OrderManager:
-    def __init__(self, parent_frame):
+    def __init__(self, parent_frame, journal: PosJournal = None, interactions: InteractionIndex = None):
         self.frame = ttk.Frame(parent_frame)
         self.current_order = None
         self.order_items = []
+        # One key per order as it stands, so a double click or a retry after
+        # a timeout returns the order that was already saved; any change to
+        # the items or the customer takes a new one
+        self.order_key = new_key()
+        self.journal = journal or PosJournal()
+        self.interactions = interactions or InteractionIndex()
         self.setup_ui()
+        self.frame.after(500, self.poll_journal)
+        if not self.interactions.loaded:
+            try:
+                self.interactions.refresh()
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to load interaction rules: {str(e)}")
 
     def setup_ui(self):
         # Main frames
@@ -19,9 +38,9 @@ class OrderManager:
         order_info_frame = ttk.LabelFrame(top_frame, text="Order Information", padding=10)
         order_info_frame.pack(side="left", fill="y", padx=5)
         
-        ttk.Label(order_info_frame, text="Customer:").grid(row=0, column=0, sticky="e")
-        self.customer_combo = ttk.Combobox(order_info_frame, state="readonly")
-        self.customer_combo.grid(row=0, column=1, pady=5)
+        ttk.Label(order_info_frame, text="Customer:").grid(row=0, column=0, sticky="ne")
+        self.customer_selector = CustomerSelector(order_info_frame, on_select=self.on_customer_selected, width=25)
+        self.customer_selector.grid(row=0, column=1, pady=5)
         
         ttk.Label(order_info_frame, text="Employee:").grid(row=1, column=0, sticky="e")
         self.employee_combo = ttk.Combobox(order_info_frame, state="readonly")
@@ -48,6 +67,10 @@ class OrderManager:
         ttk.Button(add_item_frame, text="Add Item", 
                   command=self.add_item).grid(row=2, column=1, pady=5)
         
+        # Lines the selected customer can have filled with this order
+        self.prescriptions_panel = OpenPrescriptionsPanel(self.frame, self.dispense_prescription)
+        self.prescriptions_panel.pack(fill="x", padx=10, pady=5)
+        
         # Order items treeview
         items_frame = ttk.LabelFrame(self.frame, text="Order Items", padding=10)
         items_frame.pack(fill="both", expand=True, padx=10, pady=5)
@@ -75,6 +98,8 @@ class OrderManager:
         
         self.total_label = ttk.Label(bottom_frame, text="Total: $0.00", font=("Arial", 12, "bold"))
         self.total_label.pack(side="left", padx=5)
+        self.sync_status = ttk.Label(bottom_frame, text="")
+        self.sync_status.pack(side="left", padx=5)
         
         ttk.Button(bottom_frame, text="New Order", 
                   command=self.new_order).pack(side="left", padx=5)
@@ -82,16 +107,14 @@ class OrderManager:
                   command=self.save_order).pack(side="left", padx=5)
         ttk.Button(bottom_frame, text="Delete Item", 
                   command=self.delete_item).pack(side="right", padx=5)
+        ttk.Button(bottom_frame, text="Import CSV", 
+                  command=self.import_orders).pack(side="right", padx=5)
         
         # Load initial data
         self.load_combos()
         self.new_order()
 
     def load_combos(self):
-        # Load customers
-        customers = Customer.get_all()
-        self.customer_combo['values'] = [f"{c['customer_id']} - {c['name']}" for c in customers]
-        
         # Load employees
         employees = Employee.get_all()
         self.employee_combo['values'] = [f"{e['employee_id']} - {e['name']}" for e in employees]
@@ -100,10 +123,56 @@ class OrderManager:
         medicines = Medicine.get_all()
         self.medicine_combo['values'] = [f"{m['medicine_id']} - {m['name']}" for m in medicines]
 
+    def import_orders(self):
+        """Import a wholesale order sheet on a worker thread"""
+        path = filedialog.askopenfilename(title="Import Orders",
+                                          filetypes=[("CSV files", "*.csv"), ("All files", "*.*")])
+        if not path:
+            return
+        importer = OrderImporter(path)
+        result = {}
+
+        def run():
+            try:
+                result['stats'] = importer.run()
+            except Exception as e:
+                result['error'] = e
+
+        worker = threading.Thread(target=run, name="order-import", daemon=True)
+        worker.start()
+        self.poll_import(worker, importer, result)
+
+    def poll_import(self, worker, importer, result):
+        if worker.is_alive():
+            self.frame.after(500, self.poll_import, worker, importer, result)
+            return
+        if 'error' in result:
+            messagebox.showerror("Error", f"Import failed: {result['error']}")
+            return
+        stats = result['stats']
+        messagebox.showinfo("Import Finished",
+                            f"Imported {stats['orders']} orders ({stats['lines']} lines), "
+                            f"{stats['already_imported']} already imported.\n"
+                            f"Rejected {stats['rejected_orders']} orders ({stats['rejected_lines']} lines), "
+                            f"see {importer.reject_path}")
+
+    def poll_journal(self):
+        """Show what became of orders saved offline once the journal replays them"""
+        while True:
+            try:
+                key, kind, status, detail = self.journal.events['order'].get_nowait()
+            except queue.Empty:
+                break
+            if status == PosJournal.REPLAYED:
+                self.sync_status.config(text=f"Offline order synced as order #{detail['remote_id']}")
+            elif status == PosJournal.CONFLICT:
+                self.sync_status.config(text=f"Offline order {key[:8]} could not be synced: {detail['detail']}")
+        self.frame.after(500, self.poll_journal)
+
     def new_order(self):
         self.order_items = []
         self.update_items_tree()
-        self.customer_combo.set('')
+        self.customer_selector.clear()
         self.employee_combo.set('')
         self.order_type_combo.current(0)
         self.total_label.config(text="Total: $0.00")
@@ -124,15 +193,23 @@ class OrderManager:
                 raise ValueError("Quantity must be positive")
             
             # Get medicine details
-            med = Medicine.get_by_id(medicine_id)
+            med = Medicine.get_many([medicine_id], ("name", "price")).get(medicine_id)
             if not med:
                 messagebox.showerror("Error", "Medicine not found")
                 return
             
-            if quantity > med['quantity']:
-                messagebox.showerror("Error", f"Only {med['quantity']} available in stock")
+            available = MedicineLot.availability([medicine_id])[medicine_id]
+            if quantity > available:
+                messagebox.showerror("Error", f"Only {available} available in stock")
                 return
             
+            basket = [item['medicine_id'] for item in self.order_items]
+            if medicine_id not in basket:
+                findings = self.interactions.check(basket + [medicine_id], added=[medicine_id])
+                if findings and not messagebox.askyesno("Interaction Warning",
+                                                        describe(findings) + "\n\nAdd it anyway?"):
+                    return
+            
             # Add to order items
             self.order_items.append({
                 'medicine_id': medicine_id,
@@ -149,7 +226,42 @@ class OrderManager:
         except ValueError as e:
             messagebox.showerror("Error", f"Invalid input: {str(e)}")
 
+    def on_customer_selected(self, customer=None):
+        self.order_key = new_key()
+        self.prescriptions_panel.show(customer['customer_id'] if customer else None)
+
+    def dispense_prescription(self, line):
+        """Add one fill of a prescription line; the fill is used up when the order is saved"""
+        if any(item.get('prescription_item_id') == line['item_id'] for item in self.order_items):
+            messagebox.showwarning("Warning", "This prescription line is already on the order")
+            return
+        try:
+            available = MedicineLot.availability([line['medicine_id']])[line['medicine_id']]
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to check stock: {str(e)}")
+            return
+        if line['quantity'] > available:
+            messagebox.showerror("Error", f"Only {available} available in stock")
+            return
+        basket = [item['medicine_id'] for item in self.order_items]
+        if line['medicine_id'] not in basket:
+            findings = self.interactions.check(basket + [line['medicine_id']], added=[line['medicine_id']])
+            if findings and not messagebox.askyesno("Interaction Warning",
+                                                    describe(findings) + "\n\nAdd it anyway?"):
+                return
+        self.order_items.append({
+            'medicine_id': line['medicine_id'],
+            'name': line['name'],
+            'quantity': line['quantity'],
+            'price': float(line['price']),
+            'subtotal': float(line['price']) * line['quantity'],
+            'prescription_item_id': line['item_id']
+        })
+        self.update_items_tree()
+
     def update_items_tree(self):
+        # Every change to the items goes through here
+        self.order_key = new_key()
         for row in self.items_tree.get_children():
             self.items_tree.delete(row)
         
@@ -180,32 +292,46 @@ class OrderManager:
             messagebox.showwarning("Warning", "No items in order")
             return
         
-        customer = self.customer_combo.get()
+        if self.customer_selector.typed():
+            messagebox.showerror("Error", "Choose the customer from the list, or clear the field")
+            return
         employee = self.employee_combo.get()
         
         try:
-            customer_id = int(customer.split(" - ")[0]) if customer else None
+            customer_id = self.customer_selector.customer_id
             employee_id = int(employee.split(" - ")[0]) if employee else None
             
             order_data = {
                 'customer_id': customer_id,
                 'employee_id': employee_id,
                 'order_type': self.order_type_combo.get(),
+                'order_date': datetime.now(),
                 'total_amount': sum(item['subtotal'] for item in self.order_items)
             }
+            key = self.order_key
             
-            # Create order with items
-            order_id = Order.create_with_details(order_data, self.order_items)
-            
-            # Update medicine quantities
-            for item in self.order_items:
-                if not Medicine.reduce_stock(item['medicine_id'], item['quantity']):
-                    raise Exception(f"Failed to update stock for {item['name']}")
-            
-            # Update customer loyalty points (10 points per $1 spent)
-            if customer_id:
-                points = int(order_data['total_amount'] * 10)
-                Customer.add_loyalty_points(customer_id, points)
+            try:
+                # Re-check the whole basket against current stock in one pass
+                basket = {}
+                for item in self.order_items:
+                    basket[item['medicine_id']] = basket.get(item['medicine_id'], 0) + item['quantity']
+                medicines = Medicine.get_many(list(basket), ("name",))
+                available = MedicineLot.availability(list(basket))
+                short = [medicines[medicine_id]['name'] if medicine_id in medicines else str(medicine_id)
+                         for medicine_id, quantity in basket.items() if quantity > available.get(medicine_id, 0)]
+                if short:
+                    messagebox.showerror("Error", f"Not enough stock for: {', '.join(short)}")
+                    return
+                
+                # Create order with items; stock is taken out in the same transaction
+                order_id = Order.create_with_details(dict(order_data, idempotency_key=key), self.order_items)
+            except DatabaseUnavailableError:
+                # Kept locally and replayed under the same key once the server is
+                # back; MedicineLot.take checks the stock again on replay
+                self.journal.append('order', key, {'order': order_data, 'items': self.order_items})
+                messagebox.showinfo("Saved Offline", "Database unavailable: the order was saved locally and will sync")
+                self.new_order()
+                return
             
             messagebox.showinfo("Success", f"Order #{order_id} created successfully")
             self.new_order()
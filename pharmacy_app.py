@@ -1,13 +1,17 @@
 import tkinter as tk
 from tkinter import messagebox, ttk
 from ttkthemes import ThemedTk
-from datetime import datetime, timedelta
 from customer_manager import CustomerManager
 from supplier_manager import SupplierManager
 from medicine_manager import MedicineManager
 from sales_manager import SalesManager
 from logintoapp import LoginWindow
-from database import Database
+from database import Database, StockMovement, LoyaltyLedger
+from scheduler import BackgroundScheduler
+from expiry_monitor import ExpiryMonitor, ExpiryAlertPanel
+from receipt_archive import ReceiptArchive
+from pos_journal import PosJournal
+from barcode_index import BarcodeIndex
 
 class PharmacyApp:
     def __init__(self, root):
@@ -43,7 +47,8 @@ class PharmacyApp:
             ("Medicine Management", self.show_medicine_management),
             ("Sales and Billing", self.show_sales_and_billing),
             ("Customer Management", self.show_customer_management),
-            ("Supplier Management", self.show_supplier_management)
+            ("Supplier Management", self.show_supplier_management),
+            ("Expiry Alerts", self.show_expiry_alerts)
         ]
         
         for text, command in buttons:
@@ -57,31 +62,31 @@ class PharmacyApp:
         self.main_frame.pack(side="left", fill="both", expand=True, padx=10, pady=10)
 
         # Initialize all managers
-        self.medicine_manager = MedicineManager(self.main_frame)
-        self.sales_manager = SalesManager(self.main_frame)
+        # Barcodes registered on the medicine screen go straight into the counter's index
+        self.barcodes = BarcodeIndex()
+        self.medicine_manager = MedicineManager(self.main_frame, self.barcodes)
+        self.journal = PosJournal()
+        self.sales_manager = SalesManager(self.main_frame, journal=self.journal, barcodes=self.barcodes)
         self.customer_manager = CustomerManager(self.main_frame)
         self.supplier_manager = SupplierManager(self.main_frame)
 
+        # Expiry alerts are computed in the background and shown in a panel
+        self.expiry_monitor = ExpiryMonitor(warn_days=30)
+        self.expiry_panel = ExpiryAlertPanel(self.main_frame, self.expiry_monitor)
+
         # Show default view
         self.show_medicine_management()
-        self.check_expiration_alerts()
 
-    def check_expiration_alerts(self):
-        """Check for medicines nearing expiration"""
-        try:
-            today = datetime.now().date()
-            alert_date = today + timedelta(days=30)
-            query = "SELECT name, expiry_date FROM medicines WHERE expiry_date <= %s"
-            expiring_medicines = Database.execute_query(query, (alert_date,), fetch=True)
-
-            if expiring_medicines:
-                alert_message = "The following medicines are nearing expiration:\n\n"
-                for medicine in expiring_medicines:
-                    days_left = (medicine['expiry_date'] - today).days
-                    alert_message += f"{medicine['name']} (Expires on: {medicine['expiry_date']}, {days_left} days left)\n"
-                messagebox.showwarning("Expiration Alert", alert_message)
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to check expiration alerts: {str(e)}")
+        # Background maintenance
+        self.scheduler = BackgroundScheduler()
+        self.scheduler.every(15 * 60, StockMovement.take_snapshots, "stock snapshots")
+        self.scheduler.every(5 * 60, LoyaltyLedger.fold, "loyalty fold")
+        self.scheduler.every(60 * 60, self.expiry_monitor.check, "expiry check", run_now=True)
+        self.scheduler.every(24 * 60 * 60, ReceiptArchive().pack_older_than, "receipt packing")
+        self.scheduler.every(30, self.journal.replay, "journal replay", run_now=True)
+        self.scheduler.every(5 * 60, self.barcodes.load, "barcode index")
+        self.scheduler.every(5 * 60, self.sales_manager.interactions.refresh, "interaction rules")
+        self.scheduler.start()
 
     def show_medicine_management(self):
         """Show medicine management interface"""
@@ -93,7 +98,6 @@ class PharmacyApp:
         self.hide_all_frames()
         self.sales_manager.frame.pack(fill="both", expand=True)
         self.sales_manager.load_medicine_names()
-        self.sales_manager.load_customer_names()
 
     def show_customer_management(self):
         """Show customer management interface"""
@@ -107,12 +111,18 @@ class PharmacyApp:
         self.supplier_manager.frame.pack(fill="both", expand=True)
         self.supplier_manager.load_suppliers()
 
+    def show_expiry_alerts(self):
+        """Show medicines that are expired or nearing expiration"""
+        self.hide_all_frames()
+        self.expiry_panel.pack(fill="both", expand=True)
+
     def hide_all_frames(self):
         """Hide all content frames"""
         self.medicine_manager.frame.pack_forget()
         self.sales_manager.frame.pack_forget()
         self.customer_manager.frame.pack_forget()
         self.supplier_manager.frame.pack_forget()
+        self.expiry_panel.pack_forget()
 
 if __name__ == "__main__":
     login_window = LoginWindow()
@@ -3,6 +3,8 @@ CREATE TABLE customers (
   customer_id int NOT NULL AUTO_INCREMENT,
   name varchar(100) NOT NULL,
   phone varchar(15) DEFAULT NULL,
+  -- phone with everything but the digits stripped, for prefix lookup
+  phone_digits varchar(15) DEFAULT NULL,
   email varchar(100) DEFAULT NULL,
   address text DEFAULT NULL,
   age int DEFAULT NULL,
@@ -11,7 +13,19 @@ CREATE TABLE customers (
   updated_at timestamp NULL DEFAULT NULL ON UPDATE current_timestamp(),
   PRIMARY KEY (customer_id),
   UNIQUE KEY email (email),
-  KEY name (name)
+  KEY name (name),
+  KEY phone_digits (phone_digits)
+);
+
+-- Lower-cased words of each customer's name with their SOUNDEX, so a name
+-- is found from any word's prefix or a misspelling of it
+CREATE TABLE customer_name_tokens (
+  token varchar(50) NOT NULL,
+  sound varchar(50) NOT NULL,
+  customer_id int NOT NULL,
+  PRIMARY KEY (token, customer_id),
+  KEY sound (sound, customer_id),
+  KEY customer_id (customer_id)
 );
 
 CREATE TABLE employees (
@@ -54,6 +68,7 @@ CREATE TABLE medicines (
   manufacturer varchar(100) DEFAULT NULL,
   batch_number varchar(50) DEFAULT NULL,
   category varchar(50) DEFAULT NULL,
+  active_ingredient varchar(100) DEFAULT NULL,
   description text DEFAULT NULL,
   supplier_id int DEFAULT NULL,
   created_at timestamp NOT NULL DEFAULT current_timestamp(),
@@ -62,7 +77,9 @@ CREATE TABLE medicines (
   KEY supplier_id (supplier_id),
   KEY name (name),
   KEY category (category),
-  KEY expiry_date (expiry_date)
+  KEY active_ingredient (active_ingredient),
+  KEY expiry_date (expiry_date),
+  KEY updated_at (updated_at)
 );
 
 CREATE TABLE stock (
@@ -70,11 +87,13 @@ CREATE TABLE stock (
   medicine_id int NOT NULL,
   quantity_in_stock int NOT NULL,
   reorder_level int NOT NULL,
+  below_reorder tinyint(1) GENERATED ALWAYS AS (quantity_in_stock <= reorder_level) STORED,
   last_updated date DEFAULT NULL,
   created_at timestamp NOT NULL DEFAULT current_timestamp(),
   updated_at timestamp NULL DEFAULT NULL ON UPDATE current_timestamp(),
   PRIMARY KEY (stock_id),
-  KEY medicine_id (medicine_id)
+  KEY medicine_id (medicine_id),
+  KEY below_reorder (below_reorder)
 );
 
 CREATE TABLE orders (
@@ -84,11 +103,15 @@ CREATE TABLE orders (
   order_type varchar(50) DEFAULT NULL,
   total_amount decimal(10, 2) NOT NULL,
   order_date timestamp NOT NULL DEFAULT current_timestamp(),
+  idempotency_key char(32) DEFAULT NULL,
   created_at timestamp NOT NULL DEFAULT current_timestamp(),
   updated_at timestamp NULL DEFAULT NULL ON UPDATE current_timestamp(),
   PRIMARY KEY (order_id),
-  KEY customer_id (customer_id),
-  KEY employee_id (employee_id)
+  UNIQUE KEY idempotency_key (idempotency_key),
+  KEY order_date (order_date),
+  KEY customer_date (customer_id, order_date),
+  KEY employee_date (employee_id, order_date),
+  KEY type_date (order_type, order_date)
 );
 
 CREATE TABLE order_items (
@@ -98,11 +121,13 @@ CREATE TABLE order_items (
   quantity int NOT NULL,
   unit_price decimal(10, 2) NOT NULL,
   subtotal decimal(10, 2) NOT NULL,
+  prescription_item_id int DEFAULT NULL,
   created_at timestamp NOT NULL DEFAULT current_timestamp(),
   updated_at timestamp NULL DEFAULT NULL ON UPDATE current_timestamp(),
   PRIMARY KEY (item_id),
   KEY order_id (order_id),
-  KEY medicine_id (medicine_id)
+  KEY medicine_id (medicine_id),
+  KEY prescription_item_id (prescription_item_id)
 );
 
 CREATE TABLE prescriptions (
@@ -116,7 +141,10 @@ CREATE TABLE prescriptions (
   created_at timestamp NOT NULL DEFAULT current_timestamp(),
   updated_at timestamp NULL DEFAULT NULL ON UPDATE current_timestamp(),
   PRIMARY KEY (prescription_id),
-  KEY customer_id (customer_id)
+  KEY issue_date (issue_date),
+  KEY customer_issue (customer_id, issue_date),
+  KEY customer_expiry (customer_id, expiry_date),
+  KEY doctor_issue (doctor_name, issue_date)
 );
 
 CREATE TABLE prescription_items (
@@ -126,6 +154,9 @@ CREATE TABLE prescription_items (
   quantity int NOT NULL,
   dosage varchar(50) DEFAULT NULL,
   instructions text DEFAULT NULL,
+  -- Refills allowed after the first fill, and fills still left to dispense
+  refills int NOT NULL DEFAULT 0,
+  fills_remaining int NOT NULL DEFAULT 1,
   created_at timestamp NOT NULL DEFAULT current_timestamp(),
   updated_at timestamp NULL DEFAULT NULL ON UPDATE current_timestamp(),
   PRIMARY KEY (item_id),
@@ -133,6 +164,169 @@ CREATE TABLE prescription_items (
   KEY medicine_id (medicine_id)
 );
 
+-- One row per bill; its lines are in sale_items
+CREATE TABLE sales (
+  sale_id int NOT NULL AUTO_INCREMENT,
+  customer_id int DEFAULT NULL,
+  sale_date datetime NOT NULL DEFAULT current_timestamp(),
+  subtotal decimal(10,2) NOT NULL,
+  tax decimal(10,2) NOT NULL,
+  total decimal(10,2) NOT NULL,
+  idempotency_key char(32) DEFAULT NULL,
+  created_at timestamp NOT NULL DEFAULT current_timestamp(),
+  PRIMARY KEY (sale_id),
+  UNIQUE KEY idempotency_key (idempotency_key),
+  KEY sale_date (sale_date),
+  KEY customer_date (customer_id, sale_date)
+);
+
+CREATE TABLE sale_items (
+  item_id int NOT NULL AUTO_INCREMENT,
+  sale_id int NOT NULL,
+  medicine_id int NOT NULL,
+  quantity int NOT NULL,
+  unit_price decimal(10,2) NOT NULL,
+  total_price decimal(10,2) NOT NULL,
+  -- The prescription line this bill line was dispensed against, if any
+  prescription_item_id int DEFAULT NULL,
+  PRIMARY KEY (item_id),
+  KEY sale_id (sale_id),
+  KEY medicine_sale (medicine_id, sale_id),
+  KEY prescription_item_id (prescription_item_id)
+);
+
+-- Barcodes (GTIN-14, zero padded) printed on a medicine's packs
+CREATE TABLE medicine_barcodes (
+  barcode varchar(32) NOT NULL,
+  medicine_id int NOT NULL,
+  created_at timestamp NOT NULL DEFAULT current_timestamp(),
+  PRIMARY KEY (barcode),
+  KEY medicine_id (medicine_id)
+);
+
+-- Price of each medicine over time; the open row (effective_to NULL) is the
+-- current price
+CREATE TABLE medicine_prices (
+  price_id bigint NOT NULL AUTO_INCREMENT,
+  medicine_id int NOT NULL,
+  price decimal(10,2) NOT NULL,
+  effective_from datetime NOT NULL,
+  effective_to datetime DEFAULT NULL,
+  PRIMARY KEY (price_id),
+  KEY medicine_effective (medicine_id, effective_from, price),
+  KEY open_price (effective_to, medicine_id)
+);
+
+-- Received lots of a medicine; open_expiry is NULL once a lot is used up so
+-- FEFO allocation and availability only ever walk lots that still hold stock
+CREATE TABLE medicine_lots (
+  lot_id int NOT NULL AUTO_INCREMENT,
+  medicine_id int NOT NULL,
+  batch_number varchar(50) DEFAULT NULL,
+  expiry_date date DEFAULT NULL,
+  quantity int NOT NULL DEFAULT 0,
+  open_expiry date GENERATED ALWAYS AS (IF(quantity > 0, COALESCE(expiry_date, '9999-12-31'), NULL)) STORED,
+  received_at timestamp NOT NULL DEFAULT current_timestamp(),
+  created_at timestamp NOT NULL DEFAULT current_timestamp(),
+  updated_at timestamp NULL DEFAULT NULL ON UPDATE current_timestamp(),
+  PRIMARY KEY (lot_id),
+  KEY fefo (medicine_id, open_expiry, quantity),
+  KEY medicine_expiry (medicine_id, expiry_date),
+  KEY open_expiry (open_expiry)
+);
+
+-- Append-only ledger of stock changes; quantity is a signed delta
+CREATE TABLE stock_movements (
+  movement_id bigint NOT NULL AUTO_INCREMENT,
+  medicine_id int NOT NULL,
+  lot_id int DEFAULT NULL,
+  movement_type enum('sale', 'order', 'receipt', 'adjustment', 'write_off') NOT NULL,
+  quantity int NOT NULL,
+  reference_id int DEFAULT NULL,
+  moved_at timestamp NOT NULL DEFAULT current_timestamp(),
+  PRIMARY KEY (movement_id),
+  KEY medicine_history (medicine_id, moved_at, quantity)
+);
+
+-- Periodic per-medicine fold of stock_movements up to last_movement_id
+CREATE TABLE stock_snapshots (
+  snapshot_id bigint NOT NULL AUTO_INCREMENT,
+  medicine_id int NOT NULL,
+  quantity int NOT NULL,
+  last_movement_id bigint NOT NULL,
+  taken_at timestamp NOT NULL DEFAULT current_timestamp(),
+  PRIMARY KEY (snapshot_id),
+  UNIQUE KEY medicine_movement (medicine_id, last_movement_id),
+  KEY medicine_taken (medicine_id, taken_at)
+);
+
+-- Loyalty points earned or adjusted; fold_batch stays NULL until the entry
+-- has been added to customers.loyalty_points
+CREATE TABLE loyalty_ledger (
+  entry_id bigint NOT NULL AUTO_INCREMENT,
+  customer_id int NOT NULL,
+  points int NOT NULL,
+  source enum('sale', 'order', 'adjustment') NOT NULL,
+  reference_id int DEFAULT NULL,
+  fold_batch bigint DEFAULT NULL,
+  created_at timestamp NOT NULL DEFAULT current_timestamp(),
+  PRIMARY KEY (entry_id),
+  KEY customer_pending (customer_id, fold_batch, points),
+  KEY fold_batch (fold_batch, customer_id, points)
+);
+
+-- Index of archived receipts; a receipt lives at path until its day is
+-- packed, after which it is segment_length bytes at segment_offset in
+-- segment_path (zlib compressed)
+CREATE TABLE receipts (
+  receipt_id bigint NOT NULL AUTO_INCREMENT,
+  sale_id int NOT NULL,
+  customer_id int DEFAULT NULL,
+  format varchar(10) NOT NULL,
+  issued_at datetime NOT NULL,
+  path varchar(255) NOT NULL,
+  size int NOT NULL,
+  segment_path varchar(255) DEFAULT NULL,
+  segment_offset bigint DEFAULT NULL,
+  segment_length int DEFAULT NULL,
+  created_at timestamp NOT NULL DEFAULT current_timestamp(),
+  PRIMARY KEY (receipt_id),
+  UNIQUE KEY sale_format (sale_id, format),
+  KEY customer_issued (customer_id, issued_at),
+  KEY issued_at (issued_at)
+);
+
+-- Receipts waiting to be rendered, or given up on after their retries; a
+-- row is removed once its receipt is archived, so a restart can queue the
+-- rest again
+CREATE TABLE receipt_jobs (
+  sale_id int NOT NULL,
+  format varchar(10) NOT NULL,
+  status enum('queued', 'failed') NOT NULL DEFAULT 'queued',
+  detail varchar(255) DEFAULT NULL,
+  updated_at timestamp NOT NULL DEFAULT current_timestamp() ON UPDATE current_timestamp(),
+  PRIMARY KEY (sale_id, format),
+  KEY format_status (format, status)
+);
+
+-- Pairs of active ingredients or categories that interact. A pair is stored
+-- once, smaller (type, value) first; rules are switched off with active = 0
+-- rather than deleted so terminals pick the change up by updated_at
+CREATE TABLE interaction_rules (
+  rule_id int NOT NULL AUTO_INCREMENT,
+  left_type enum('ingredient','category') NOT NULL,
+  left_value varchar(100) NOT NULL,
+  right_type enum('ingredient','category') NOT NULL,
+  right_value varchar(100) NOT NULL,
+  severity enum('minor','moderate','major') NOT NULL DEFAULT 'moderate',
+  description varchar(255) DEFAULT NULL,
+  active tinyint(1) NOT NULL DEFAULT 1,
+  updated_at timestamp NOT NULL DEFAULT current_timestamp() ON UPDATE current_timestamp(),
+  PRIMARY KEY (rule_id),
+  UNIQUE KEY pair (left_type, left_value, right_type, right_value),
+  KEY updated_at (updated_at)
+);
+
 -- Foreign key constraints
 
 -- Foreign key for medicines → suppliers
@@ -141,6 +335,12 @@ ADD FOREIGN KEY (supplier_id) REFERENCES suppliers(supplier_id)
 ON DELETE SET NULL 
 ON UPDATE CASCADE;
 
+-- customer_name_tokens → customers
+ALTER TABLE customer_name_tokens
+ADD FOREIGN KEY (customer_id) REFERENCES customers(customer_id)
+ON DELETE CASCADE
+ON UPDATE CASCADE;
+
 -- orders → customers
 ALTER TABLE orders
 ADD FOREIGN KEY (customer_id) REFERENCES customers(customer_id)
@@ -165,6 +365,12 @@ ADD FOREIGN KEY (medicine_id) REFERENCES medicines(medicine_id)
 ON DELETE CASCADE
 ON UPDATE CASCADE;
 
+-- order_items → prescription_items
+ALTER TABLE order_items
+ADD FOREIGN KEY (prescription_item_id) REFERENCES prescription_items(item_id)
+ON DELETE SET NULL
+ON UPDATE CASCADE;
+
 -- prescriptions → customers
 ALTER TABLE prescriptions
 ADD FOREIGN KEY (customer_id) REFERENCES customers(customer_id)
@@ -192,6 +398,86 @@ ON UPDATE CASCADE;
 
 
 
+-- sales → customers
+ALTER TABLE sales
+ADD FOREIGN KEY (customer_id) REFERENCES customers(customer_id)
+ON DELETE SET NULL
+ON UPDATE CASCADE;
+
+-- sale_items → sales
+ALTER TABLE sale_items
+ADD FOREIGN KEY (sale_id) REFERENCES sales(sale_id)
+ON DELETE CASCADE
+ON UPDATE CASCADE;
+
+-- sale_items → medicines
+ALTER TABLE sale_items
+ADD FOREIGN KEY (medicine_id) REFERENCES medicines(medicine_id)
+ON DELETE CASCADE
+ON UPDATE CASCADE;
+
+-- sale_items → prescription_items
+ALTER TABLE sale_items
+ADD FOREIGN KEY (prescription_item_id) REFERENCES prescription_items(item_id)
+ON DELETE SET NULL
+ON UPDATE CASCADE;
+
+-- medicine_barcodes → medicines
+ALTER TABLE medicine_barcodes
+ADD FOREIGN KEY (medicine_id) REFERENCES medicines(medicine_id)
+ON DELETE CASCADE
+ON UPDATE CASCADE;
+
+-- medicine_prices → medicines
+ALTER TABLE medicine_prices
+ADD FOREIGN KEY (medicine_id) REFERENCES medicines(medicine_id)
+ON DELETE CASCADE
+ON UPDATE CASCADE;
+
+-- medicine_lots → medicines
+ALTER TABLE medicine_lots
+ADD FOREIGN KEY (medicine_id) REFERENCES medicines(medicine_id)
+ON DELETE CASCADE
+ON UPDATE CASCADE;
+
+-- stock_movements → medicines
+ALTER TABLE stock_movements
+ADD FOREIGN KEY (medicine_id) REFERENCES medicines(medicine_id)
+ON DELETE CASCADE
+ON UPDATE CASCADE;
+
+-- stock_snapshots → medicines
+ALTER TABLE stock_snapshots
+ADD FOREIGN KEY (medicine_id) REFERENCES medicines(medicine_id)
+ON DELETE CASCADE
+ON UPDATE CASCADE;
+
+-- loyalty_ledger → customers
+ALTER TABLE loyalty_ledger
+ADD FOREIGN KEY (customer_id) REFERENCES customers(customer_id)
+ON DELETE CASCADE
+ON UPDATE CASCADE;
+
+-- receipts → sales
+ALTER TABLE receipts
+ADD FOREIGN KEY (sale_id) REFERENCES sales(sale_id)
+ON DELETE CASCADE
+ON UPDATE CASCADE;
+
+-- receipts → customers
+ALTER TABLE receipts
+ADD FOREIGN KEY (customer_id) REFERENCES customers(customer_id)
+ON DELETE SET NULL
+ON UPDATE CASCADE;
+
+-- receipt_jobs → sales
+ALTER TABLE receipt_jobs
+ADD FOREIGN KEY (sale_id) REFERENCES sales(sale_id)
+ON DELETE CASCADE
+ON UPDATE CASCADE;
+
+
+
 -- Sample data insertion
 INSERT INTO customers (name, phone, email, address, age, loyalty_points) VALUES
 ('John Doe', '1234567890', 'john.doe@example.com', '123 Main St, Cityville', 35, 100),
@@ -205,6 +491,14 @@ INSERT INTO customers (name, phone, email, address, age, loyalty_points) VALUES
 ('Daniel Lee', '9998887777', 'daniel.lee@example.com', '963 Walnut St, Riverside', 32, 80),
 ('Laura Harris', '6667778888', 'laura.harris@example.com', '159 Palm St, Countryside', 36, 95);
 
+UPDATE customers SET phone_digits = REGEXP_REPLACE(phone, '[^0-9]', '');
+
+-- The sample names are all "First Last"
+INSERT INTO customer_name_tokens (token, sound, customer_id)
+SELECT LOWER(SUBSTRING_INDEX(name, ' ', 1)), SOUNDEX(SUBSTRING_INDEX(name, ' ', 1)), customer_id FROM customers
+UNION
+SELECT LOWER(SUBSTRING_INDEX(name, ' ', -1)), SOUNDEX(SUBSTRING_INDEX(name, ' ', -1)), customer_id FROM customers;
+
 INSERT INTO employees (name, role, phone, email, salary, hire_date) VALUES
 ('Alice Johnson', 'Pharmacist', '5551234567', 'alice.johnson@example.com', 5000.00, '2022-01-10'),
 ('Bob Williams', 'Cashier', '5559876543', 'bob.williams@example.com', 3000.00, '2023-05-15'),
@@ -241,6 +535,15 @@ INSERT INTO medicines (name, quantity, price, expiry_date, manufacturer, batch_n
 ('Omeprazole', 300, 6.00, '2026-10-05', 'SafePharm', 'O74125', 'Acid Reducer', 'Treats heartburn and acid reflux', 9),
 ('Metformin', 500, 8.50, '2027-04-20', 'QuickMeds', 'M96325', 'Diabetes', 'Lowers blood sugar levels', 10);
 
+UPDATE medicines SET active_ingredient = LOWER(name)
+WHERE name IN ('Paracetamol', 'Amoxicillin', 'Ibuprofen', 'Cetirizine', 'Aspirin', 'Insulin', 'Omeprazole', 'Metformin');
+UPDATE medicines SET active_ingredient = 'ascorbic acid' WHERE name = 'Vitamin C';
+
+INSERT INTO interaction_rules (left_type, left_value, right_type, right_value, severity, description) VALUES
+('ingredient', 'aspirin', 'ingredient', 'ibuprofen', 'moderate', 'Ibuprofen blunts the antiplatelet effect of aspirin; both raise GI bleeding risk'),
+('category', 'diabetes', 'ingredient', 'aspirin', 'minor', 'High-dose aspirin can lower blood sugar'),
+('category', 'painkiller', 'category', 'painkiller', 'minor', 'Two painkillers on one bill');
+
 INSERT INTO stock (medicine_id, quantity_in_stock, reorder_level, last_updated) VALUES
 (1, 500, 50, '2025-03-30'),
 (2, 300, 40, '2025-03-30'),
@@ -253,6 +556,18 @@ INSERT INTO stock (medicine_id, quantity_in_stock, reorder_level, last_updated)
 (9, 300, 40, '2025-03-30'),
 (10, 500, 50, '2025-03-30');
 
+-- Opening price history from the sample prices
+INSERT INTO medicine_prices (medicine_id, price, effective_from)
+SELECT medicine_id, price, created_at FROM medicines;
+
+-- One opening lot per medicine from its batch number and expiry date
+INSERT INTO medicine_lots (medicine_id, batch_number, expiry_date, quantity, received_at)
+SELECT medicine_id, batch_number, expiry_date, quantity, '2025-03-30 00:00:00' FROM medicines;
+
+-- Opening balances so the ledger agrees with the sample quantities
+INSERT INTO stock_movements (medicine_id, lot_id, movement_type, quantity, moved_at)
+SELECT medicine_id, lot_id, 'adjustment', quantity, '2025-03-30 00:00:00' FROM medicine_lots;
+
 INSERT INTO orders (customer_id, employee_id, order_type, total_amount, order_date) VALUES
 (1, 1, 'In-Store', 25.50, '2025-03-28 10:30:00'),
 (2, 2, 'Online', 15.00, '2025-03-27 14:15:00'),
@@ -289,14 +604,14 @@ INSERT INTO prescriptions (customer_id, doctor_name, doctor_license, issue_date,
 (9, 'Dr. Roberts', 'D47592', '2025-03-07', '2025-06-07', 'Reduce salt intake'),
 (10, 'Dr. Anderson', 'D38475', '2025-03-06', '2025-06-06', 'Increase fluid intake');
 
-INSERT INTO prescription_items (prescription_id, medicine_id, quantity, dosage, instructions) VALUES
-(1, 1, 20, '500mg', 'Take twice daily'),
-(2, 3, 10, '200mg', 'Once daily before bed'),
-(3, 5, 15, '1000mg', 'Take with food'),
-(4, 2, 7, '250mg', 'Complete full course'),
-(5, 7, 30, '300mg', 'One tablet every morning'),
-(6, 4, 5, '10mg', 'Avoid driving'),
-(7, 6, 10, '15ml', 'Shake well before use'),
-(8, 8, 3, 'Units as needed', 'Monitor blood sugar'),
-(9, 9, 6, '40mg', 'Take before meals'),
-(10, 10, 14, '500mg', 'Take twice daily with meals');
\ No newline at end of file
+INSERT INTO prescription_items (prescription_id, medicine_id, quantity, dosage, instructions, refills, fills_remaining) VALUES
+(1, 1, 20, '500mg', 'Take twice daily', 0, 1),
+(2, 3, 10, '200mg', 'Once daily before bed', 1, 2),
+(3, 5, 15, '1000mg', 'Take with food', 0, 1),
+(4, 2, 7, '250mg', 'Complete full course', 0, 1),
+(5, 7, 30, '300mg', 'One tablet every morning', 5, 6),
+(6, 4, 5, '10mg', 'Avoid driving', 2, 3),
+(7, 6, 10, '15ml', 'Shake well before use', 0, 1),
+(8, 8, 3, 'Units as needed', 'Monitor blood sugar', 11, 12),
+(9, 9, 6, '40mg', 'Take before meals', 2, 3),
+(10, 10, 14, '500mg', 'Take twice daily with meals', 5, 6);
\ No newline at end of file
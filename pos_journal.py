@@ -0,0 +1,195 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+from decimal import Decimal
+from typing import Dict, List
+from mysql.connector import errorcode
+from database import Database, DatabaseUnavailableError, InsufficientStockError, Order, PrescriptionError, Sale
+
+logger = logging.getLogger(__name__)
+
+# Server errors that say nothing about the entry itself; it is retried on the next pass
+TRANSIENT_ERRORS = {errorcode.ER_LOCK_DEADLOCK, errorcode.ER_LOCK_WAIT_TIMEOUT}
+
+def new_key() -> str:
+    """Client-side idempotency key for one checkout"""
+    return uuid.uuid4().hex
+
+def _encode(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot journal {type(value).__name__}")
+
+def replay_sale(key: str, payload: Dict) -> int:
+    sale = dict(payload['sale'], idempotency_key=key)
+    sale['sale_date'] = datetime.fromisoformat(sale['sale_date'])
+    for field in ('subtotal', 'tax', 'total'):
+        sale[field] = Decimal(sale[field])
+    items = [dict(item, price=Decimal(item['price']), total=Decimal(item['total'])) for item in payload['items']]
+    return Sale.create_with_details(sale, items)
+
+def receipt_from_payload(payload: Dict) -> Dict:
+    """Rebuild the receipt journaled with an offline sale"""
+    receipt = dict(payload['receipt'])
+    receipt['issued_at'] = datetime.fromisoformat(receipt['issued_at'])
+    receipt['lines'] = [(name, quantity, Decimal(price), Decimal(total))
+                        for name, quantity, price, total in receipt['lines']]
+    for field in ('subtotal', 'tax', 'total'):
+        receipt[field] = Decimal(receipt[field])
+    return receipt
+
+def replay_order(key: str, payload: Dict) -> int:
+    order = dict(payload['order'], idempotency_key=key)
+    order['order_date'] = datetime.fromisoformat(order['order_date'])
+    return Order.create_with_details(order, payload['items'])
+
+class PosJournal:
+    """Local SQLite journal for checkouts made while the database is unreachable.
+
+    ``append`` commits a checkout to a WAL-mode SQLite file, which takes about
+    a millisecond and needs no server. ``replay`` (run from the
+    BackgroundScheduler) pushes pending entries to MySQL in batches, each
+    under its idempotency key so an entry that reached the server before a
+    crash is not written twice. Entries whose stock is no longer available,
+    or whose prescription fill was used up meanwhile, are marked
+    ``conflict`` and kept for review; a lost connection, a deadlock or a
+    lock wait timeout leaves the entry pending for the next pass. Outcomes are put on
+    ``self.events[kind]`` as (key, kind, status, detail) for the screen that
+    journals that kind to drain. The queues are bounded, so outcomes nobody
+    drains are dropped; the journal table still has them.
+    """
+
+    PENDING = "pending"
+    REPLAYED = "replayed"
+    CONFLICT = "conflict"
+
+    # Outcomes kept per kind for a screen to pick up
+    EVENT_BACKLOG = 1000
+
+    HANDLERS = {
+        'sale': replay_sale,
+        'order': replay_order,
+    }
+
+    def __init__(self, path: str = None, batch_size: int = 50):
+        self.path = path or os.path.join(os.getcwd(), "pos_journal.db")
+        self.batch_size = batch_size
+        self.events = {kind: queue.Queue(maxsize=self.EVENT_BACKLOG) for kind in self.HANDLERS}
+        self._local = threading.local()
+        self._replay_lock = threading.Lock()
+        with self._connection() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS journal (
+                     entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     idempotency_key TEXT NOT NULL UNIQUE,
+                     kind TEXT NOT NULL,
+                     payload TEXT NOT NULL,
+                     status TEXT NOT NULL DEFAULT 'pending',
+                     remote_id INTEGER,
+                     detail TEXT,
+                     created_at TEXT NOT NULL,
+                     replayed_at TEXT
+                   )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS journal_status ON journal (status, entry_id)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections cannot be shared across threads, and the UI and
+        # the scheduler both use the journal
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=5)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            # In WAL mode NORMAL survives an application crash and keeps
+            # commits at about a millisecond
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def append(self, kind: str, key: str, payload: Dict) -> None:
+        if kind not in self.HANDLERS:
+            raise ValueError(f"Unknown journal entry kind: {kind}")
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO journal (idempotency_key, kind, payload, created_at) VALUES (?, ?, ?, ?)",
+                (key, kind, json.dumps(payload, default=_encode), datetime.now().isoformat())
+            )
+
+    def pending_count(self) -> int:
+        row = self._connection().execute(
+            "SELECT COUNT(*) FROM journal WHERE status = ?", (self.PENDING,)
+        ).fetchone()
+        return row[0]
+
+    def conflicts(self) -> List[Dict]:
+        rows = self._connection().execute(
+            "SELECT * FROM journal WHERE status = ? ORDER BY entry_id", (self.CONFLICT,)
+        ).fetchall()
+        return [dict(row, payload=json.loads(row['payload'])) for row in rows]
+
+    def replay(self) -> int:
+        """Push pending entries until none are left or the database goes away; returns how many were replayed"""
+        if not self._replay_lock.acquire(blocking=False):
+            return 0
+        try:
+            replayed = 0
+            while True:
+                batch = self._connection().execute(
+                    "SELECT * FROM journal WHERE status = ? ORDER BY entry_id LIMIT ?",
+                    (self.PENDING, self.batch_size)
+                ).fetchall()
+                if not batch:
+                    return replayed
+
+                results = []
+                unavailable = False
+                for entry in batch:
+                    payload = json.loads(entry['payload'])
+                    try:
+                        remote_id = self.HANDLERS[entry['kind']](entry['idempotency_key'], payload)
+                        results.append((self.REPLAYED, remote_id, None, entry))
+                    except DatabaseUnavailableError:
+                        unavailable = True
+                        break
+                    except (InsufficientStockError, PrescriptionError) as e:
+                        results.append((self.CONFLICT, None, str(e), entry))
+                    except Exception as e:
+                        if Database.connection_lost(e):
+                            unavailable = True
+                            break
+                        if getattr(e, 'errno', None) in TRANSIENT_ERRORS:
+                            # Entries after this one wait too, so they still replay in order
+                            logger.warning("Journal entry %s hit %s; retrying on the next pass",
+                                           entry['idempotency_key'], e)
+                            unavailable = True
+                            break
+                        logger.exception("Journal entry %s could not be replayed", entry['idempotency_key'])
+                        results.append((self.CONFLICT, None, str(e), entry))
+
+                now = datetime.now().isoformat()
+                with self._connection() as conn:
+                    conn.executemany(
+                        "UPDATE journal SET status = ?, remote_id = ?, detail = ?, replayed_at = ? WHERE entry_id = ?",
+                        [(status, remote_id, detail, now, entry['entry_id'])
+                         for status, remote_id, detail, entry in results]
+                    )
+                for status, remote_id, detail, entry in results:
+                    replayed += status == self.REPLAYED
+                    try:
+                        self.events[entry['kind']].put_nowait((entry['idempotency_key'], entry['kind'], status,
+                                                               {'remote_id': remote_id, 'detail': detail,
+                                                                'payload': json.loads(entry['payload'])}))
+                    except queue.Full:
+                        logger.info("No screen is draining %s journal events; dropped %s",
+                                    entry['kind'], entry['idempotency_key'])
+                if unavailable:
+                    return replayed
+        finally:
+            self._replay_lock.release()
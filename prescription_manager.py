@@ -1,12 +1,19 @@
 import tkinter as tk
 from tkinter import ttk, messagebox
 from datetime import datetime, timedelta
-from database import Prescription, Customer, Medicine, Database
+from database import Prescription, Customer, Medicine, MedicineLot, Database
+from interactions import InteractionIndex, describe
 
 class PrescriptionManager:
-    def __init__(self, parent_frame):
+    PAGE_SIZE = 50
+
+    def __init__(self, parent_frame, interactions: InteractionIndex = None):
         self.frame = ttk.Frame(parent_frame)
         self.current_prescription = None
+        self.interactions = interactions or InteractionIndex()
+        # Cursor that starts each page seen so far, for going back
+        self.page_cursors = [None]
+        self.next_cursor = None
         self.setup_ui()
 
     def setup_ui(self):
@@ -14,12 +21,24 @@ class PrescriptionManager:
         search_frame = ttk.Frame(self.frame)
         search_frame.pack(fill="x", padx=10, pady=10)
         
-        ttk.Label(search_frame, text="Customer:").pack(side="left")
+        ttk.Label(search_frame, text="Customer:").grid(row=0, column=0, sticky="e")
         self.customer_combo = ttk.Combobox(search_frame, state="readonly")
-        self.customer_combo.pack(side="left", padx=5)
+        self.customer_combo.grid(row=0, column=1, padx=5, pady=5)
+        
+        ttk.Label(search_frame, text="Doctor:").grid(row=0, column=2, sticky="e")
+        self.doctor_entry = ttk.Entry(search_frame)
+        self.doctor_entry.grid(row=0, column=3, padx=5, pady=5)
+        
+        ttk.Label(search_frame, text="Issued From (YYYY-MM-DD):").grid(row=1, column=0, sticky="e")
+        self.start_entry = ttk.Entry(search_frame)
+        self.start_entry.grid(row=1, column=1, padx=5, pady=5)
+        
+        ttk.Label(search_frame, text="To (YYYY-MM-DD):").grid(row=1, column=2, sticky="e")
+        self.end_entry = ttk.Entry(search_frame)
+        self.end_entry.grid(row=1, column=3, padx=5, pady=5)
         
         ttk.Button(search_frame, text="Search", 
-                  command=self.search_prescriptions).pack(side="left", padx=5)
+                  command=self.search_prescriptions).grid(row=1, column=4, padx=5, pady=5)
         
         # Prescription treeview
         self.tree = ttk.Treeview(self.frame, columns=("ID", "Customer", "Doctor", "Issued", "Expires", "Items"), show="headings")
@@ -40,6 +59,16 @@ class PrescriptionManager:
         self.tree.pack(fill="both", expand=True, padx=10, pady=5)
         self.tree.bind("<<TreeviewSelect>>", self.on_prescription_select)
         
+        # Paging
+        nav_frame = ttk.Frame(self.frame)
+        nav_frame.pack(fill="x", padx=10)
+        self.prev_btn = ttk.Button(nav_frame, text="< Newer", state="disabled", command=self.prev_page)
+        self.prev_btn.pack(side="left", padx=5)
+        self.page_label = ttk.Label(nav_frame, text="Page 1")
+        self.page_label.pack(side="left", padx=5)
+        self.next_btn = ttk.Button(nav_frame, text="Older >", state="disabled", command=self.next_page)
+        self.next_btn.pack(side="left", padx=5)
+        
         # Button frame
         btn_frame = ttk.Frame(self.frame)
         btn_frame.pack(fill="x", padx=10, pady=10)
@@ -55,35 +84,46 @@ class PrescriptionManager:
         self.view_btn.pack(side="right", padx=5)
         
         # Load initial data
+        if not self.interactions.loaded:
+            try:
+                self.interactions.refresh()
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to load interaction rules: {str(e)}")
         self.load_customers()
         self.load_prescriptions()
 
     def load_customers(self):
         customers = Customer.get_all()
-        self.customer_combo['values'] = [f"{c['customer_id']} - {c['name']}" for c in customers]
+        self.customer_combo['values'] = [""] + [f"{c['customer_id']} - {c['name']}" for c in customers]
 
-    def load_prescriptions(self, customer_id=None):
-        # Clear current entries
-        for row in self.tree.get_children():
-            self.tree.delete(row)
-        
-        query = """SELECT p.*, c.name as customer_name, 
-                  (SELECT COUNT(*) FROM prescription_items WHERE prescription_id = p.prescription_id) as item_count
-                  FROM prescriptions p JOIN customers c ON p.customer_id = c.customer_id"""
-        
-        params = []
-        if customer_id:
-            query += " WHERE p.customer_id = %s"
-            params.append(customer_id)
-        
-        prescriptions = Database.execute_query(query, tuple(params) if params else None, fetch=True)
-        
-        # Debugging: Check if prescriptions are returned
-        print("Prescriptions:", prescriptions)
+    def filters(self) -> dict:
+        customer = self.customer_combo.get()
+        start = self.start_entry.get().strip()
+        end = self.end_entry.get().strip()
+        return {
+            'customer_id': int(customer.split(" - ")[0]) if customer else None,
+            'doctor': self.doctor_entry.get().strip() or None,
+            'start': datetime.strptime(start, "%Y-%m-%d").date() if start else None,
+            # The end date is inclusive in the form
+            'end': datetime.strptime(end, "%Y-%m-%d").date() + timedelta(days=1) if end else None
+        }
 
-        if not prescriptions:
-            messagebox.showinfo("No Data", "No prescriptions found.")
+    def load_prescriptions(self):
+        """Show the page starting at the current cursor"""
+        try:
+            prescriptions, self.next_cursor = Prescription.page(
+                after=self.page_cursors[-1], limit=self.PAGE_SIZE, **self.filters()
+            )
+        except ValueError:
+            messagebox.showerror("Error", "Dates must be in YYYY-MM-DD format")
+            return
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load prescriptions: {str(e)}")
             return
+        
+        # Clear current entries
+        self.tree.delete(*self.tree.get_children())
+        self.on_prescription_select(None)
 
         # Insert data into the treeview
         for pres in prescriptions:
@@ -96,12 +136,23 @@ class PrescriptionManager:
                 pres['item_count']
             ))
 
+        page = len(self.page_cursors)
+        self.page_label.config(text=f"Page {page}" if prescriptions else "No prescriptions found")
+        self.prev_btn.config(state="normal" if page > 1 else "disabled")
+        self.next_btn.config(state="normal" if self.next_cursor else "disabled")
+
     def search_prescriptions(self):
-        customer = self.customer_combo.get()
-        if customer:
-            customer_id = int(customer.split(" - ")[0])
-            self.load_prescriptions(customer_id)
-        else:
+        self.page_cursors = [None]
+        self.load_prescriptions()
+
+    def next_page(self):
+        if self.next_cursor:
+            self.page_cursors.append(self.next_cursor)
+            self.load_prescriptions()
+
+    def prev_page(self):
+        if len(self.page_cursors) > 1:
+            self.page_cursors.pop()
             self.load_prescriptions()
 
     def on_prescription_select(self, event):
@@ -118,26 +169,26 @@ class PrescriptionManager:
             self.view_btn.config(state="disabled")
 
     def show_add_dialog(self):
-        dialog = PrescriptionDialog(self.frame, title="Add New Prescription")
+        dialog = PrescriptionDialog(self.frame, title="Add New Prescription",
+                                    interactions=self.interactions)
         if dialog.result:
             try:
-                # Create prescription
-                prescription_id = Prescription.create(dialog.result['prescription'])
-                
-                # Add prescription items
-                for item in dialog.result['items']:
-                    # Check medicine availability
-                    med = Medicine.get_by_id(item['medicine_id'])
-                    if not med or med['quantity'] < item['quantity']:
+                # Check availability of every item with one lookup before
+                # anything is written
+                items = dialog.result['items']
+                requested = {}
+                for item in items:
+                    requested[item['medicine_id']] = requested.get(item['medicine_id'], 0) + item['quantity']
+                # Expired lots cannot be dispensed, so only unexpired stock counts
+                medicines = Medicine.get_many(list(requested), ("name",))
+                available = MedicineLot.availability(list(requested))
+                for medicine_id, quantity in requested.items():
+                    med = medicines.get(medicine_id)
+                    if not med or available[medicine_id] < quantity:
                         raise ValueError(f"Not enough stock for {med['name'] if med else 'selected medicine'}")
-                    
-                    Database.execute_query(
-                        """INSERT INTO prescription_items 
-                          (prescription_id, medicine_id, quantity, dosage, instructions) 
-                          VALUES (%s, %s, %s, %s, %s)""",
-                        (prescription_id, item['medicine_id'], item['quantity'], 
-                         item['dosage'], item['instructions'])
-                    )
+                
+                # Create the prescription and all of its items together
+                Prescription.create_with_items(dialog.result['prescription'], items)
                 
                 self.load_prescriptions()
                 messagebox.showinfo("Success", "Prescription added successfully")
@@ -155,17 +206,13 @@ class PrescriptionManager:
             if not prescription:
                 raise Exception("Prescription not found")
             
-            # Get existing items
-            items = Database.execute_query(
-                """SELECT medicine_id, quantity, dosage, instructions 
-                   FROM prescription_items 
-                   WHERE prescription_id = %s""",
-                (prescription_id,), fetch=True
-            )
+            # Get existing items; their item_ids let the save keep unchanged lines
+            items = Prescription.get_items(prescription_id)
             
             dialog = PrescriptionDialog(
                 self.frame,
                 title="Edit Prescription",
+                interactions=self.interactions,
                 data={
                     'prescription': {
                         'customer_id': prescription['customer_id'],
@@ -180,24 +227,9 @@ class PrescriptionManager:
             )
             
             if dialog.result:
-                # Update prescription
-                Prescription.update(prescription_id, dialog.result['prescription'])
-                
-                # Delete existing items
-                Database.execute_query(
-                    "DELETE FROM prescription_items WHERE prescription_id = %s",
-                    (prescription_id,)
-                )
-                
-                # Add new items
-                for item in dialog.result['items']:
-                    Database.execute_query(
-                        """INSERT INTO prescription_items 
-                          (prescription_id, medicine_id, quantity, dosage, instructions) 
-                          VALUES (%s, %s, %s, %s, %s)""",
-                        (prescription_id, item['medicine_id'], item['quantity'], 
-                         item['dosage'], item['instructions'])
-                    )
+                # Apply the header and only the changed items in one transaction
+                Prescription.replace_items(prescription_id, dialog.result['items'],
+                                           data=dialog.result['prescription'])
                 
                 self.load_prescriptions()
                 messagebox.showinfo("Success", "Prescription updated successfully")
@@ -223,7 +255,7 @@ class PrescriptionManager:
         
         prescription_id = self.current_prescription[0]
         items = Database.execute_query(
-            """SELECT m.name, pi.quantity, pi.dosage, pi.instructions 
+            """SELECT m.name, pi.quantity, pi.dosage, pi.instructions, pi.fills_remaining 
               FROM prescription_items pi JOIN medicines m 
               ON pi.medicine_id = m.medicine_id 
               WHERE pi.prescription_id = %s""",
@@ -232,11 +264,12 @@ class PrescriptionManager:
         detail_window = tk.Toplevel(self.frame)
         detail_window.title(f"Prescription #{prescription_id} Items")
         
-        tree = ttk.Treeview(detail_window, columns=("Medicine", "Quantity", "Dosage", "Instructions"), show="headings")
+        tree = ttk.Treeview(detail_window, columns=("Medicine", "Quantity", "Dosage", "Instructions", "Fills"), show="headings")
         tree.heading("Medicine", text="Medicine")
         tree.heading("Quantity", text="Quantity")
         tree.heading("Dosage", text="Dosage")
         tree.heading("Instructions", text="Instructions")
+        tree.heading("Fills", text="Fills Left")
         tree.pack(fill="both", expand=True, padx=10, pady=10)
         
         for item in items:
@@ -244,5 +277,255 @@ class PrescriptionManager:
                 item['name'],
                 item['quantity'],
                 item['dosage'] or "N/A",
-                item['instructions'] or "N/A"
+                item['instructions'] or "N/A",
+                item['fills_remaining']
             ))
+
+class OpenPrescriptionsPanel(ttk.LabelFrame):
+    """A customer's open prescription lines, for dispensing at the counter.
+
+    ``on_dispense(line)`` is called with the chosen row from
+    Prescription.active_for; the caller puts it on the bill.
+    """
+
+    def __init__(self, parent, on_dispense):
+        super().__init__(parent, text="Open Prescriptions", padding=10)
+        self.on_dispense = on_dispense
+        self.lines = {}
+        
+        self.tree = ttk.Treeview(self, columns=("Medicine", "Quantity", "Dosage", "Fills", "Expires"),
+                                 show="headings", height=4)
+        columns = [
+            ("Medicine", "Medicine", 160),
+            ("Quantity", "Qty", 50),
+            ("Dosage", "Dosage", 100),
+            ("Fills", "Fills Left", 70),
+            ("Expires", "Expires", 90)
+        ]
+        for col_id, col_text, width in columns:
+            self.tree.heading(col_id, text=col_text)
+            self.tree.column(col_id, width=width, anchor="center")
+        self.tree.pack(side="left", fill="both", expand=True)
+        self.tree.bind("<Double-1>", lambda event: self.dispense())
+        
+        ttk.Button(self, text="Dispense", command=self.dispense).pack(side="left", padx=5)
+    
+    def show(self, customer_id):
+        self.tree.delete(*self.tree.get_children())
+        self.lines = {}
+        if not customer_id:
+            return
+        try:
+            lines = Prescription.active_for(customer_id)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load prescriptions: {str(e)}")
+            return
+        for line in lines:
+            iid = str(line['item_id'])
+            self.lines[iid] = line
+            self.tree.insert("", "end", iid=iid, values=(
+                line['name'],
+                line['quantity'],
+                line['dosage'] or "N/A",
+                line['fills_remaining'],
+                line['expiry_date'].strftime("%Y-%m-%d") if line['expiry_date'] else "N/A"
+            ))
+    
+    def dispense(self):
+        selected = self.tree.selection()
+        if not selected:
+            messagebox.showwarning("Warning", "Please select a prescription line")
+            return
+        self.on_dispense(self.lines[selected[0]])
+
+class PrescriptionDialog(tk.Toplevel):
+    def __init__(self, parent, title, data=None, interactions: InteractionIndex = None):
+        super().__init__(parent)
+        self.title(title)
+        self.geometry("650x550")
+        self.result = None
+        self.interactions = interactions
+        
+        self.data = data or {
+            'prescription': {
+                'customer_id': None,
+                'doctor_name': '',
+                'doctor_license': '',
+                'issue_date': datetime.now().strftime("%Y-%m-%d"),
+                'expiry_date': (datetime.now() + timedelta(days=180)).strftime("%Y-%m-%d"),
+                'notes': ''
+            },
+            'items': []
+        }
+        # item_id of each line read from the database, by tree row
+        self.item_ids = {}
+        
+        self.create_widgets()
+        self.transient(parent)
+        self.grab_set()
+        self.wait_window(self)
+    
+    def create_widgets(self):
+        prescription = self.data['prescription']
+        form = ttk.Frame(self)
+        form.pack(fill="x", padx=10, pady=10)
+        
+        ttk.Label(form, text="Customer*:").grid(row=0, column=0, padx=5, pady=5, sticky="e")
+        self.customer_combo = ttk.Combobox(form, state="readonly", width=30)
+        self.customer_combo.grid(row=0, column=1, padx=5, pady=5, sticky="w")
+        
+        self.entries = {}
+        fields = [
+            ("Doctor Name", "doctor_name"),
+            ("Doctor License", "doctor_license"),
+            ("Issue Date* (YYYY-MM-DD)", "issue_date"),
+            ("Expiry Date (YYYY-MM-DD)", "expiry_date"),
+            ("Notes", "notes")
+        ]
+        for i, (label, field) in enumerate(fields, start=1):
+            ttk.Label(form, text=label + ":").grid(row=i, column=0, padx=5, pady=5, sticky="e")
+            entry = ttk.Entry(form, width=33)
+            entry.grid(row=i, column=1, padx=5, pady=5, sticky="w")
+            entry.insert(0, prescription.get(field) or "")
+            self.entries[field] = entry
+        
+        # Items
+        items_frame = ttk.LabelFrame(self, text="Items", padding=10)
+        items_frame.pack(fill="both", expand=True, padx=10, pady=5)
+        
+        ttk.Label(items_frame, text="Medicine:").grid(row=0, column=0, sticky="e")
+        self.medicine_combo = ttk.Combobox(items_frame, state="readonly", width=25)
+        self.medicine_combo.grid(row=0, column=1, padx=5, pady=5)
+        ttk.Label(items_frame, text="Qty:").grid(row=0, column=2, sticky="e")
+        self.quantity_spin = ttk.Spinbox(items_frame, from_=1, to=1000, width=5)
+        self.quantity_spin.set(1)
+        self.quantity_spin.grid(row=0, column=3, padx=5, pady=5)
+        ttk.Label(items_frame, text="Dosage:").grid(row=1, column=0, sticky="e")
+        self.dosage_entry = ttk.Entry(items_frame, width=28)
+        self.dosage_entry.grid(row=1, column=1, padx=5, pady=5)
+        ttk.Label(items_frame, text="Instructions:").grid(row=1, column=2, sticky="e")
+        self.instructions_entry = ttk.Entry(items_frame, width=25)
+        self.instructions_entry.grid(row=1, column=3, columnspan=2, padx=5, pady=5)
+        ttk.Label(items_frame, text="Refills:").grid(row=2, column=0, sticky="e")
+        self.refills_spin = ttk.Spinbox(items_frame, from_=0, to=12, width=5)
+        self.refills_spin.set(0)
+        self.refills_spin.grid(row=2, column=1, padx=5, pady=5, sticky="w")
+        ttk.Button(items_frame, text="Add Item", command=self.add_item).grid(row=0, column=4, padx=5)
+        
+        self.items_tree = ttk.Treeview(items_frame, columns=("Medicine", "Quantity", "Dosage", "Instructions", "Refills"),
+                                       show="headings", height=6)
+        for col_id, width in (("Medicine", 170), ("Quantity", 60), ("Dosage", 110), ("Instructions", 180),
+                              ("Refills", 60)):
+            self.items_tree.heading(col_id, text=col_id)
+            self.items_tree.column(col_id, width=width)
+        self.items_tree.grid(row=3, column=0, columnspan=5, sticky="nsew", pady=5)
+        items_frame.rowconfigure(3, weight=1)
+        ttk.Button(items_frame, text="Remove Item", command=self.remove_item).grid(row=4, column=4, pady=5)
+        
+        button_frame = ttk.Frame(self)
+        button_frame.pack(pady=10)
+        ttk.Button(button_frame, text="Save", command=self.on_save).pack(side="left", padx=5)
+        ttk.Button(button_frame, text="Cancel", command=self.destroy).pack(side="right", padx=5)
+        
+        self.load_choices()
+        for item in self.data['items']:
+            row = self.items_tree.insert("", "end", values=(
+                self.medicine_label(item['medicine_id']),
+                item['quantity'],
+                item['dosage'] or "",
+                item['instructions'] or "",
+                item.get('refills') or 0
+            ))
+            if item.get('item_id'):
+                self.item_ids[row] = item['item_id']
+    
+    def load_choices(self):
+        try:
+            customers = Customer.get_all()
+            self.customer_combo['values'] = [f"{c['customer_id']} - {c['name']}" for c in customers]
+            customer_id = self.data['prescription']['customer_id']
+            for value in self.customer_combo['values']:
+                if customer_id and value.startswith(f"{customer_id} - "):
+                    self.customer_combo.set(value)
+            self.medicines = {m['medicine_id']: m['name'] for m in Medicine.get_all()}
+            self.medicine_combo['values'] = [f"{mid} - {name}" for mid, name in self.medicines.items()]
+        except Exception as e:
+            self.medicines = {}
+            messagebox.showerror("Error", f"Failed to load customers and medicines: {str(e)}")
+    
+    def medicine_label(self, medicine_id):
+        return f"{medicine_id} - {self.medicines.get(medicine_id, 'Unknown')}"
+    
+    def add_item(self):
+        medicine = self.medicine_combo.get()
+        if not medicine:
+            messagebox.showwarning("Warning", "Please select a medicine")
+            return
+        try:
+            quantity = int(self.quantity_spin.get())
+            if quantity <= 0:
+                raise ValueError
+            refills = int(self.refills_spin.get())
+            if refills < 0:
+                raise ValueError
+        except ValueError:
+            messagebox.showerror("Error", "Quantity must be a positive number and refills zero or more")
+            return
+        self.items_tree.insert("", "end", values=(
+            medicine, quantity, self.dosage_entry.get(), self.instructions_entry.get(), refills
+        ))
+        self.dosage_entry.delete(0, tk.END)
+        self.instructions_entry.delete(0, tk.END)
+    
+    def remove_item(self):
+        for row in self.items_tree.selection():
+            self.item_ids.pop(row, None)
+            self.items_tree.delete(row)
+    
+    def on_save(self):
+        try:
+            customer = self.customer_combo.get()
+            if not customer:
+                raise ValueError("Please select a customer")
+            issue_date = datetime.strptime(self.entries['issue_date'].get().strip(), "%Y-%m-%d").date()
+            expiry = self.entries['expiry_date'].get().strip()
+            expiry_date = datetime.strptime(expiry, "%Y-%m-%d").date() if expiry else None
+            if expiry_date and expiry_date < issue_date:
+                raise ValueError("Expiry date is before the issue date")
+            
+            items = []
+            for row in self.items_tree.get_children():
+                medicine, quantity, dosage, instructions, refills = self.items_tree.item(row)['values']
+                item = {
+                    'medicine_id': int(str(medicine).split(" - ")[0]),
+                    'quantity': int(quantity),
+                    'dosage': str(dosage) or None,
+                    'instructions': str(instructions) or None,
+                    'refills': int(refills)
+                }
+                if row in self.item_ids:
+                    item['item_id'] = self.item_ids[row]
+                items.append(item)
+            if not items:
+                raise ValueError("Add at least one item")
+            
+            if self.interactions:
+                findings = self.interactions.check([item['medicine_id'] for item in items])
+                if findings and not messagebox.askyesno("Interaction Warning",
+                                                        describe(findings) + "\n\nSave anyway?"):
+                    return
+            
+            self.result = {
+                'prescription': {
+                    'customer_id': int(customer.split(" - ")[0]),
+                    'doctor_name': self.entries['doctor_name'].get() or None,
+                    'doctor_license': self.entries['doctor_license'].get() or None,
+                    'issue_date': issue_date,
+                    'expiry_date': expiry_date,
+                    'notes': self.entries['notes'].get() or None
+                },
+                'items': items
+            }
+            self.destroy()
+        except ValueError as e:
+            messagebox.showerror("Error", f"Invalid input: {str(e)}")
@@ -0,0 +1,103 @@
+import logging
+import os
+import zlib
+from datetime import date, datetime, timedelta
+from typing import Optional
+from database import Receipt
+
+logger = logging.getLogger(__name__)
+
+class ReceiptArchive:
+    """Receipt files sharded by day with an index table for lookups.
+
+    Each receipt is stored once as ``<root>/YYYY/MM/DD/sale_<id>.<ext>``, so
+    names never collide and no directory holds more than a day of sales.
+    The ``receipts`` table maps sale, customer and date to the file, which
+    makes ``read`` a single indexed query and one open. ``pack_day`` folds a
+    finished day into one zlib-compressed segment file and drops the loose
+    files; the index then points at the receipt's offset in the segment.
+    """
+
+    SEGMENT_NAME = "segment_{first}-{last}.seg"
+
+    def __init__(self, root: str = None):
+        self.root = root or os.path.join(os.getcwd(), "receipts")
+
+    def day_dir(self, day: date) -> str:
+        return os.path.join(self.root, f"{day.year:04d}", f"{day.month:02d}", f"{day.day:02d}")
+
+    def path_for(self, sale_id, issued_at: datetime, extension: str) -> str:
+        return os.path.join(self.day_dir(issued_at), f"sale_{sale_id}.{extension}")
+
+    def store(self, sale_id, receipt: dict, data: bytes, fmt: str, extension: str) -> str:
+        """Write a rendered receipt and index it; returns the file path"""
+        path = self.path_for(sale_id, receipt['issued_at'], extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so a crash never leaves a half-written receipt
+        # behind an index entry
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        Receipt.record({
+            'sale_id': sale_id,
+            'customer_id': receipt.get('customer_id'),
+            'format': fmt,
+            'issued_at': receipt['issued_at'],
+            'path': os.path.relpath(path, self.root),
+            'size': len(data)
+        })
+        return path
+
+    def read(self, sale_id, fmt: str = None) -> Optional[bytes]:
+        """Receipt bytes for a sale, or None if it was never archived"""
+        entry = Receipt.for_sale(sale_id, fmt)
+        if entry is None:
+            return None
+        if entry['segment_path']:
+            with open(os.path.join(self.root, entry['segment_path']), "rb") as f:
+                f.seek(entry['segment_offset'])
+                return zlib.decompress(f.read(entry['segment_length']))
+        with open(os.path.join(self.root, entry['path']), "rb") as f:
+            return f.read()
+
+    def pack_day(self, day: date) -> int:
+        """Pack the day's loose receipts into one segment; returns how many were packed"""
+        entries = Receipt.on_day(day, unpacked_only=True)
+        if not entries:
+            return 0
+
+        segment_path = os.path.join(
+            os.path.relpath(self.day_dir(day), self.root),
+            self.SEGMENT_NAME.format(first=entries[0]['receipt_id'], last=entries[-1]['receipt_id'])
+        )
+        full_segment_path = os.path.join(self.root, segment_path)
+        placements = []
+        packed_files = []
+        with open(full_segment_path + ".tmp", "wb") as segment:
+            for entry in entries:
+                path = os.path.join(self.root, entry['path'])
+                try:
+                    with open(path, "rb") as f:
+                        data = zlib.compress(f.read())
+                except FileNotFoundError:
+                    logger.warning("Receipt file %s is missing; left unpacked", path)
+                    continue
+                placements.append((entry['receipt_id'], segment.tell(), len(data)))
+                packed_files.append(path)
+                segment.write(data)
+        os.replace(full_segment_path + ".tmp", full_segment_path)
+
+        # Loose files are only removed once the index points at the segment
+        Receipt.mark_packed(segment_path, placements)
+        for path in packed_files:
+            os.remove(path)
+        return len(placements)
+
+    def pack_older_than(self, days: int = 30) -> int:
+        """Pack every day older than the given age; meant for the scheduler"""
+        packed = 0
+        for day in Receipt.unpacked_days(date.today() - timedelta(days=days)):
+            packed += self.pack_day(day)
+        return packed
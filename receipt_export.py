@@ -0,0 +1,177 @@
+"""Bulk receipt reprint and export.
+
+Regenerates receipts for every sale in a date range, e.g. for an audit or
+after a letterhead change::
+
+    python receipt_export.py 2026-01-01 2026-02-01 --format pdf
+    python receipt_export.py 2026-01-01 2026-02-01 --pdf january.pdf
+"""
+import argparse
+import multiprocessing
+import time
+from collections import deque
+from datetime import date
+from itertools import islice
+from typing import Iterator, List
+from cart import to_money
+from database import Database
+from receipt_archive import ReceiptArchive
+from receipt_renderer import ReceiptRenderer
+
+_renderer = None
+
+def _init_worker(fmt: str):
+    global _renderer
+    _renderer = ReceiptRenderer(fmt)
+
+def _render(job):
+    sale_id, receipt = job
+    return sale_id, receipt, _renderer.render(receipt)
+
+def _render_page(job):
+    sale_id, receipt = job
+    return sale_id, _renderer.backend('pdf').page(receipt)
+
+def _render_chunk(func, jobs):
+    return [func(job) for job in jobs]
+
+def bounded_imap(pool, func, jobs, chunksize: int = 16, read_ahead: int = 256) -> Iterator:
+    """Like ``pool.imap`` but with at most ``read_ahead`` jobs taken from
+    ``jobs`` and not yet consumed by the caller.
+
+    ``Pool.imap`` feeds tasks from a thread that drains the whole iterable
+    as fast as it can, so a long date range would pile up in its queue.
+    """
+    jobs = iter(jobs)
+    pending = deque()
+    exhausted = False
+    while True:
+        while not exhausted and len(pending) * chunksize < read_ahead:
+            chunk = list(islice(jobs, chunksize))
+            if not chunk:
+                exhausted = True
+                break
+            pending.append(pool.apply_async(_render_chunk, (func, chunk)))
+        if not pending:
+            return
+        yield from pending.popleft().get()
+
+RECEIPT_QUERY = """SELECT s.sale_id, s.sale_date, s.customer_id, s.subtotal, s.tax, s.total,
+                          si.quantity, si.unit_price, si.total_price,
+                          m.name AS medicine_name, c.name AS customer_name, c.phone AS customer_phone
+                   FROM sales s
+                   JOIN sale_items si ON si.sale_id = s.sale_id
+                   JOIN medicines m ON m.medicine_id = si.medicine_id
+                   LEFT JOIN customers c ON c.customer_id = s.customer_id
+                   WHERE {where}
+                   ORDER BY s.sale_date, s.sale_id, si.item_id"""
+
+def stream_receipts(start: date, end: date) -> Iterator[tuple]:
+    """Yield (sale_id, receipt) for every bill issued in [start, end).
+
+    Lines are read with an unbuffered cursor in bill order, so only one bill
+    is held in memory at a time; totals come from the sale header.
+    """
+    return _read_receipts("s.sale_date >= %s AND s.sale_date < %s", (start, end))
+
+def receipts_for_sales(sale_ids: List[int]) -> Iterator[tuple]:
+    """Yield (sale_id, receipt) for the given sales, e.g. to queue their receipts again"""
+    if not sale_ids:
+        return iter(())
+    return _read_receipts(f"s.sale_id IN ({', '.join(['%s'] * len(sale_ids))})", tuple(sale_ids))
+
+def _read_receipts(where: str, params: tuple) -> Iterator[tuple]:
+    conn = Database.get_connection()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute(RECEIPT_QUERY.format(where=where), params)
+        sale_id, receipt = None, None
+        for row in cursor:
+            if row['sale_id'] != sale_id:
+                if receipt:
+                    yield sale_id, receipt
+                sale_id = row['sale_id']
+                receipt = {
+                    'issued_at': row['sale_date'],
+                    'customer_id': row['customer_id'],
+                    'customer': {'name': row['customer_name'], 'phone': row['customer_phone']}
+                                if row['customer_id'] else None,
+                    'lines': [],
+                    'subtotal': to_money(row['subtotal']),
+                    'tax': to_money(row['tax']),
+                    'total': to_money(row['total'])
+                }
+            receipt['lines'].append((row['medicine_name'], row['quantity'],
+                                     to_money(row['unit_price']), to_money(row['total_price'])))
+        if receipt:
+            yield sale_id, receipt
+    finally:
+        Database.close_connection(conn, cursor)
+
+class ExportProgress:
+    """Counts exported receipts and reports throughput every report_every"""
+
+    def __init__(self, report_every: int = 100, callback=None):
+        self.report_every = report_every
+        self.callback = callback or self.print_progress
+        self.done = 0
+        self.started = time.perf_counter()
+
+    def tick(self):
+        self.done += 1
+        if self.done % self.report_every == 0:
+            self.callback(self.done, time.perf_counter() - self.started)
+
+    def finish(self):
+        self.callback(self.done, time.perf_counter() - self.started)
+
+    @staticmethod
+    def print_progress(done: int, elapsed: float):
+        rate = done / elapsed if elapsed else 0.0
+        print(f"{done} receipts in {elapsed:.1f}s ({rate:.1f}/s)")
+
+def export_to_archive(start: date, end: date, fmt: str = 'png', workers: int = None,
+                      archive: ReceiptArchive = None, progress: ExportProgress = None) -> int:
+    """Re-render every bill in the range into the archive, replacing old copies"""
+    archive = archive or ReceiptArchive()
+    progress = progress or ExportProgress()
+    extension = ReceiptRenderer(fmt).extension()
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(fmt,)) as pool:
+        for sale_id, receipt, data in bounded_imap(pool, _render, stream_receipts(start, end)):
+            archive.store(sale_id, receipt, data, fmt, extension)
+            progress.tick()
+    progress.finish()
+    return progress.done
+
+def export_to_pdf(start: date, end: date, path: str, workers: int = None,
+                  progress: ExportProgress = None) -> int:
+    """Write every bill in the range as one page of a single PDF"""
+    progress = progress or ExportProgress()
+
+    def pages(results):
+        for sale_id, page in results:
+            progress.tick()
+            yield page
+
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=('pdf',)) as pool, \
+            open(path, "wb") as out:
+        ReceiptRenderer('pdf').backend().write(
+            out, pages(bounded_imap(pool, _render_page, stream_receipts(start, end)))
+        )
+    progress.finish()
+    return progress.done
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("start", type=date.fromisoformat, help="first day, YYYY-MM-DD")
+    parser.add_argument("end", type=date.fromisoformat, help="day after the last, YYYY-MM-DD")
+    parser.add_argument("--format", default="png", choices=sorted(ReceiptRenderer.BACKENDS),
+                        help="format written to the archive")
+    parser.add_argument("--pdf", help="write one multi-page PDF here instead of the archive")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.pdf:
+        export_to_pdf(args.start, args.end, args.pdf, args.workers)
+    else:
+        export_to_archive(args.start, args.end, args.format, args.workers)
@@ -0,0 +1,144 @@
+import logging
+import queue
+import threading
+from database import ReceiptJob
+from receipt_renderer import ReceiptRenderer
+from receipt_archive import ReceiptArchive
+from receipt_export import receipts_for_sales
+
+logger = logging.getLogger(__name__)
+
+class ReceiptQueue:
+    """Renders and saves receipts on a small pool of worker threads.
+
+    Checkout only has to call ``submit`` after its commit. Each sale's receipt
+    goes ``queued`` -> ``rendered`` or, after ``retries`` failed attempts with
+    backoff, ``failed``; failed receipts can be queued again with
+    ``retry_failed``. Rendered receipts are written through a ReceiptArchive.
+    Status changes are put on ``self.events`` as
+    (sale_id, status, detail) for the UI thread to drain.
+
+    Queued and failed receipts are also kept in ``receipt_jobs`` until they
+    are archived; on start the queue rebuilds them from their sales and
+    queues them again, so a crash or restart loses none.
+    """
+
+    QUEUED = "queued"
+    RENDERED = "rendered"
+    FAILED = "failed"
+
+    # Sales rebuilt per query when resuming
+    RESUME_CHUNK = 100
+
+    def __init__(self, fmt: str = 'png', workers: int = 2, max_pending: int = 100, retries: int = 3,
+                 backoff: float = 0.5, archive: ReceiptArchive = None, resume: bool = True):
+        self.fmt = fmt
+        self.retries = retries
+        self.backoff = backoff
+        self.archive = archive or ReceiptArchive()
+        self.status = {}
+        self.paths = {}
+        self.failed = {}
+        self.events = queue.Queue()
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._local = threading.local()
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._run, name=f"receipt-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        if resume:
+            threading.Thread(target=self._resume, name="receipt-resume", daemon=True).start()
+
+    def submit(self, sale_id, receipt: dict) -> str:
+        """Queue a receipt without blocking; returns its status"""
+        # Recorded before a worker can see it, so its outcome lands last
+        self._set_status(sale_id, self.QUEUED)
+        try:
+            self._pending.put_nowait((sale_id, receipt, 0))
+        except queue.Full:
+            self.failed[sale_id] = receipt
+            self._set_status(sale_id, self.FAILED, "receipt queue is full")
+            return self.FAILED
+        return self.QUEUED
+
+    def resume(self) -> int:
+        """Queue again the receipts an earlier run left queued or failed; returns how many"""
+        jobs = ReceiptJob.unfinished(self.fmt)
+        resumed = 0
+        for start in range(0, len(jobs), self.RESUME_CHUNK):
+            sale_ids = [job['sale_id'] for job in jobs[start:start + self.RESUME_CHUNK]]
+            for sale_id, receipt in receipts_for_sales(sale_ids):
+                self._set_status(sale_id, self.QUEUED)
+                # Not a worker, so waiting for room cannot stall the pool
+                self._pending.put((sale_id, receipt, 0))
+                resumed += 1
+        return resumed
+
+    def retry_failed(self) -> int:
+        failed, self.failed = self.failed, {}
+        for sale_id, receipt in failed.items():
+            self.submit(sale_id, receipt)
+        return len(failed)
+
+    def pending(self) -> int:
+        return self._pending.qsize()
+
+    def render(self, sale_id, receipt: dict) -> str:
+        """Render and save one receipt; runs on a worker thread"""
+        renderer = getattr(self._local, 'renderer', None)
+        if renderer is None:
+            renderer = self._local.renderer = ReceiptRenderer(self.fmt)
+
+        data = renderer.render(receipt)
+        return self.archive.store(sale_id, receipt, data, self.fmt, renderer.extension())
+
+    def _run(self):
+        while True:
+            sale_id, receipt, attempt = self._pending.get()
+            try:
+                self.paths[sale_id] = self.render(sale_id, receipt)
+                self._set_status(sale_id, self.RENDERED, self.paths[sale_id])
+            except Exception as e:
+                logger.exception("Receipt for sale %s failed (attempt %d)", sale_id, attempt + 1)
+                if attempt + 1 < self.retries:
+                    # Wait out the backoff on a timer so the worker moves on
+                    timer = threading.Timer(self.backoff * 2 ** attempt, self._requeue,
+                                            (sale_id, receipt, attempt + 1))
+                    timer.daemon = True
+                    timer.start()
+                else:
+                    self.failed[sale_id] = receipt
+                    self._set_status(sale_id, self.FAILED, str(e))
+            finally:
+                self._pending.task_done()
+
+    def _requeue(self, sale_id, receipt: dict, attempt: int):
+        # A blocking put here could wait on workers that are themselves
+        # waiting to requeue, so a full queue fails the receipt instead
+        try:
+            self._pending.put_nowait((sale_id, receipt, attempt))
+        except queue.Full:
+            self.failed[sale_id] = receipt
+            self._set_status(sale_id, self.FAILED, "receipt queue is full")
+
+    def _resume(self):
+        try:
+            resumed = self.resume()
+        except Exception:
+            logger.exception("Could not queue unfinished receipts again")
+            return
+        if resumed:
+            logger.info("Queued %d unfinished receipt(s) from an earlier run", resumed)
+
+    def _set_status(self, sale_id, status, detail=None):
+        self.status[sale_id] = status
+        self.events.put((sale_id, status, detail))
+        try:
+            if status == self.RENDERED:
+                ReceiptJob.done(sale_id, self.fmt)
+            else:
+                ReceiptJob.set_status(sale_id, self.fmt, status, detail)
+        except Exception:
+            # The receipt itself is unaffected; only a restart would miss it
+            logger.exception("Could not record receipt status for sale %s", sale_id)
@@ -0,0 +1,359 @@
+import io
+import threading
+import time
+import zlib
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFont
+
+PHARMACY_NAME = "Al-Khwarizmi Pharmacy"
+PHARMACY_ADDRESS = "Address: Baghdad University"
+PHARMACY_PHONE = "Phone: +123 456 7890"
+
+BLACK = (0, 0, 0)
+WHITE = (255, 255, 255)
+
+def load_font(path: str, size: int):
+    """Load a TrueType font once per thread, falling back to PIL's default.
+
+    FreeType faces are not safe to share between threads, so each receipt
+    worker gets its own copy.
+    """
+    return _load_font(path, size, threading.get_ident())
+
+@lru_cache(maxsize=None)
+def _load_font(path: str, size: int, thread_id: int):
+    try:
+        return ImageFont.truetype(path, size)
+    except IOError:
+        return ImageFont.load_default()
+
+def wrap(text: str, width: int):
+    return [text[i:i + width] for i in range(0, len(text), width)] or [""]
+
+class PngBackend:
+    """The original 600px wide raster receipt"""
+
+    extension = "png"
+
+    WIDTH = 600
+    HEADER_HEIGHT = 110
+    NAME_WIDTH = 30
+    LINE_HEIGHT = 25
+    BOTTOM_MARGIN = 30
+
+    def __init__(self, header_lines):
+        self.header_lines = header_lines
+        self.font = load_font("arial.ttf", 18)
+        self.font_bold = load_font("arialbd.ttf", 20)
+        self._header = None
+
+    @property
+    def header(self) -> Image.Image:
+        if self._header is None:
+            header = Image.new('RGB', (self.WIDTH, self.HEADER_HEIGHT), color=WHITE)
+            draw = ImageDraw.Draw(header)
+            name, address, phone = self.header_lines
+            draw.text((50, 20), name, fill=BLACK, font=self.font_bold)
+            draw.text((50, 50), address, fill=BLACK, font=self.font)
+            draw.text((50, 80), phone, fill=BLACK, font=self.font)
+            self._header = header
+        return self._header
+
+    def height(self, receipt: dict) -> int:
+        """Page height needed for receipt, matching the offsets used by draw"""
+        height = self.HEADER_HEIGHT + 30
+        if receipt.get('customer'):
+            height += 60
+        height += 20 + 30
+        for name, *_ in receipt['lines']:
+            height += self.LINE_HEIGHT * len(wrap(name, self.NAME_WIDTH)) + 10
+        height += 20 + 30 + 30 + 40 + 30 + 40
+        return height + self.BOTTOM_MARGIN
+
+    def draw(self, receipt: dict) -> Image.Image:
+        img = Image.new('RGB', (self.WIDTH, self.height(receipt)), color=WHITE)
+        img.paste(self.header, (0, 0))
+        draw = ImageDraw.Draw(img)
+        font, font_bold = self.font, self.font_bold
+
+        y_offset = self.HEADER_HEIGHT
+        draw.text((50, y_offset), f"Date: {receipt['issued_at'].strftime('%m/%d/%Y %H:%M:%S')}",
+                  fill=BLACK, font=font)
+        y_offset += 30
+
+        customer = receipt.get('customer')
+        if customer:
+            draw.text((50, y_offset), f"Customer: {customer['name']}", fill=BLACK, font=font)
+            if customer.get('phone'):
+                draw.text((50, y_offset + 30), f"Phone: {customer['phone']}", fill=BLACK, font=font)
+            y_offset += 60
+
+        draw.line((50, y_offset, 550, y_offset), fill=BLACK, width=2)
+        y_offset += 20
+
+        draw.text((50, y_offset), "Item", fill=BLACK, font=font_bold)
+        draw.text((350, y_offset), "Qty", fill=BLACK, font=font_bold)
+        draw.text((400, y_offset), "Price", fill=BLACK, font=font_bold)
+        draw.text((500, y_offset), "Total", fill=BLACK, font=font_bold)
+        y_offset += 30
+
+        for name, quantity, price, total in receipt['lines']:
+            name_lines = wrap(name, self.NAME_WIDTH)
+            for i, line in enumerate(name_lines):
+                draw.text((50, y_offset + i * self.LINE_HEIGHT), line, fill=BLACK, font=font)
+            draw.text((350, y_offset), str(quantity), fill=BLACK, font=font)
+            draw.text((400, y_offset), f"${price:.2f}", fill=BLACK, font=font)
+            draw.text((500, y_offset), f"${total:.2f}", fill=BLACK, font=font)
+            y_offset += self.LINE_HEIGHT * len(name_lines) + 10
+
+        draw.line((50, y_offset, 550, y_offset), fill=BLACK, width=2)
+        y_offset += 20
+
+        draw.text((400, y_offset), "Subtotal:", fill=BLACK, font=font)
+        draw.text((500, y_offset), f"${receipt['subtotal']:.2f}", fill=BLACK, font=font)
+        y_offset += 30
+
+        draw.text((400, y_offset), "Tax (10%):", fill=BLACK, font=font)
+        draw.text((500, y_offset), f"${receipt['tax']:.2f}", fill=BLACK, font=font)
+        y_offset += 30
+
+        draw.text((400, y_offset), "TOTAL:", fill=BLACK, font=font_bold)
+        draw.text((500, y_offset), f"${receipt['total']:.2f}", fill=BLACK, font=font_bold)
+        y_offset += 40
+
+        draw.text((125, y_offset), "THANK YOU FOR YOUR PURCHASE", fill=BLACK, font=font_bold)
+        y_offset += 30
+        draw.text((200, y_offset), "Please come again!", fill=BLACK, font=font)
+
+        # Stars divider
+        draw.text((125, y_offset + 40), "*" * 50, fill=BLACK, font=font)
+        return img
+
+    def render(self, receipt: dict) -> bytes:
+        buffer = io.BytesIO()
+        self.draw(receipt).save(buffer, format="PNG")
+        return buffer.getvalue()
+
+class EscPosBackend:
+    """Plain-text ESC/POS byte stream for 80mm thermal printers"""
+
+    extension = "bin"
+
+    COLUMNS = 42
+    INIT = b"\x1b@"
+    BOLD_ON = b"\x1bE\x01"
+    BOLD_OFF = b"\x1bE\x00"
+    ALIGN_LEFT = b"\x1ba\x00"
+    ALIGN_CENTER = b"\x1ba\x01"
+    FEED_AND_CUT = b"\x1dV\x42\x00"
+
+    def __init__(self, header_lines):
+        self.header_lines = header_lines
+
+    def text(self, value: str) -> bytes:
+        return value.encode("cp437", errors="replace") + b"\n"
+
+    def row(self, left: str, right: str) -> bytes:
+        return self.text(left + right.rjust(self.COLUMNS - len(left)))
+
+    def render(self, receipt: dict) -> bytes:
+        rule = self.text("-" * self.COLUMNS)
+        name, address, phone = self.header_lines
+        out = [self.INIT, self.ALIGN_CENTER, self.BOLD_ON, self.text(name), self.BOLD_OFF,
+               self.text(address), self.text(phone), self.ALIGN_LEFT,
+               self.text(f"Date: {receipt['issued_at'].strftime('%m/%d/%Y %H:%M:%S')}")]
+
+        customer = receipt.get('customer')
+        if customer:
+            out.append(self.text(f"Customer: {customer['name']}"))
+            if customer.get('phone'):
+                out.append(self.text(f"Phone: {customer['phone']}"))
+
+        out += [rule, self.BOLD_ON, self.text(f"{'Item':<20}{'Qty':>5}{'Price':>8}{'Total':>9}"), self.BOLD_OFF]
+        for item, quantity, price, total in receipt['lines']:
+            name_lines = wrap(item, 20)
+            out.append(self.text(f"{name_lines[0]:<20}{quantity:>5}{price:>8.2f}{total:>9.2f}"))
+            out += [self.text(line) for line in name_lines[1:]]
+
+        out += [rule,
+                self.row("Subtotal:", f"${receipt['subtotal']:.2f}"),
+                self.row("Tax (10%):", f"${receipt['tax']:.2f}"),
+                self.BOLD_ON, self.row("TOTAL:", f"${receipt['total']:.2f}"), self.BOLD_OFF,
+                self.ALIGN_CENTER, self.text(""), self.text("THANK YOU FOR YOUR PURCHASE"),
+                self.text("Please come again!"), self.ALIGN_LEFT, self.FEED_AND_CUT]
+        return b"".join(out)
+
+class PdfBackend:
+    """Small vector PDF using the built-in Helvetica fonts (nothing embedded)"""
+
+    extension = "pdf"
+
+    WIDTH = 300
+    MARGIN = 20
+    LINE = 14
+
+    def __init__(self, header_lines):
+        self.header_lines = header_lines
+
+    @staticmethod
+    def escape(value: str) -> str:
+        value = value.encode("latin-1", errors="replace").decode("latin-1")
+        return value.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+    def page(self, receipt: dict):
+        """Return (height, content stream) for one receipt.
+
+        Each row is a list of (x, text) cells plus a font name, or None for a
+        horizontal rule; rows are laid out top to bottom LINE points apart.
+        """
+        rows = []
+        name, address, phone = self.header_lines
+        rows.append([(self.MARGIN, name), "F2"])
+        rows.append([(self.MARGIN, address), "F1"])
+        rows.append([(self.MARGIN, phone), "F1"])
+        rows.append([(self.MARGIN, f"Date: {receipt['issued_at'].strftime('%m/%d/%Y %H:%M:%S')}"), "F1"])
+        customer = receipt.get('customer')
+        if customer:
+            rows.append([(self.MARGIN, f"Customer: {customer['name']}"), "F1"])
+            if customer.get('phone'):
+                rows.append([(self.MARGIN, f"Phone: {customer['phone']}"), "F1"])
+        rows.append(None)
+        rows.append([(self.MARGIN, "Item"), (170, "Qty"), (200, "Price"), (245, "Total"), "F2"])
+        for item, quantity, price, total in receipt['lines']:
+            name_lines = wrap(item, 28)
+            rows.append([(self.MARGIN, name_lines[0]), (170, str(quantity)),
+                         (200, f"${price:.2f}"), (245, f"${total:.2f}"), "F1"])
+            rows += [[(self.MARGIN, line), "F1"] for line in name_lines[1:]]
+        rows.append(None)
+        rows.append([(170, "Subtotal:"), (245, f"${receipt['subtotal']:.2f}"), "F1"])
+        rows.append([(170, "Tax (10%):"), (245, f"${receipt['tax']:.2f}"), "F1"])
+        rows.append([(170, "TOTAL:"), (245, f"${receipt['total']:.2f}"), "F2"])
+        rows.append([(80, "THANK YOU FOR YOUR PURCHASE"), "F2"])
+        rows.append([(110, "Please come again!"), "F1"])
+
+        height = 2 * self.MARGIN + self.LINE * len(rows)
+        y = height - self.MARGIN - self.LINE
+        ops = []
+        for row in rows:
+            if row is None:
+                rule_y = y + self.LINE // 2
+                ops.append(f"{self.MARGIN} {rule_y} m {self.WIDTH - self.MARGIN} {rule_y} l S")
+            else:
+                font = row[-1]
+                for x, value in row[:-1]:
+                    ops.append(f"BT /{font} 9 Tf {x} {y} Td ({self.escape(value)}) Tj ET")
+            y -= self.LINE
+        return height, "\n".join(ops).encode("latin-1")
+
+    def document(self, receipts) -> bytes:
+        """One PDF with a page per receipt"""
+        out = io.BytesIO()
+        self.write(out, (self.page(receipt) for receipt in receipts))
+        return out.getvalue()
+
+    def write(self, out, pages) -> int:
+        """Stream a PDF of (height, content) pages to a binary file; returns the page count.
+
+        Objects 1-4 are the catalog, page tree and the two fonts; each page
+        adds its content stream and page object. The page tree is written
+        last so pages never have to be held in memory.
+        """
+        offsets = {}
+
+        def emit(number, body):
+            offsets[number] = out.tell()
+            out.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+
+        out.write(b"%PDF-1.4\n")
+        emit(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        emit(3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+        emit(4, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold >>")
+
+        kids = []
+        number = 4
+        for height, content in pages:
+            stream = zlib.compress(content)
+            emit(number + 1, b"<< /Length %d /Filter /FlateDecode >>\nstream\n" % len(stream) + stream + b"\nendstream")
+            emit(number + 2, (
+                f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {self.WIDTH} {height}] "
+                f"/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> /Contents {number + 1} 0 R >>"
+            ).encode())
+            kids.append(f"{number + 2} 0 R")
+            number += 2
+        emit(2, f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>".encode())
+
+        xref = out.tell()
+        out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (number + 1))
+        out.write(b"".join(b"%010d 00000 n \n" % offsets[n] for n in range(1, number + 1)))
+        out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (number + 1, xref))
+        return len(kids)
+
+    def render(self, receipt: dict) -> bytes:
+        return self.document([receipt])
+
+class RenderStats:
+    """Running count, output size and render time per receipt format"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}
+
+    def record(self, fmt: str, size: int, seconds: float):
+        with self._lock:
+            totals = self._totals.setdefault(fmt, {'count': 0, 'bytes': 0, 'seconds': 0.0})
+            totals['count'] += 1
+            totals['bytes'] += size
+            totals['seconds'] += seconds
+
+    def summary(self) -> dict:
+        """Per format: count, average bytes and average milliseconds"""
+        with self._lock:
+            return {fmt: {
+                'count': t['count'],
+                'avg_bytes': t['bytes'] / t['count'],
+                'avg_ms': t['seconds'] / t['count'] * 1000
+            } for fmt, t in self._totals.items()}
+
+render_stats = RenderStats()
+
+class ReceiptRenderer:
+    """Renders receipts from plain data without touching the database.
+
+    A receipt is a dict with ``issued_at`` (datetime), an optional ``customer``
+    dict (``name``, ``phone``), ``lines`` as (name, quantity, price, total)
+    tuples and the ``subtotal``, ``tax`` and ``total`` amounts. ``render``
+    returns the encoded bytes in one of the registered BACKENDS and records
+    size and time in ``render_stats``. Backends are built lazily and kept, so
+    fonts and the PNG header are prepared once per renderer.
+    """
+
+    BACKENDS = {
+        'png': PngBackend,
+        'escpos': EscPosBackend,
+        'pdf': PdfBackend,
+    }
+
+    def __init__(self, fmt: str = 'png', name: str = PHARMACY_NAME,
+                 address: str = PHARMACY_ADDRESS, phone: str = PHARMACY_PHONE):
+        if fmt not in self.BACKENDS:
+            raise ValueError(f"Unknown receipt format: {fmt}")
+        self.fmt = fmt
+        self.header_lines = (name, address, phone)
+        self._backends = {}
+
+    def backend(self, fmt: str = None):
+        fmt = fmt or self.fmt
+        if fmt not in self._backends:
+            self._backends[fmt] = self.BACKENDS[fmt](self.header_lines)
+        return self._backends[fmt]
+
+    def extension(self, fmt: str = None) -> str:
+        return self.BACKENDS[fmt or self.fmt].extension
+
+    def render(self, receipt: dict, fmt: str = None) -> bytes:
+        fmt = fmt or self.fmt
+        backend = self.backend(fmt)
+        start = time.perf_counter()
+        data = backend.render(receipt)
+        render_stats.record(fmt, len(data), time.perf_counter() - start)
+        return data
@@ -1,27 +1,55 @@
+import queue
+import time
 import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog
 from datetime import datetime
-from PIL import Image, ImageDraw, ImageFont
-import os
-from database import Database
+from database import DatabaseUnavailableError, MedicineLot, Sale
+from cart import Cart
+from receipt_queue import ReceiptQueue
+from pos_journal import PosJournal, new_key, receipt_from_payload
+from barcode_index import BarcodeIndex, ScanStats
+from interactions import InteractionIndex, describe
+from prescription_manager import OpenPrescriptionsPanel
+from customer_manager import CustomerSelector
 
 class SalesManager:
-    def __init__(self, parent_frame, connection, medicine_manager):
+    # Receipt output: 'png', 'escpos' (thermal printer) or 'pdf'
+    RECEIPT_FORMAT = "png"
+
+    def __init__(self, parent_frame, connection, medicine_manager, journal: PosJournal = None,
+                 interactions: InteractionIndex = None, barcodes: BarcodeIndex = None):
         self.frame = ttk.Frame(parent_frame)
         self.connection = connection
         self.medicine_manager = medicine_manager
-        self.bill_items = []
+        self.cart = Cart()
+        self.cart.subscribe(self.on_cart_changed)
+        self.receipts = ReceiptQueue(self.RECEIPT_FORMAT)
+        self.journal = journal or PosJournal()
+        self.barcodes = barcodes or BarcodeIndex()
+        self.scan_stats = ScanStats()
+        self.interactions = interactions or InteractionIndex()
+        # One key per bill as it stands; a second click on Generate Bill, or
+        # a retry after a timeout, reuses it, but any change to the bill or
+        # its customer takes a new one so an edited bill is not answered
+        # with the sale saved before the edit
+        self.sale_key = new_key()
         self.setup_ui()
+        self.load_barcodes()
+        if not self.interactions.loaded:
+            self.load_interactions()
+        self.frame.after(500, self.poll_receipts)
 
     def setup_ui(self):
         customer_frame = ttk.LabelFrame(self.frame, text="Customer Information", padding=10)
         customer_frame.pack(fill="x", padx=10, pady=10)
 
-        ttk.Label(customer_frame, text="Customer:").grid(row=0, column=0, padx=5, pady=5, sticky="e")
-        self.customer_var = tk.StringVar()
-        self.customer_dropdown = ttk.Combobox(customer_frame, textvariable=self.customer_var, width=40)
-        self.customer_dropdown.grid(row=0, column=1, padx=5, pady=5)
-        self.load_customer_names()
+        ttk.Label(customer_frame, text="Phone, email or name:").grid(row=0, column=0, padx=5, pady=5, sticky="ne")
+        self.customer_selector = CustomerSelector(customer_frame, on_select=self.on_customer_selected)
+        self.customer_selector.grid(row=0, column=1, padx=5, pady=5, sticky="w")
+
+        # Lines the selected customer can have filled now
+        self.prescriptions_panel = OpenPrescriptionsPanel(self.frame, self.dispense_prescription)
+        self.prescriptions_panel.pack(fill="x", padx=10, pady=5)
 
         add_to_bill_frame = ttk.LabelFrame(self.frame, text="Add to Bill", padding=10)
         add_to_bill_frame.pack(fill="x", padx=10, pady=10)
@@ -38,6 +66,15 @@ class SalesManager:
 
         ttk.Button(add_to_bill_frame, text="Add to Bill", command=self.add_to_bill).grid(row=2, column=1, pady=10)
 
+        # Scanners type the code and press Enter
+        ttk.Label(add_to_bill_frame, text="Scan Barcode").grid(row=3, column=0, padx=10, pady=5, sticky="e")
+        self.scan_entry = ttk.Entry(add_to_bill_frame, width=40)
+        self.scan_entry.grid(row=3, column=1, padx=10, pady=5)
+        self.scan_entry.bind("<Return>", self.on_scan)
+        self.scan_status = ttk.Label(add_to_bill_frame, text="")
+        self.scan_status.grid(row=3, column=2, padx=10, pady=5, sticky="w")
+        self.scan_entry.focus_set()
+
         self.bill_tree = ttk.Treeview(self.frame, columns=("Medicine", "Quantity", "Price", "Total"), show="headings")
         self.bill_tree.heading("Medicine", text="Medicine")
         self.bill_tree.heading("Quantity", text="Quantity")
@@ -57,16 +94,86 @@ class SalesManager:
 
         ttk.Button(self.frame, text="Generate Bill", command=self.generate_bill).pack(pady=10)
 
-    def load_customer_names(self):
-        cursor = self.connection.cursor()
+        receipt_frame = ttk.Frame(self.frame)
+        receipt_frame.pack(fill="x", padx=10, pady=5)
+        self.receipt_status = ttk.Label(receipt_frame, text="")
+        self.receipt_status.pack(side="left", padx=5)
+        ttk.Button(receipt_frame, text="Retry Failed Receipts",
+                   command=self.receipts.retry_failed).pack(side="right", padx=5)
+
+    def load_barcodes(self):
         try:
-            cursor.execute("SELECT customer_id, name FROM customers ORDER BY name")
-            customers = [f"{row[0]} - {row[1]}" for row in cursor.fetchall()]
-            self.customer_dropdown['values'] = customers
+            self.barcodes.load()
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to load customers: {e}")
-        finally:
-            cursor.close()
+            messagebox.showerror("Error", f"Failed to load barcodes: {e}")
+
+    def load_interactions(self):
+        try:
+            self.interactions.refresh()
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load interaction rules: {e}")
+
+    def confirm_interactions(self, medicine_id: int) -> bool:
+        """Ask before adding a medicine that interacts with what is already on the bill"""
+        if medicine_id in self.cart.lines:
+            return True
+        findings = self.interactions.check(list(self.cart.lines) + [medicine_id], added=[medicine_id])
+        if not findings:
+            return True
+        return messagebox.askyesno("Interaction Warning", describe(findings) + "\n\nAdd it anyway?")
+
+    def is_prescription_fill(self, medicine_id: int) -> bool:
+        """Warn and return True when the bill already holds this medicine as a prescription fill"""
+        line = self.cart.lines.get(medicine_id)
+        if line and line['prescription_item_id']:
+            messagebox.showwarning("Warning", f"{line['name']} is on the bill as a prescription fill")
+            return True
+        return False
+
+    def on_scan(self, event=None):
+        """Add one unit of the scanned medicine from the in-memory index.
+
+        Stock is not checked here; checkout takes it from the lots and
+        rejects the bill if anything is short.
+        """
+        start = time.perf_counter()
+        code = self.scan_entry.get()
+        self.scan_entry.delete(0, tk.END)
+        medicine = self.barcodes.lookup(code)
+        if medicine is None:
+            self.scan_status.config(text=f"Unknown barcode {code.strip()}")
+            return
+        if self.is_prescription_fill(medicine['medicine_id']):
+            return
+        if not self.confirm_interactions(medicine['medicine_id']):
+            return
+        self.cart.add(medicine['medicine_id'], medicine['name'], medicine['price'], 1)
+        self.scan_stats.record(time.perf_counter() - start)
+        stats = self.scan_stats.summary()
+        self.scan_status.config(text=f"{medicine['name']} ({stats['p95_ms']:.1f} ms p95)")
+
+    def on_customer_selected(self, customer=None):
+        self.sale_key = new_key()
+        self.prescriptions_panel.show(self.customer_selector.customer_id)
+
+    def dispense_prescription(self, line):
+        """Put one fill of a prescription line on the bill; the fill is used up at checkout"""
+        medicine_id = line['medicine_id']
+        if medicine_id in self.cart.lines:
+            messagebox.showwarning("Warning", f"{line['name']} is already on the bill")
+            return
+        try:
+            available_quantity = MedicineLot.availability([medicine_id])[medicine_id]
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to check stock: {e}")
+            return
+        if line['quantity'] > available_quantity:
+            messagebox.showerror("Error", f"Only {available_quantity} units available in stock")
+            return
+        if not self.confirm_interactions(medicine_id):
+            return
+        self.cart.add(medicine_id, line['name'], line['price'], line['quantity'],
+                      prescription_item_id=line['item_id'])
 
     def load_medicine_names(self):
         cursor = self.connection.cursor()
@@ -101,38 +208,55 @@ class SalesManager:
 
         cursor = self.connection.cursor()
         try:
-            cursor.execute("SELECT name, price, quantity FROM medicines WHERE medicine_id = %s", (medicine_id,))
+            cursor.execute("SELECT name, price FROM medicines WHERE medicine_id = %s", (medicine_id,))
             medicine = cursor.fetchone()
 
             if medicine:
-                medicine_name, price, available_quantity = medicine
-                if quantity > available_quantity:
+                medicine_name, price = medicine
+                if self.is_prescription_fill(medicine_id):
+                    return
+                # Expired lots cannot be sold; count what is already on the bill
+                available_quantity = MedicineLot.availability([medicine_id])[medicine_id]
+                if quantity + self.cart.quantity_of(medicine_id) > available_quantity:
                     messagebox.showerror("Error", f"Only {available_quantity} units available in stock")
                     return
+                if not self.confirm_interactions(medicine_id):
+                    return
                     
-                total = price * quantity
-                self.bill_tree.insert("", "end", 
-                                    values=(medicine_name, quantity, price, total), 
-                                    tags=(medicine_id,))
-                self.update_total()
+                self.cart.add(medicine_id, medicine_name, price, quantity)
                 self.quantity_entry.delete(0, tk.END)
         except Exception as e:
             messagebox.showerror("Error", f"Failed to add to bill: {e}")
         finally:
             cursor.close()
 
+    def on_cart_changed(self, event, line):
+        """Mirror a single cart change into the bill view"""
+        self.sale_key = new_key()
+        if event == 'clear':
+            self.bill_tree.delete(*self.bill_tree.get_children())
+        elif event == 'remove':
+            self.bill_tree.delete(str(line['medicine_id']))
+        else:
+            values = (line['name'], line['quantity'], f"{line['price']:.2f}", f"{line['total']:.2f}")
+            if event == 'add':
+                self.bill_tree.insert("", "end", iid=str(line['medicine_id']), values=values)
+            else:
+                self.bill_tree.item(str(line['medicine_id']), values=values)
+        self.update_total()
+
     def update_total(self):
-        total = sum(float(self.bill_tree.item(item, "values")[3]) 
-                for item in self.bill_tree.get_children())
-        self.total_label.config(text=f"Total: ${total:.2f}")
+        self.total_label.config(
+            text=f"Subtotal: ${self.cart.subtotal:.2f}   Tax: ${self.cart.tax:.2f}   Total: ${self.cart.total:.2f}"
+        )
 
     def delete_from_bill(self):
         selected_item = self.bill_tree.selection()
         if not selected_item:
             messagebox.showwarning("Warning", "Please select an item to delete.")
             return
-        self.bill_tree.delete(selected_item)
-        self.update_total()
+        for iid in selected_item:
+            self.cart.remove(int(iid))
 
     def change_quantity(self):
         selected_item = self.bill_tree.selection()
@@ -140,190 +264,119 @@ class SalesManager:
             messagebox.showwarning("Warning", "Please select an item to change quantity.")
             return
 
-        medicine_name, old_quantity, price, total = self.bill_tree.item(selected_item, "values")
-        medicine_id = self.bill_tree.item(selected_item, "tags")[0]
+        medicine_id = int(selected_item[0])
+        line = self.cart.lines[medicine_id]
+        if self.is_prescription_fill(medicine_id):
+            return
 
         new_quantity = simpledialog.askinteger(
             "Change Quantity", 
-            f"Enter new quantity for {medicine_name}:", 
+            f"Enter new quantity for {line['name']}:", 
             minvalue=1
         )
         
         if new_quantity:
-            cursor = self.connection.cursor()
             try:
-                cursor.execute("SELECT quantity FROM medicines WHERE medicine_id = %s", (medicine_id,))
-                available_quantity = cursor.fetchone()[0]
+                available_quantity = MedicineLot.availability([medicine_id])[medicine_id]
                 
                 if new_quantity > available_quantity:
                     messagebox.showerror("Error", f"Only {available_quantity} units available in stock")
                     return
+                if not self.confirm_interactions(medicine_id):
+                    return
                     
-                total = float(price) * new_quantity
-                self.bill_tree.item(selected_item, 
-                                  values=(medicine_name, new_quantity, price, total))
-                self.update_total()
+                self.cart.set_quantity(medicine_id, new_quantity)
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to change quantity: {e}")
-            finally:
-                cursor.close()
 
     def clear_bill(self):
-        if not self.bill_tree.get_children():
+        if not len(self.cart):
             return
             
         if messagebox.askyesno("Confirm", "Are you sure you want to clear the bill?"):
-            self.bill_tree.delete(*self.bill_tree.get_children())
-            self.total_label.config(text="Total: $0.00")
+            self.cart.clear()
 
     def generate_bill(self):
-        if not self.bill_tree.get_children():
+        if not len(self.cart):
             messagebox.showwarning("Warning", "No items in the bill!")
             return
             
-        customer_id = None
-        customer_selection = self.customer_var.get()
-        if customer_selection:
-            try:
-                customer_id = int(customer_selection.split(" - ")[0])
-            except (IndexError, ValueError):
-                messagebox.showerror("Error", "Invalid customer selection")
-                return
-
-        bill_data = []
-        for item in self.bill_tree.get_children():
-            medicine_name, quantity, price, total = self.bill_tree.item(item, "values")
-            medicine_id = self.bill_tree.item(item, "tags")[0]
-            bill_data.append((medicine_name, quantity, float(price), float(total), medicine_id))
+        if self.customer_selector.typed():
+            messagebox.showerror("Error", "Choose the customer from the list, or clear the field for a walk-in sale")
+            return
+        customer = self.customer_selector.customer
+        customer_id = customer['customer_id'] if customer else None
 
-        total_price = sum(item[3] for item in bill_data)
+        lines = self.cart.items()
+        issued_at = datetime.now()
+        key = self.sale_key
+        sale = {
+            'customer_id': customer_id,
+            'sale_date': issued_at,
+            'subtotal': self.cart.subtotal,
+            'tax': self.cart.tax,
+            'total': self.cart.total,
+            'idempotency_key': key
+        }
+        receipt = {
+            'issued_at': issued_at,
+            'customer_id': customer_id,
+            # Read at selection time so rendering needs no further queries
+            'customer': {'name': customer['name'], 'phone': customer['phone']} if customer else None,
+            'lines': [(line['name'], line['quantity'], line['price'], line['total']) for line in lines],
+            'subtotal': self.cart.subtotal,
+            'tax': self.cart.tax,
+            'total': self.cart.total
+        }
 
-        cursor = self.connection.cursor()
         try:
-            self.connection.start_transaction()
-            
-            for medicine_name, quantity, price, total, medicine_id in bill_data:
-                cursor.execute(
-                    """INSERT INTO sales 
-                    (medicine_id, quantity, unit_price, total_price, sale_date, customer_id) 
-                    VALUES (%s, %s, %s, %s, NOW(), %s)""",
-                    (medicine_id, quantity, price, total, customer_id)
-                )
-                
-                if not self.medicine_manager.reduce_medicine_quantity(medicine_id, quantity):
-                    raise Exception("Failed to update medicine quantity")
-            
-            if customer_id:
-                points_to_add = int(total_price)
-                cursor.execute(
-                    "UPDATE customers SET loyalty_points = loyalty_points + %s WHERE customer_id = %s",
-                    (points_to_add, customer_id)
-                )
-            
-            self.connection.commit()
-            
-            self.generate_receipt_image(
-                [(item[0], item[1], item[2], item[3]) for item in bill_data], 
-                total_price,
-                customer_id
-            )
-            
-            messagebox.showinfo("Success", "Bill generated and saved!")
-            
-            self.clear_bill()
-            self.load_medicine_names()
-            self.medicine_manager.load_medicines()
-
+            # Header, all lines, the stock they take and loyalty, in one transaction
+            sale_id = Sale.create_with_details(sale, lines)
+        except DatabaseUnavailableError:
+            # Keep the sale locally; the journal replays it once the server is back
+            self.journal.append('sale', key, {
+                'sale': {k: v for k, v in sale.items() if k != 'idempotency_key'},
+                'items': [{k: line[k] for k in ('medicine_id', 'quantity', 'price', 'total', 'prescription_item_id')}
+                          for line in lines],
+                'receipt': receipt
+            })
+            self.receipt_status.config(text="Database unavailable: sale saved offline and will sync")
+            self.cart.clear()
+            return
         except Exception as e:
-            self.connection.rollback()
             messagebox.showerror("Error", f"Failed to generate bill: {str(e)}")
-        finally:
-            cursor.close()
+            return
 
-    def generate_receipt_image(self, bill_data, total_price, customer_id=None):
-        img = Image.new('RGB', (600, 800), color=(255, 255, 255))
-        draw = ImageDraw.Draw(img)
-    
-        try:
-            font = ImageFont.truetype("arial.ttf", 18)
-            font_bold = ImageFont.truetype("arialbd.ttf", 20)
-            font_large = ImageFont.truetype("arialbd.ttf", 24)
-        except IOError:
-            font = ImageFont.load_default()
-            font_bold = ImageFont.load_default()
-            font_large = ImageFont.load_default()
-    
-        # Pharmacy name and address
-        draw.text((50, 20), "Al-Khwarizmi Pharmacy", fill=(0, 0, 0), font=font_bold)
-        draw.text((50, 50), "Address: Baghdad University", fill=(0, 0, 0), font=font)
-        draw.text((50, 80), "Phone: +123 456 7890", fill=(0, 0, 0), font=font)
-    
-        current_datetime = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
-        draw.text((50, 110), f"Date: {current_datetime}", fill=(0, 0, 0), font=font)
-    
-        y_offset = 140
-        if customer_id:
-            cursor = self.connection.cursor()
+        # Receipt drawing and saving happen off the checkout path
+        self.receipts.submit(sale_id, receipt)
+        self.receipt_status.config(text=f"Sale #{sale_id} saved, receipt queued")
+
+        self.cart.clear()
+        self.load_medicine_names()
+        self.medicine_manager.load_medicines()
+        # Fills used by this bill are gone from the panel
+        self.on_customer_selected()
+
+    def poll_receipts(self):
+        """Show receipt status changes reported by the worker pool"""
+        while True:
             try:
-                cursor.execute("SELECT name, phone FROM customers WHERE customer_id = %s", (customer_id,))
-                customer = cursor.fetchone()
-                if customer:
-                    draw.text((50, y_offset), f"Customer: {customer[0]}", fill=(0, 0, 0), font=font)
-                    draw.text((50, y_offset+30), f"Phone: {customer[1]}" if customer[1] else "", 
-                             fill=(0, 0, 0), font=font)
-                    y_offset += 60
-            except Exception:
-                pass
-            finally:
-                cursor.close()
-    
-        draw.line((50, y_offset, 550, y_offset), fill=(0, 0, 0), width=2)
-        y_offset += 20
-    
-        draw.text((50, y_offset), "Item", fill=(0, 0, 0), font=font_bold)
-        draw.text((350, y_offset), "Qty", fill=(0, 0, 0), font=font_bold)
-        draw.text((400, y_offset), "Price", fill=(0, 0, 0), font=font_bold)
-        draw.text((500, y_offset), "Total", fill=(0, 0, 0), font=font_bold)
-        y_offset += 30
-    
-        for medicine, quantity, price, total in bill_data:
-            name_lines = [medicine[i:i+30] for i in range(0, len(medicine), 30)]
-            for i, line in enumerate(name_lines):
-                draw.text((50, y_offset + (i*25)), line, fill=(0, 0, 0), font=font)
-            
-            draw.text((350, y_offset), str(quantity), fill=(0, 0, 0), font=font)
-            draw.text((400, y_offset), f"${price:.2f}", fill=(0, 0, 0), font=font)
-            draw.text((500, y_offset), f"${total:.2f}", fill=(0, 0, 0), font=font)
-            
-            y_offset += 25 * max(1, len(name_lines)) + 10
-    
-        draw.line((50, y_offset, 550, y_offset), fill=(0, 0, 0), width=2)
-        y_offset += 20
-    
-        tax = total_price * 0.10
-        draw.text((400, y_offset), "Subtotal:", fill=(0, 0, 0), font=font)
-        draw.text((500, y_offset), f"${total_price:.2f}", fill=(0, 0, 0), font=font)
-        y_offset += 30
-        
-        draw.text((400, y_offset), "Tax (10%):", fill=(0, 0, 0), font=font)
-        draw.text((500, y_offset), f"${tax:.2f}", fill=(0, 0, 0), font=font)
-        y_offset += 30
-    
-        draw.text((400, y_offset), "TOTAL:", fill=(0, 0, 0), font=font_bold)
-        draw.text((500, y_offset), f"${total_price + tax:.2f}", fill=(0, 0, 0), font=font_bold)
-        y_offset += 40
-    
-        draw.text((125, y_offset), "THANK YOU FOR YOUR PURCHASE", fill=(0, 0, 0), font=font_bold)
-        y_offset += 30
-        draw.text((200, y_offset), "Please come again!", fill=(0, 0, 0), font=font)
-
-        # Stars divider
-        draw.text((125, y_offset + 40), "*" * 50, fill=(0, 0, 0), font=font)
-
-        receipt_dir = os.path.join(os.getcwd(), "receipts")
-        if not os.path.exists(receipt_dir):
-            os.makedirs(receipt_dir)
-            
-        receipt_path = os.path.join(receipt_dir, f"receipt_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png")
-        img.save(receipt_path)
-        messagebox.showinfo("Receipt Saved", f"Receipt saved as:\n{receipt_path}")
\ No newline at end of file
+                sale_id, status, detail = self.receipts.events.get_nowait()
+            except queue.Empty:
+                break
+            if status == ReceiptQueue.RENDERED:
+                self.receipt_status.config(text=f"Receipt for sale #{sale_id} saved as {detail}")
+            elif status == ReceiptQueue.FAILED:
+                self.receipt_status.config(text=f"Receipt for sale #{sale_id} failed: {detail}")
+
+        # Offline sales pushed by the journal replayer
+        while True:
+            try:
+                key, kind, status, detail = self.journal.events['sale'].get_nowait()
+            except queue.Empty:
+                break
+            if status == PosJournal.REPLAYED:
+                self.receipts.submit(detail['remote_id'], receipt_from_payload(detail['payload']))
+            elif status == PosJournal.CONFLICT:
+                self.receipt_status.config(text=f"Offline sale {key[:8]} could not be synced: {detail['detail']}")
+        self.frame.after(500, self.poll_receipts)
@@ -0,0 +1,58 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class BackgroundScheduler:
+    """Runs periodic maintenance jobs on a single daemon thread.
+
+    Jobs must not touch Tk widgets; anything meant for the UI should be handed
+    over through a queue that the UI polls with ``after``.
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def every(self, seconds: float, func, name: str = None, run_now: bool = False):
+        """Schedule func to run every `seconds` seconds"""
+        with self._lock:
+            self.jobs.append({
+                'name': name or getattr(func, '__name__', 'job'),
+                'interval': seconds,
+                'func': func,
+                'next_run': time.monotonic() + (0 if run_now else seconds)
+            })
+        return self
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="pharmacy-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+            with self._lock:
+                due = [job for job in self.jobs if job['next_run'] <= now]
+                for job in due:
+                    job['next_run'] = now + job['interval']
+                wait = min((job['next_run'] for job in self.jobs), default=now + 60) - now
+
+            for job in due:
+                try:
+                    job['func']()
+                except Exception:
+                    logger.exception("Scheduled job %s failed", job['name'])
+
+            self._stop.wait(max(wait, 0.05))
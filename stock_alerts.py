@@ -0,0 +1,79 @@
+import queue
+import threading
+from bisect import bisect_left, insort
+from typing import Dict, List
+from database import Stock
+
+class LowStockAlerts:
+    """Incrementally maintained set of medicines at or below their reorder level.
+
+    Seeded once from the indexed ``stock.below_reorder`` column, then kept
+    current from the levels Stock publishes after every committed movement or
+    reorder-level change, so reading the alerts costs O(alerts) rather than a
+    scan of the catalog. Alerts are ordered by margin (stock minus reorder
+    level), most urgent first.
+
+    Levels arrive from commit hooks on whichever thread committed, so every
+    change puts a snapshot of the alerts on ``self.changes`` for the UI
+    thread to drain instead of calling into the UI.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = {}
+        self._order = []
+        self.changes = queue.Queue()
+        Stock.add_listener(self.update)
+
+    def load(self):
+        """(Re)seed the alert set from the database"""
+        rows = Stock.check_low_stock()
+        with self._lock:
+            self._items = {}
+            self._order = []
+            for row in rows:
+                self._put(row)
+        self._notify()
+
+    def update(self, levels: Dict[int, Dict]):
+        """Apply fresh levels keyed by medicine_id; queues a snapshot on change"""
+        changed = False
+        with self._lock:
+            for medicine_id, level in levels.items():
+                level = dict(level, medicine_id=medicine_id)
+                current = self._items.get(medicine_id)
+                below = level['quantity_in_stock'] <= level['reorder_level']
+                if current and not below:
+                    self._remove(medicine_id)
+                    changed = True
+                elif below and (not current or self._key(current) != self._key(level)):
+                    if current:
+                        self._remove(medicine_id)
+                    self._put(level)
+                    changed = True
+        if changed:
+            self._notify()
+
+    def alerts(self) -> List[Dict]:
+        with self._lock:
+            return [self._items[medicine_id] for _, medicine_id in self._order]
+
+    def close(self):
+        Stock.remove_listener(self.update)
+
+    @staticmethod
+    def _key(item):
+        return (item['quantity_in_stock'] - item['reorder_level'], item['medicine_id'])
+
+    def _put(self, item):
+        self._items[item['medicine_id']] = item
+        insort(self._order, self._key(item))
+
+    def _remove(self, medicine_id):
+        key = self._key(self._items.pop(medicine_id))
+        index = bisect_left(self._order, key)
+        if index < len(self._order) and self._order[index] == key:
+            self._order.pop(index)
+
+    def _notify(self):
+        self.changes.put(self.alerts())
@@ -1,11 +1,17 @@
+import queue
 import tkinter as tk
 from tkinter import ttk, messagebox
-from database import Stock, Medicine, Database
+from database import Stock, Medicine, Database, StockMovement
+from stock_alerts import LowStockAlerts
 
 class StockManager:
+    POLL_MS = 1000
+
     def __init__(self, parent_frame):
         self.frame = ttk.Frame(parent_frame)
+        self.low_stock = LowStockAlerts()
         self.setup_ui()
+        self.frame.after(self.POLL_MS, self.poll_low_stock)
 
     def setup_ui(self):
         # Low stock alert frame
@@ -73,20 +79,36 @@ class StockManager:
         self.load_stock()
 
     def load_low_stock(self):
-        for row in self.alert_tree.get_children():
-            self.alert_tree.delete(row)
-        
+        """Reseed the alert set from the database"""
         try:
-            low_stock = Stock.check_low_stock()
-            for item in low_stock:
-                self.alert_tree.insert("", "end", values=(
-                    item['name'],
-                    item['quantity_in_stock'],
-                    item['reorder_level']
-                ))
+            self.low_stock.load()
         except Exception as e:
             messagebox.showerror("Error", f"Failed to load low stock alerts: {str(e)}")
 
+    def poll_low_stock(self):
+        # The alert engine queues a snapshot after every committed stock
+        # change, from whatever thread committed; only the latest is shown
+        alerts = None
+        while True:
+            try:
+                alerts = self.low_stock.changes.get_nowait()
+            except queue.Empty:
+                break
+        if alerts is not None:
+            self.render_low_stock(alerts)
+        self.frame.after(self.POLL_MS, self.poll_low_stock)
+
+    def render_low_stock(self, alerts):
+        for row in self.alert_tree.get_children():
+            self.alert_tree.delete(row)
+        
+        for item in alerts:
+            self.alert_tree.insert("", "end", values=(
+                item['name'],
+                item['quantity_in_stock'],
+                item['reorder_level']
+            ))
+
     def load_stock(self, search_term=None):
         for row in self.stock_tree.get_children():
             self.stock_tree.delete(row)
@@ -147,17 +169,17 @@ class StockManager:
                 messagebox.showerror("Error", "Medicine not found")
                 return
             
-            # Update stock
-            Database.execute_query(
-                """UPDATE stock SET quantity_in_stock = %s, 
-                  reorder_level = %s, last_updated = CURRENT_DATE 
-                  WHERE medicine_id = %s""",
-                (new_qty, new_reorder, med['medicine_id'])
-            )
+            # Record the change as an adjustment so the ledger and both cached
+            # levels move together
+            with Database.transaction() as cursor:
+                StockMovement.adjust_to(med['medicine_id'], new_qty, cursor=cursor)
+                Stock.set_reorder_level(med['medicine_id'], new_reorder, cursor=cursor)
             
+            # Low stock alerts are pushed by the alert engine on commit
             messagebox.showinfo("Success", "Stock updated successfully")
-            self.load_low_stock()
             self.load_stock()
             
         except ValueError:
-            messagebox.showerror("Error", "Please enter valid numbers for quantity and reorder level")
\ No newline at end of file
+            messagebox.showerror("Error", "Please enter valid numbers for quantity and reorder level")
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to update stock: {str(e)}")
\ No newline at end of file